@@ -1,6 +1,7 @@
 from .kronicler import Database, database_init
 
 from typing import Final
+import atexit
 import time
 from os import getenv
 from starlette.requests import Request
@@ -13,6 +14,19 @@ KRONICLER_ENABLED = getenv("KRONICLER_ENABLED", "true").lower() in ("true", "1")
 
 DB = Database(sync_consume=True)
 
+# Pages are written behind the captures, so write whatever is left when Python exits
+atexit.register(DB.flush)
+
+# perf_counter_ns is precise but counts from an arbitrary point, so captures are moved onto the
+# wall clock by how far apart the two clocks were at import. Deltas stay the same, and starts can
+# be compared with time.time_ns(), like in DB.fetch_range for the last few minutes.
+CLOCK_OFFSET_NS: Final[int] = time.time_ns() - time.perf_counter_ns()
+
+
+def now_ns() -> int:
+    """Nanoseconds since the epoch, with the precision of perf_counter_ns."""
+    return time.perf_counter_ns() + CLOCK_OFFSET_NS
+
 
 def capture(func):
     if not KRONICLER_ENABLED:
@@ -22,7 +36,7 @@ def capture(func):
     def wrapper(*args, **krawgs):
         # Use nano seconds because it's an int
         # def perf_counter_ns() -> int: ...
-        start: int = time.perf_counter_ns()
+        start: int = now_ns()
 
         # TODO: Should I go through args manually here and only share ones that
         # are string, float, and int? This way I can actually store them
@@ -34,7 +48,7 @@ def capture(func):
         #       strings.append(a)
         value = func(*args, **krawgs)
 
-        end: int = time.perf_counter_ns()
+        end: int = now_ns()
 
         DB.capture(func.__name__, args, start, end)
 
@@ -59,9 +73,9 @@ class KroniclerEndpointMiddleware(BaseHTTPMiddleware):
         super().__init__(app)
 
     async def dispatch(self, request: Request, call_next):
-        start: int = time.perf_counter_ns()
+        start: int = now_ns()
         response = await call_next(request)
-        end: int = time.perf_counter_ns()
+        end: int = now_ns()
 
         # After call_next, the route has been matched
         endpoint = request.url.path
@@ -75,9 +89,9 @@ class KroniclerFunctionMiddleware(BaseHTTPMiddleware):
         super().__init__(app)
 
     async def dispatch(self, request: Request, call_next):
-        start: int = time.perf_counter_ns()
+        start: int = now_ns()
         response = await call_next(request)
-        end: int = time.perf_counter_ns()
+        end: int = now_ns()
 
         # After call_next, the route has been matched
         route = request.scope.get("route")
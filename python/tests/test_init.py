@@ -33,3 +33,134 @@ def test_capture():
     foo()
 
     # assert not KQ.empty()
+
+
+def test_flush():
+    from kronicler import capture, DB
+
+    @capture
+    def flushed_function():
+        pass
+
+    flushed_function()
+
+    DB.flush()
+
+    assert DB.contains_name("flushed_function")
+
+
+def test_fetch_range():
+    import time
+    from kronicler import capture, DB
+
+    before = time.time_ns()
+
+    @capture
+    def ranged_function():
+        pass
+
+    ranged_function()
+
+    after = time.time_ns()
+
+    # Captures are on the wall clock, so they can be found by when they ran
+    rows = DB.fetch_range(before, after, name="ranged_function")
+    assert len(rows) == 1
+
+    assert DB.fetch_range(before, after, name="not_captured") == []
+
+
+def test_column():
+    from kronicler import capture, DB
+
+    @capture
+    def column_function():
+        pass
+
+    column_function()
+    DB.flush()
+
+    # One u64 a row, readable without a Python object per row
+    deltas = memoryview(DB.column("delta")).cast("Q")
+    codes = memoryview(DB.column("name_codes")).cast("I")
+    assert len(deltas) == len(codes)
+
+    names = DB.names_by_code()
+    assert names[codes[-1]] == "column_function"
+
+
+def test_scan():
+    from kronicler import capture, DB
+
+    @capture
+    def scanned_function():
+        pass
+
+    for _ in range(5):
+        scanned_function()
+
+    DB.flush()
+
+    batches = list(DB.scan(batch_size=2))
+    assert all(len(b) <= 2 for b in batches)
+
+    rows = [row for batch in batches for row in batch]
+    assert len(rows) == len(DB.fetch_all())
+
+
+def test_logs_since():
+    from kronicler import capture, DB
+
+    # Leftover shards from other runs can share the data directory, so only the rows and high
+    # water of shard 0, the one this process writes to, are checked
+    def in_shard_0(rows):
+        return [row for row in rows if row[0] >> 40 == 0]
+
+    @capture
+    def polled_function():
+        pass
+
+    polled_function()
+    DB.flush()
+
+    mark = DB.high_water()
+    assert DB.logs(since_id=mark) == []
+
+    polled_function()
+    polled_function()
+    DB.flush()
+
+    rows = in_shard_0(DB.logs(since_id=mark, name="polled_function"))
+    assert [row[0] for row in rows] == [mark[0], mark[0] + 1]
+    assert len(DB.logs(since_id=mark, limit=1)) == 1
+    assert DB.high_water()[0] == mark[0] + 2
+
+    # A single ID gets the rows with that ID or later
+    assert len(in_shard_0(DB.logs(since_id=mark[0] + 1))) == 1
+
+
+def test_new_reader():
+    from kronicler import capture, DB, Database
+
+    @capture
+    def read_only_function():
+        pass
+
+    read_only_function()
+    DB.flush()
+
+    reader = Database.new_reader()
+    assert reader.is_reader()
+
+    mark = reader.high_water()
+    assert mark == DB.high_water()
+
+    read_only_function()
+    DB.flush()
+
+    # The reader only moves up to new rows when it refreshes
+    assert reader.high_water() == mark
+    assert reader.refresh() == 1
+
+    rows = reader.logs(since_id=mark)
+    assert [row[1] for row in rows] == ["read_only_function"]
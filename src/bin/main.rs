@@ -1,5 +1,7 @@
+use kronicler::constants::SCAN_BATCH_SIZE;
 use kronicler::database::Database;
 use log::debug;
+use std::io::{self, BufWriter, Write};
 use std::str::FromStr;
 use structopt::StructOpt;
 
@@ -47,15 +49,26 @@ fn init_logging() {
 }
 
 fn fetch_all() {
-    let mut db = Database::new_reader(true);
-
-    for row in db.fetch_all() {
-        println!("{}", row.to_string());
+    let db = Database::new_reader(true);
+    let mut out = BufWriter::new(io::stdout().lock());
+
+    // Print one batch at a time instead of reading every row first
+    let scan = db.scan(SCAN_BATCH_SIZE, 0).expect("Should start scan.");
+
+    for batch in scan {
+        for row in batch {
+            if writeln!(out, "{}", row.to_string()).is_err() {
+                // Stdout was closed, like when piped into `head`
+                return;
+            }
+        }
     }
+
+    let _ = out.flush();
 }
 
 fn fetch_one(index: usize) {
-    let mut db = Database::new_reader(true);
+    let db = Database::new_reader(true);
 
     let row = db.fetch(index);
 
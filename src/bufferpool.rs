@@ -1,7 +1,20 @@
-use super::page::{Page, PageID};
+use super::constants::{
+    BUFFERPOOL_PAGE_LIMIT, DATA_DIRECTORY, DIRTY_PAGE_LIMIT, FLUSH_INTERVAL, MAX_EXTENT_SIZE,
+    PAGE_SIZE,
+};
+use super::page::{decode_value, Page, PageID};
 use super::row::FieldType;
+use super::sealed::SealedFooter;
+use super::segment::ColumnSegments;
+use super::watermark::Watermark;
 use log::{info, warn};
+use memmap2::Mmap;
+use std::collections::{HashSet, VecDeque};
+use std::path::{Path, PathBuf};
+use std::sync::atomic::{AtomicBool, AtomicUsize, Ordering};
 use std::sync::{Arc, RwLock};
+use std::thread::{self, Thread};
+use std::time::{Duration, Instant};
 
 // I had planned to test many different hashmap implementations
 type BHashMap<K, V> = std::collections::HashMap<K, V>;
@@ -12,61 +25,301 @@ type BHashMap<K, V> = std::collections::HashMap<K, V>;
 // inserted. This tells us the location in memory. Using this, we can tell both which page it
 // should be in, and where in the page it should be located
 //
+// A page of PAGE_SIZE bytes holds `PAGE_SIZE / field_type_size` values, so for a 16 byte Epoch
+// that is 256 values per page.
+//
 // If I want ID 0, I go to the 0th page, and the 0th value
 // If I want ID 100, I go to the 0th page, and the 100th value
-// If I want ID 513, I go to the 1st page, and the 0th value
+// If I want ID 257, I go to the 1st page, and the 1st value
 //
 // This way, when we check for a value, we might see that that page is not actually loaded into
-// memory, this will cause us to find the file and then load it into the bufferpool.
+// memory, this will cause us to read it from the column's segment files and then load it into the
+// bufferpool.
+//
+// The page is `index / values_per_page` and the value index is `index % values_per_page`
+//
+// Each column can use an extent size larger than PAGE_SIZE (see `create_column`). Pages of that
+// column are then one extent big, so scanning a column reads fewer and larger blocks.
+//
+// Writes are write-behind. Inserting a value only changes the page in memory and marks it as
+// dirty. Dirty pages get written to disk by `flush`, which is called by the background flusher
+// once too many pages are dirty or the oldest change is older than `FLUSH_INTERVAL`, and again
+// when the Bufferpool is dropped.
+//
+// Pages are removed with the CLOCK (second chance) strategy. Every page in memory, from any
+// column, has a spot in `clock`. Using a page sets its reference bit. When a new page needs to be
+// loaded and `page_limit` pages are already in memory, the hand goes around the clock: pages with
+// the bit set lose it and get another turn, and the first page without it is removed. Dirty pages
+// are written to disk before they are removed.
+//
+// Reading a value with `fetch_shared` only needs a shared reference to the Bufferpool, so any
+// number of readers can run at once. The counters and the reference bits are atomics for that
+// reason. A page that is not in memory is read straight from the memory map of its segment
+// instead of being loaded, because loading it would change the page tables. Only the writer,
+// which holds the Bufferpool for writing, adds and removes pages.
+//
+// Segments that are full are sealed into compressed files by the compactor, see `sealed.rs`.
+// Reading a page of one decompresses the part of the file it is in, and a page loaded from it is
+// never dirty, since nothing is written to a full segment again.
 //
-// The page is `index // 512` and the value index is `index % 512`
+// The writer stages a watermark, the number of rows that are saved apart from the dirty pages.
+// It is published for readers in other processes once those pages are written, see
+// `watermark.rs`.
+
+/// A page in memory and its reference bit for the clock
+struct Frame {
+    page: Arc<RwLock<Page>>,
+    referenced: AtomicBool,
+}
+
+impl Frame {
+    fn new(page: Arc<RwLock<Page>>) -> Self {
+        Frame {
+            page,
+            referenced: AtomicBool::new(false),
+        }
+    }
+}
 
 pub struct Bufferpool {
-    // Right now, there is no removal strategy
-    pages_collections: Vec<BHashMap<PageID, Arc<RwLock<Page>>>>,
+    /// The directory of the shard the columns are in
+    dir: PathBuf,
+    pages_collections: Vec<BHashMap<PageID, Frame>>,
+    /// The size in bytes of the pages of each column
+    extent_sizes: Vec<usize>,
+    /// The files each column's pages are read from and written to
+    segments: Vec<ColumnSegments>,
     page_index: PageID,
     page_limit: usize,
-    page_hit_count: usize,
-    page_miss_count: usize,
+    page_hit_count: AtomicUsize,
+    page_miss_count: AtomicUsize,
+    page_eviction_count: AtomicUsize,
+    /// Every page in memory as (column_index, pid), the front is where the hand points
+    clock: VecDeque<(usize, PageID)>,
+    /// Pages that changed in memory and still need to be written, as (column_index, pid)
+    dirty_pages: HashSet<(usize, PageID)>,
+    /// When the oldest unflushed change was made
+    dirty_since: Option<Instant>,
+    /// The background flusher thread, woken up when there is work for it
+    flusher: Option<Thread>,
+    /// Rows to publish to readers once the dirty pages are written
+    watermark: Option<usize>,
 }
 
 impl Bufferpool {
     pub fn new(column_count: usize) -> Self {
-        let mut page_maps = vec![];
-        for _ in 0..column_count {
-            page_maps.push(BHashMap::new())
-        }
+        Bufferpool::open(&Path::new("./").join(DATA_DIRECTORY), column_count, false)
+    }
+
+    /// Make a Bufferpool for the columns in `dir`
+    ///
+    /// A `read_only` Bufferpool is for a reader, and never makes or writes any files.
+    pub fn open(dir: &Path, column_count: usize, read_only: bool) -> Self {
+        let segments = (0..column_count)
+            .map(|column_index| ColumnSegments::open(dir, column_index, read_only))
+            .collect();
+        let page_maps = (0..column_count).map(|_| BHashMap::new()).collect();
 
         Bufferpool {
+            dir: dir.to_path_buf(),
             pages_collections: page_maps,
+            extent_sizes: vec![PAGE_SIZE; column_count],
+            segments,
             page_index: 0,
-            page_limit: 0,
-            page_hit_count: 0,
-            page_miss_count: 0,
+            page_limit: BUFFERPOOL_PAGE_LIMIT,
+            page_hit_count: AtomicUsize::new(0),
+            page_miss_count: AtomicUsize::new(0),
+            page_eviction_count: AtomicUsize::new(0),
+            clock: VecDeque::new(),
+            dirty_pages: HashSet::new(),
+            dirty_since: None,
+            flusher: None,
+            watermark: None,
+        }
+    }
+
+    /// Spawn the background flusher for a shared Bufferpool
+    ///
+    /// The flusher parks while there are no dirty pages. Once something is dirty, it wakes up at
+    /// least every `FLUSH_INTERVAL` milliseconds and writes the dirty pages out if a threshold
+    /// was passed. It only holds a weak reference, so it stops when the Bufferpool is dropped.
+    pub fn start_flusher(bufferpool: &Arc<RwLock<Bufferpool>>) {
+        let weak = Arc::downgrade(bufferpool);
+
+        let handle = thread::spawn(move || loop {
+            let has_dirty = match weak.upgrade() {
+                Some(bp) => bp.read().unwrap().dirty_count() > 0,
+                None => break,
+            };
+
+            if has_dirty {
+                thread::park_timeout(Duration::from_millis(FLUSH_INTERVAL));
+            } else {
+                thread::park();
+            }
+
+            match weak.upgrade() {
+                Some(bp) => {
+                    if bp.read().unwrap().needs_flush() {
+                        bp.write().unwrap().flush();
+                    }
+                }
+                None => break,
+            }
+        });
+
+        bufferpool.write().unwrap().flusher = Some(handle.thread().clone());
+    }
+
+    /// Write every dirty page to disk, then publish the staged watermark
+    pub fn flush(&mut self) {
+        if !self.dirty_pages.is_empty() {
+            info!("Flushing {} dirty pages", self.dirty_pages.len());
+
+            for (column_index, pid) in self.dirty_pages.drain() {
+                if let Some(frame) = self.pages_collections[column_index].get(&pid) {
+                    let mut p = frame.page.write().unwrap();
+                    p.write_page(&mut self.segments[column_index]);
+                    p.mark_clean();
+                }
+            }
+
+            self.dirty_since = None;
         }
+
+        if let Some(rows) = self.watermark.take() {
+            Watermark::publish(&Watermark::get_path(&self.dir), rows);
+        }
+    }
+
+    /// Write every dirty page, then sync everything written to the segments to disk
+    pub fn sync(&mut self) {
+        self.flush();
+
+        for segments in &self.segments {
+            segments.sync();
+        }
+    }
+
+    /// Publish `rows` to readers once the pages that are dirty now are on disk
+    ///
+    /// Everything else the rows need has to be saved before this is called.
+    pub fn stage_watermark(&mut self, rows: usize) {
+        self.watermark = Some(rows);
+
+        if self.dirty_pages.is_empty() {
+            self.flush();
+        }
+    }
+
+    /// Check if the size or the time threshold for a flush has been passed
+    pub fn needs_flush(&self) -> bool {
+        if self.dirty_pages.len() >= DIRTY_PAGE_LIMIT {
+            return true;
+        }
+
+        match self.dirty_since {
+            Some(since) => since.elapsed() >= Duration::from_millis(FLUSH_INTERVAL),
+            None => false,
+        }
+    }
+
+    pub fn dirty_count(&self) -> usize {
+        self.dirty_pages.len()
     }
 
-    // pub fn create_column(&mut self, column_index: usize) {
-    //     // TODO: Create an internal column
-    //     // self.columns[0].pages ...
-    //     todo!()
-    // }
+    fn mark_dirty(&mut self, column_index: usize, pid: PageID) {
+        if !self.dirty_pages.insert((column_index, pid)) {
+            return;
+        }
+
+        if self.dirty_since.is_none() {
+            self.dirty_since = Some(Instant::now());
+        }
+
+        // Wake the flusher when it goes from idle to having work, or when the size limit is hit
+        let count = self.dirty_pages.len();
+        if count == 1 || count == DIRTY_PAGE_LIMIT {
+            if let Some(t) = &self.flusher {
+                t.unpark();
+            }
+        }
+    }
+
+    /// Check that an extent size is a power of two from PAGE_SIZE up to MAX_EXTENT_SIZE
+    pub fn valid_extent_size(extent_size: usize) -> bool {
+        extent_size.is_power_of_two() && extent_size >= PAGE_SIZE && extent_size <= MAX_EXTENT_SIZE
+    }
 
+    /// Set the size of the pages used for a column
+    ///
+    /// This has to be called before the column has any pages, because the extent size decides
+    /// where each value is stored.
+    pub fn create_column(&mut self, column_index: usize, extent_size: usize) {
+        assert!(
+            Bufferpool::valid_extent_size(extent_size),
+            "Invalid extent size {}",
+            extent_size
+        );
+        assert!(
+            self.pages_collections[column_index].is_empty()
+                || self.extent_sizes[column_index] == extent_size
+        );
+
+        self.extent_sizes[column_index] = extent_size;
+    }
+
+    /// The directory the column files are in
+    pub fn dir(&self) -> &Path {
+        &self.dir
+    }
+
+    pub fn extent_size(&self, column_index: usize) -> usize {
+        self.extent_sizes[column_index]
+    }
+
+    /// Find the page a value is in, and where in that page it starts
+    fn locate(&self, index: usize, column_index: usize, field_type_size: usize) -> (PageID, usize) {
+        let values_per_page = self.extent_sizes[column_index] / field_type_size;
+
+        let pid = index / values_per_page;
+        let index_in_page = (index % values_per_page) * field_type_size;
+
+        (pid, index_in_page)
+    }
+
+    /// Set how many pages, across all columns, can be in memory at once
+    ///
+    /// If there are more pages in memory than the new limit, pages are removed right away.
     pub fn set_page_limit(&mut self, limit: usize) {
-        self.page_limit = limit;
+        self.page_limit = limit.max(1);
+
+        while self.size() > self.page_limit {
+            self.evict();
+        }
     }
 
     pub fn create_page(&mut self, column_index: usize, field_type: FieldType) -> Arc<RwLock<Page>> {
-        let p = Page::new(self.page_index, column_index, field_type.get_size());
+        let p = Page::with_capacity(
+            self.page_index,
+            column_index,
+            field_type.get_size(),
+            self.extent_sizes[column_index],
+        );
         let page = Arc::new(RwLock::new(p));
 
-        self.pages_collections[column_index].insert(self.page_index, page.clone());
+        self.admit(column_index, self.page_index, page.clone());
         self.page_index += 1;
         return page.clone();
     }
 
+    pub fn page_limit(&self) -> usize {
+        self.page_limit
+    }
+
+    /// The amount of pages currently in memory
     pub fn size(&self) -> usize {
-        self.page_index
+        self.clock.len()
     }
 
     pub fn empty(&self) -> bool {
@@ -74,97 +327,291 @@ impl Bufferpool {
     }
 
     pub fn full(&self) -> bool {
-        self.page_index >= self.page_limit
+        self.size() >= self.page_limit
+    }
+
+    pub fn hit_count(&self) -> usize {
+        self.page_hit_count.load(Ordering::Relaxed)
+    }
+
+    pub fn miss_count(&self) -> usize {
+        self.page_miss_count.load(Ordering::Relaxed)
+    }
+
+    pub fn eviction_count(&self) -> usize {
+        self.page_eviction_count.load(Ordering::Relaxed)
+    }
+
+    /// Write a page to the segment files of its column
+    pub fn write_page(&mut self, page: &Page) {
+        page.write_page(&mut self.segments[page.column_index()]);
     }
 
+    /// Call `f` with the bytes of a page without loading it into the Bufferpool
+    ///
+    /// A page that is already in memory is used as it is. Any other page is read straight from
+    /// the memory map of its segment, so scanning a whole column neither copies it nor pushes
+    /// out the pages other readers are using.
+    pub fn with_page_bytes<R>(
+        &self,
+        column_index: usize,
+        pid: PageID,
+        f: impl FnOnce(&[u8]) -> R,
+    ) -> R {
+        if let Some(frame) = self.pages_collections[column_index].get(&pid) {
+            let p = frame.page.read().unwrap();
+            if let Some(bytes) = p.bytes() {
+                return f(bytes);
+            }
+        }
+
+        let extent_size = self.extent_sizes[column_index];
+        let offset = (pid * extent_size) as u64;
+
+        self.with_bytes(column_index, offset, extent_size, f)
+    }
+
+    /// Call `f` with `len` bytes of a column starting at byte `offset`, straight from disk
+    ///
+    /// This is for data that is not kept in pages, like the blocks of an encoded column.
+    pub fn with_bytes<R>(
+        &self,
+        column_index: usize,
+        offset: u64,
+        len: usize,
+        f: impl FnOnce(&[u8]) -> R,
+    ) -> R {
+        let mut f = Some(f);
+
+        let mapped = self.segments[column_index].with_slice(offset, len, |bytes| {
+            f.take().expect("Should only be called once.")(bytes)
+        });
+
+        if let Some(r) = mapped {
+            return r;
+        }
+
+        // The end of the range was never written, so read what is there and fill in zeros
+        let mut buf = vec![0u8; len];
+        self.segments[column_index].read(offset, &mut buf);
+        f.take().expect("Should only be called once.")(&buf)
+    }
+
+    /// Drop the memory maps of every segment, so pages written by another process are read
+    /// again
+    pub fn unmap(&self) {
+        for segments in &self.segments {
+            segments.unmap();
+        }
+    }
+
+    /// Delete the segment files of a column before the one with byte `offset` in it, returning
+    /// how many were deleted
+    pub fn remove_segments_before(&mut self, column_index: usize, offset: u64) -> usize {
+        self.segments[column_index].remove_before(offset)
+    }
+
+    /// The first segment of a column that might not be sealed yet
+    pub fn next_seal(&self, column_index: usize) -> usize {
+        self.segments[column_index].next_seal()
+    }
+
+    /// Start sealing the segments of a column before segment `end`, getting the map of each one
+    ///
+    /// The pages in them have to be written first. See `ColumnSegments::begin_seal`.
+    pub fn begin_seal(
+        &self,
+        column_index: usize,
+        end: usize,
+    ) -> Option<Vec<(usize, Option<Arc<Mmap>>)>> {
+        self.segments[column_index].begin_seal(end)
+    }
+
+    /// Use the sealed segment written for a segment of a column instead of its file
+    pub fn install_sealed(&self, column_index: usize, segment: usize) -> bool {
+        self.segments[column_index].install_sealed(segment)
+    }
+
+    /// Finish sealing the segments of a column, with every one before `end` sealed
+    pub fn end_seal(&self, column_index: usize, end: usize) {
+        self.segments[column_index].end_seal(end)
+    }
+
+    /// Get the footer of a sealed segment of a column, or None if it is not sealed
+    pub fn sealed_footer(&self, column_index: usize, segment: usize) -> Option<SealedFooter> {
+        self.segments[column_index].sealed_footer(segment)
+    }
+
+    /// Write bytes that are not kept in pages straight to the segments of a column
+    pub fn write_bytes(&mut self, column_index: usize, offset: u64, data: &[u8]) {
+        self.segments[column_index].write(offset, data);
+    }
+
+    /// Add a page to memory, making room for it first if the Bufferpool is full
+    fn admit(&mut self, column_index: usize, pid: PageID, page: Arc<RwLock<Page>>) {
+        while self.full() && !self.clock.is_empty() {
+            self.evict();
+        }
+
+        self.pages_collections[column_index].insert(pid, Frame::new(page));
+        self.clock.push_back((column_index, pid));
+    }
+
+    /// Move the clock hand until a page without its reference bit is found and remove it
+    fn evict(&mut self) {
+        while let Some(key) = self.clock.pop_front() {
+            let (column_index, pid) = key;
+
+            // Give the page a second chance
+            let referenced = self.pages_collections[column_index]
+                .get(&pid)
+                .is_some_and(|f| f.referenced.swap(false, Ordering::Relaxed));
+
+            if referenced {
+                self.clock.push_back(key);
+                continue;
+            }
+
+            if let Some(frame) = self.pages_collections[column_index].remove(&pid) {
+                if self.dirty_pages.remove(&key) {
+                    let mut p = frame.page.write().unwrap();
+                    p.write_page(&mut self.segments[column_index]);
+                    p.mark_clean();
+                }
+            }
+
+            if self.dirty_pages.is_empty() {
+                self.dirty_since = None;
+            }
+
+            info!("Evicted page {} from column {}", pid, column_index);
+            self.page_eviction_count.fetch_add(1, Ordering::Relaxed);
+            return;
+        }
+    }
+
+    /// Get a value, loading its page into memory if it is not there yet
     pub fn fetch(
         &mut self,
         index: usize,
         column_index: usize,
         field_type_size: usize,
     ) -> Option<FieldType> {
-        let pid: usize = (index * field_type_size) / 512;
-        let index_in_page = (index * field_type_size) % 512;
+        let (pid, index_in_page) = self.locate(index, column_index, field_type_size);
 
-        if self.page_hit_count as f64 / ((self.page_hit_count + self.page_miss_count) as f64) < 0.40
-        {
-            warn!("Page hit rate is below 40%");
+        if self.pages_collections[column_index].contains_key(&pid) {
+            return self.fetch_shared(index, column_index, field_type_size);
         }
 
-        info!("Fetching index {} from page {}", index_in_page, pid);
+        // The page was not loading in yet, so open the page
+        let mut page = Page::with_capacity(
+            pid,
+            column_index,
+            field_type_size,
+            self.extent_sizes[column_index],
+        );
+        page.open(&mut self.segments[column_index]);
+        self.page_miss_count.fetch_add(1, Ordering::Relaxed);
 
-        if self.pages_collections[column_index].contains_key(&pid) {
-            let page = self.pages_collections[column_index].get(&pid);
-            self.page_hit_count += 1;
+        let value = page.get_value(index_in_page);
 
-            if let Some(p) = page {
-                info!("Fetching value {} in page {}", index_in_page, pid);
+        // Then load the page into the pages_collections
+        self.admit(column_index, pid, Arc::new(RwLock::new(page)));
 
-                let b = p.read().unwrap();
-                return b.get_value(index_in_page);
-            }
-        } else {
-            // The page was not loading in yet, so open the page
-            let mut page = Page::new(pid, column_index, field_type_size);
-            page.open();
-            self.page_miss_count += 1;
+        value
+    }
 
-            // Then load the page into the pages_collections
-            self.pages_collections[column_index].insert(pid, Arc::new(RwLock::new(page)));
+    /// Get a value without changing which pages are in memory
+    ///
+    /// A page in memory is read as it is. Any other value is read from the memory map of its
+    /// segment, since every page that is not in memory has been written to disk.
+    pub fn fetch_shared(
+        &self,
+        index: usize,
+        column_index: usize,
+        field_type_size: usize,
+    ) -> Option<FieldType> {
+        let (pid, index_in_page) = self.locate(index, column_index, field_type_size);
 
-            // Excellent use of recursion. Call this function again now that the page is loaded
-            return self.fetch(index, column_index, field_type_size);
+        let hits = self.hit_count();
+        let misses = self.miss_count();
+        if hits + misses > 0 && (hits as f64 / (hits + misses) as f64) < 0.40 {
+            warn!("Page hit rate is below 40%");
         }
 
-        None
+        info!("Fetching index {} from page {}", index_in_page, pid);
+
+        if let Some(frame) = self.pages_collections[column_index].get(&pid) {
+            self.page_hit_count.fetch_add(1, Ordering::Relaxed);
+            frame.referenced.store(true, Ordering::Relaxed);
+
+            info!("Fetching value {} in page {}", index_in_page, pid);
+
+            let b = frame.page.read().unwrap();
+            return b.get_value(index_in_page);
+        }
+
+        self.page_miss_count.fetch_add(1, Ordering::Relaxed);
+
+        let offset = (pid * self.extent_sizes[column_index] + index_in_page) as u64;
+        self.with_bytes(column_index, offset, field_type_size, |bytes| {
+            decode_value(bytes, field_type_size)
+        })
     }
 
     pub fn insert(&mut self, index: usize, column_index: usize, value: &FieldType) {
         let field_type_size = value.get_size();
 
-        let pid: usize = (index * field_type_size) / 512;
-        let index_in_page = (index * field_type_size) % 512;
+        let (pid, index_in_page) = self.locate(index, column_index, field_type_size);
 
         info!("Getting collection {}", column_index);
         let collection = &self.pages_collections[column_index];
 
         // Check if page is opened in bufferpool
-        if collection.contains_key(&pid) {
+        if let Some(frame) = collection.get(&pid) {
             // Get the page because it was opened
-            let poption = collection.get(&pid);
-            self.page_hit_count += 1;
+            self.page_hit_count.fetch_add(1, Ordering::Relaxed);
+            frame.referenced.store(true, Ordering::Relaxed);
 
-            let mut b = poption.unwrap().write().unwrap();
-            // TODO: Remove clone if possible
-            b.set_value(index_in_page, value.clone());
+            {
+                let mut b = frame.page.write().unwrap();
+                // TODO: Remove clone if possible
+                b.set_value(index_in_page, value.clone());
+            }
 
-            // TODO: Should this always write?
-            // If so, it should do so async
-            b.write_page();
+            self.mark_dirty(column_index, pid);
         } else {
             // Open the page cause it was not opened
-            let mut new_page = Page::new(pid, column_index, value.get_size());
-            new_page.open();
-            self.page_miss_count += 1;
+            let mut new_page = Page::with_capacity(
+                pid,
+                column_index,
+                field_type_size,
+                self.extent_sizes[column_index],
+            );
+            new_page.open(&mut self.segments[column_index]);
+            self.page_miss_count.fetch_add(1, Ordering::Relaxed);
 
             // TODO: Remove clone if possible
             new_page.set_value(index_in_page, value.clone());
 
-            // TODO: Should this always write?
-            // If so, it should do so async
-            new_page.write_page();
-
             // Make an Arc
-            let page = Some(Arc::new(RwLock::new(new_page)));
-            self.pages_collections[column_index].insert(pid, page.clone().unwrap());
+            let page = Arc::new(RwLock::new(new_page));
+            self.admit(column_index, pid, page);
+
+            self.mark_dirty(column_index, pid);
         }
     }
 }
 
+impl Drop for Bufferpool {
+    fn drop(&mut self) {
+        self.flush();
+    }
+}
+
 #[cfg(test)]
 mod tests {
     use super::*;
-    use crate::constants::PAGE_SIZE;
     use crate::database::Database;
 
     #[test]
@@ -194,7 +641,7 @@ mod tests {
         {
             let mut page_1 = page_1_arc.write().unwrap();
             page_1.set_all_values(four_k_of_data);
-            page_1.write_page();
+            bpool.write_page(&page_1);
 
             assert_eq!(page_1.size(), 0);
             assert_eq!(page_1.capacity(), PAGE_SIZE);
@@ -209,21 +656,21 @@ mod tests {
         {
             let mut page_2 = page_2_arc.write().unwrap();
             page_2.set_all_values(four_k_of_data);
-            page_2.write_page();
+            bpool.write_page(&page_2);
         }
 
         let page_3_arc = bpool.create_page(0, FieldType::Epoch(0));
         {
             let mut page_3 = page_3_arc.write().unwrap();
             page_3.set_all_values(four_k_of_data);
-            page_3.write_page();
+            bpool.write_page(&page_3);
         }
 
         let page_4_arc = bpool.create_page(0, FieldType::Epoch(0));
         {
             let mut page_4 = page_4_arc.write().unwrap();
             page_4.set_all_values(four_k_of_data);
-            page_4.write_page();
+            bpool.write_page(&page_4);
         }
 
         assert_eq!(bpool.size(), 4);
@@ -234,13 +681,13 @@ mod tests {
         {
             let mut page_5 = page_5_arc.write().unwrap();
             page_5.set_all_values(four_k_of_data);
-            page_5.write_page();
+            bpool.write_page(&page_5);
         }
 
         // Since the limit is 4, it should have removed one page to allow space for this new one
-        // TODO: Make a removal strategy and this will be true
-        //assert_eq!(bpool.size(), 4);
+        assert_eq!(bpool.size(), 4);
         assert!(bpool.full());
+        assert_eq!(bpool.eviction_count(), 1);
 
         bpool.insert(0, 0, &FieldType::Epoch(100));
 
@@ -280,4 +727,188 @@ mod tests {
             Some(FieldType::Epoch(1100))
         );
     }
+
+    #[test]
+    fn clock_eviction_test() {
+        let column_index = 4001;
+        let field_type_size = 16;
+        let values_per_page = PAGE_SIZE / field_type_size;
+        let mut bpool = Bufferpool::new(column_index + 1);
+        bpool.set_page_limit(2);
+
+        // Use pages far away from the other tests
+        let first = 800 * values_per_page;
+
+        // Fill three pages, which is one more than fits
+        for x in 0..(3 * values_per_page) {
+            bpool.insert(first + x, column_index, &FieldType::Epoch(x as u128 + 1));
+        }
+
+        assert_eq!(bpool.size(), 2);
+        assert_eq!(bpool.eviction_count(), 1);
+
+        // The first page was dirty when it got removed, so it was written and can be read back
+        assert_eq!(
+            bpool.fetch(first, column_index, field_type_size),
+            Some(FieldType::Epoch(1))
+        );
+        assert_eq!(bpool.size(), 2);
+        assert_eq!(bpool.eviction_count(), 2);
+
+        let misses = bpool.miss_count();
+        let hits = bpool.hit_count();
+
+        // Reading the same page again is a hit
+        bpool.fetch(first + 1, column_index, field_type_size);
+        assert_eq!(bpool.miss_count(), misses);
+        assert_eq!(bpool.hit_count(), hits + 1);
+
+        // Lowering the limit removes pages right away
+        bpool.set_page_limit(1);
+        assert_eq!(bpool.size(), 1);
+
+        drop(bpool);
+        let _ = std::fs::remove_file(ColumnSegments::get_segment_path(column_index, 0));
+    }
+
+    #[test]
+    fn with_page_bytes_does_not_load_page_test() {
+        let column_index = 4003;
+        let field_type_size = 16;
+        let mut bpool = Bufferpool::new(column_index + 1);
+        let _ = std::fs::remove_file(ColumnSegments::get_segment_path(column_index, 0));
+
+        bpool.insert(0, column_index, &FieldType::Epoch(7));
+        bpool.insert(
+            PAGE_SIZE / field_type_size,
+            column_index,
+            &FieldType::Epoch(8),
+        );
+        bpool.flush();
+        bpool.set_page_limit(1);
+
+        // Page 0 was pushed out, so it is read from the segment without loading it again
+        let misses = bpool.miss_count();
+        let first = bpool.with_page_bytes(column_index, 0, |b| b[..16].to_vec());
+        assert_eq!(first, 7u128.to_le_bytes().to_vec());
+        assert_eq!(bpool.miss_count(), misses);
+        assert_eq!(bpool.size(), 1);
+
+        // Page 1 is in memory
+        let second = bpool.with_page_bytes(column_index, 1, |b| b[..16].to_vec());
+        assert_eq!(second, 8u128.to_le_bytes().to_vec());
+
+        drop(bpool);
+        let _ = std::fs::remove_file(ColumnSegments::get_segment_path(column_index, 0));
+    }
+
+    #[test]
+    fn fetch_shared_test() {
+        let column_index = 4004;
+        let field_type_size = 16;
+        let mut bpool = Bufferpool::new(column_index + 1);
+        let _ = std::fs::remove_file(ColumnSegments::get_segment_path(column_index, 0));
+
+        let second_page = PAGE_SIZE / field_type_size;
+        bpool.insert(3, column_index, &FieldType::Epoch(7));
+        bpool.insert(second_page, column_index, &FieldType::Epoch(8));
+        bpool.set_page_limit(1);
+
+        // Page 0 was written when it was pushed out, and is read from disk without loading it
+        let shared = &bpool;
+        let misses = shared.miss_count();
+        assert_eq!(
+            shared.fetch_shared(3, column_index, field_type_size),
+            Some(FieldType::Epoch(7))
+        );
+        assert_eq!(shared.miss_count(), misses + 1);
+        assert_eq!(shared.size(), 1);
+
+        // Page 1 is in memory and still dirty
+        let hits = shared.hit_count();
+        assert_eq!(
+            shared.fetch_shared(second_page, column_index, field_type_size),
+            Some(FieldType::Epoch(8))
+        );
+        assert_eq!(shared.hit_count(), hits + 1);
+
+        // Readers on other threads share the Bufferpool
+        let bpool = Arc::new(RwLock::new(bpool));
+        let readers: Vec<_> = (0..4)
+            .map(|_| {
+                let bpool = bpool.clone();
+                thread::spawn(move || {
+                    let bp = bpool.read().unwrap();
+                    (0..100)
+                        .map(|_| bp.fetch_shared(3, column_index, field_type_size))
+                        .all(|v| v == Some(FieldType::Epoch(7)))
+                })
+            })
+            .collect();
+
+        for r in readers {
+            assert!(r.join().unwrap());
+        }
+
+        drop(bpool);
+        let _ = std::fs::remove_file(ColumnSegments::get_segment_path(column_index, 0));
+    }
+
+    #[test]
+    fn page_packing_test() {
+        let column_index = 0;
+        let mut bpool = Bufferpool::new(1);
+
+        // A 16 byte value fills the whole 4096 byte page before moving to the next one
+        assert_eq!(bpool.locate(0, column_index, 16), (0, 0));
+        assert_eq!(bpool.locate(255, column_index, 16), (0, PAGE_SIZE - 16));
+        assert_eq!(bpool.locate(256, column_index, 16), (1, 0));
+
+        // A 64 byte name fits 64 times
+        assert_eq!(bpool.locate(63, column_index, 64), (0, PAGE_SIZE - 64));
+        assert_eq!(bpool.locate(64, column_index, 64), (1, 0));
+
+        // With a 64KB extent, 16 times as many values go in each page
+        bpool.create_column(column_index, 64 * 1024);
+        assert_eq!(bpool.locate(4095, column_index, 16), (0, 64 * 1024 - 16));
+        assert_eq!(bpool.locate(4096, column_index, 16), (1, 0));
+    }
+
+    #[test]
+    fn valid_extent_size_test() {
+        assert!(Bufferpool::valid_extent_size(PAGE_SIZE));
+        assert!(Bufferpool::valid_extent_size(64 * 1024));
+        assert!(Bufferpool::valid_extent_size(MAX_EXTENT_SIZE));
+
+        assert!(!Bufferpool::valid_extent_size(512));
+        assert!(!Bufferpool::valid_extent_size(100_000));
+        assert!(!Bufferpool::valid_extent_size(2 * MAX_EXTENT_SIZE));
+    }
+
+    #[test]
+    fn insert_is_write_behind_test() {
+        let column_index = 4002;
+        let field_type_size = 16;
+        let mut bpool = Bufferpool::new(column_index + 1);
+
+        // Use a page far away from the other tests
+        let index = 700 * (PAGE_SIZE / field_type_size);
+
+        bpool.insert(index, column_index, &FieldType::Epoch(42));
+        assert_eq!(bpool.dirty_count(), 1);
+
+        // The value is not on disk until the page is flushed
+        let mut on_disk = Page::new(700, column_index, field_type_size);
+        on_disk.open(&mut ColumnSegments::new(column_index));
+        assert_eq!(on_disk.get_value(0), Some(FieldType::Epoch(0)));
+
+        bpool.flush();
+        assert_eq!(bpool.dirty_count(), 0);
+
+        on_disk.open(&mut ColumnSegments::new(column_index));
+        assert_eq!(on_disk.get_value(0), Some(FieldType::Epoch(42)));
+
+        drop(bpool);
+        let _ = std::fs::remove_file(ColumnSegments::get_segment_path(column_index, 0));
+    }
 }
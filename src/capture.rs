@@ -1,4 +1,4 @@
-use super::row::{create_function_name, Epoch, FieldType, Row, RID};
+use super::row::{Epoch, FieldType, Row, RID};
 use pyo3::prelude::*;
 
 #[derive(Debug)]
@@ -11,13 +11,22 @@ pub struct Capture {
 }
 
 impl Capture {
-    pub fn to_row(&self, id: RID) -> Row {
-        let name_bytes = create_function_name(&self.name);
+    pub fn new(name: String, args: Vec<PyObject>, start: Epoch, end: Epoch) -> Self {
+        Capture {
+            name,
+            args,
+            start,
+            end,
+            delta: end - start,
+        }
+    }
 
+    /// Make the row that gets stored, with `code` in place of the name
+    pub fn to_row(&self, id: RID, code: u32) -> Row {
         Row {
             id,
             fields: vec![
-                FieldType::Name(name_bytes),
+                FieldType::Code(code),
                 FieldType::Epoch(self.start),
                 FieldType::Epoch(self.end),
                 FieldType::Epoch(self.delta),
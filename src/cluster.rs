@@ -0,0 +1,295 @@
+use super::sealed::sync_dir;
+use log::{info, warn};
+use memmap2::Mmap;
+use serde::{Deserialize, Serialize};
+use std::collections::BTreeMap;
+use std::fs::{self, File};
+use std::io::{ErrorKind, Write};
+use std::path::{Path, PathBuf};
+
+// With `cluster_by_name`, the rows are also kept clustered by function so the run times of one
+// function are read in one go instead of row by row.
+//
+// The columns keep rows in the order they were captured, so the rows of one function are spread
+// over every page. Once CLUSTER_ROWS more rows are written, the background checkpointer reads
+// them from the `name` and `delta` columns from start to end and writes a cluster run,
+// `cluster_{first_row}.data`. In it the deltas of each function are next to each other as little
+// endian u64s, in row order, followed by a footer with the rows the run covers and where the
+// deltas of each name code start. The footer is bincode, followed by its length as a little
+// endian u64.
+//
+// The rows are read while the database is read, and the run is written and synced after it is
+// let go, so captures are only held up while the rows are read and the run is added.
+//
+// Reading the deltas of a function is then one slice of each run, and the rows after the last
+// run are found through the name index. The runs are extra copies of the deltas, the columns are
+// still where the rows are read from everywhere else.
+
+/// Where the deltas of one name code are in a cluster run
+#[derive(Serialize, Deserialize, Debug, Clone, Copy)]
+struct ClusterEntry {
+    code: u32,
+    /// The number of the first delta of the code in the run
+    offset: usize,
+    count: usize,
+}
+
+#[derive(Serialize, Deserialize, Debug, Clone)]
+struct ClusterFooter {
+    first_row: usize,
+    end_row: usize,
+    /// Sorted by code
+    entries: Vec<ClusterEntry>,
+}
+
+/// The deltas of a range of rows, clustered by name code
+pub struct ClusterRun {
+    footer: ClusterFooter,
+    mmap: Mmap,
+}
+
+impl ClusterRun {
+    fn open(path: &Path) -> Option<Self> {
+        let file = File::open(path).ok()?;
+        let mmap = unsafe { Mmap::map(&file) }.ok()?;
+
+        let end = mmap.len().checked_sub(8)?;
+        let len = u64::from_le_bytes(mmap[end..].try_into().unwrap()) as usize;
+        let footer = bincode::deserialize(&mmap[end.checked_sub(len)?..end]).ok()?;
+
+        Some(ClusterRun { footer, mmap })
+    }
+
+    /// The first row in the run
+    pub fn first_row(&self) -> usize {
+        self.footer.first_row
+    }
+
+    /// One more than the last row in the run
+    pub fn end_row(&self) -> usize {
+        self.footer.end_row
+    }
+
+    /// How many rows of `code` are in the run
+    pub fn count(&self, code: u32) -> usize {
+        self.entry(code).map_or(0, |e| e.count)
+    }
+
+    fn entry(&self, code: u32) -> Option<&ClusterEntry> {
+        let entries = &self.footer.entries;
+        let i = entries.binary_search_by_key(&code, |e| e.code).ok()?;
+        Some(&entries[i])
+    }
+
+    /// Get the deltas of the rows of `code` in the run as little endian u64s, in row order
+    pub fn deltas(&self, code: u32) -> &[u8] {
+        match self.entry(code) {
+            Some(e) => &self.mmap[e.offset * 8..(e.offset + e.count) * 8],
+            None => &[],
+        }
+    }
+}
+
+/// The cluster runs of one shard, in row order
+pub struct Clusters {
+    dir: PathBuf,
+    runs: Vec<ClusterRun>,
+}
+
+impl Clusters {
+    pub fn get_path(dir: &Path, first_row: usize) -> PathBuf {
+        dir.join(format!("cluster_{}.data", first_row))
+    }
+
+    /// Open the cluster runs of the shard in `dir`
+    pub fn open(dir: &Path) -> Self {
+        let mut clusters = Clusters {
+            dir: dir.to_path_buf(),
+            runs: vec![],
+        };
+        clusters.refresh();
+        clusters
+    }
+
+    /// Open the runs that were written after the last one that is open
+    pub fn refresh(&mut self) {
+        let end = self.end();
+
+        let mut first_rows: Vec<usize> = fs::read_dir(&self.dir)
+            .into_iter()
+            .flatten()
+            .filter_map(|entry| {
+                let name = entry.ok()?.file_name();
+                let name = name.to_str()?;
+                name.strip_prefix("cluster_")?
+                    .strip_suffix(".data")?
+                    .parse()
+                    .ok()
+            })
+            .filter(|first_row| *first_row >= end)
+            .collect();
+        first_rows.sort();
+
+        for first_row in first_rows {
+            let path = Clusters::get_path(&self.dir, first_row);
+
+            match ClusterRun::open(&path) {
+                Some(run) if run.first_row() >= self.end() => self.runs.push(run),
+                Some(_) => warn!("Cluster run {:?} overlaps the one before it", path),
+                None => warn!("Could not read cluster run {:?}", path),
+            }
+        }
+    }
+
+    /// One more than the last row in a run, or 0 if there are none
+    pub fn end(&self) -> usize {
+        self.runs.last().map_or(0, |r| r.end_row())
+    }
+
+    pub fn runs(&self) -> &[ClusterRun] {
+        &self.runs
+    }
+
+    /// Write the rows from `first_row` up to `end_row`, with their name codes and deltas, as a
+    /// new run
+    pub fn write(&mut self, first_row: usize, end_row: usize, codes: &[u32], deltas: &[u64]) {
+        let run = Clusters::write_run(&self.dir, first_row, end_row, codes, deltas);
+        self.push(run);
+    }
+
+    /// Write a run to the shard in `dir` without adding it to any `Clusters`, to be added with
+    /// `push` once it is synced
+    pub fn write_run(
+        dir: &Path,
+        first_row: usize,
+        end_row: usize,
+        codes: &[u32],
+        deltas: &[u64],
+    ) -> ClusterRun {
+        let mut by_code: BTreeMap<u32, Vec<u64>> = BTreeMap::new();
+        for (code, delta) in codes.iter().zip(deltas) {
+            by_code.entry(*code).or_default().push(*delta);
+        }
+
+        let mut bytes = Vec::with_capacity(deltas.len() * 8);
+        let mut footer = ClusterFooter {
+            first_row,
+            end_row,
+            entries: vec![],
+        };
+
+        for (code, deltas) in by_code {
+            footer.entries.push(ClusterEntry {
+                code,
+                offset: bytes.len() / 8,
+                count: deltas.len(),
+            });
+
+            for delta in deltas {
+                bytes.extend_from_slice(&delta.to_le_bytes());
+            }
+        }
+
+        let footer_bytes = bincode::serialize(&footer).expect("Should serialize.");
+        bytes.extend_from_slice(&footer_bytes);
+        bytes.extend_from_slice(&(footer_bytes.len() as u64).to_le_bytes());
+
+        let path = Clusters::get_path(dir, first_row);
+        let tmp = path.with_extension("tmp");
+        {
+            let mut file = File::create(&tmp).expect("Should create cluster run.");
+            file.write_all(&bytes).expect("Should write cluster run.");
+            file.sync_all().expect("Should sync cluster run.");
+        }
+        fs::rename(&tmp, &path).expect("Should replace cluster run.");
+        sync_dir(&path);
+
+        info!(
+            "Clustered rows {} to {} of {} functions",
+            first_row,
+            end_row,
+            footer.entries.len()
+        );
+
+        ClusterRun::open(&path).expect("Should open cluster run.")
+    }
+
+    /// Add a run written by `write_run` after the last one
+    pub fn push(&mut self, run: ClusterRun) {
+        if run.first_row() < self.end() {
+            warn!(
+                "Cluster run at row {} overlaps the one before it",
+                run.first_row()
+            );
+            return;
+        }
+
+        self.runs.push(run);
+    }
+
+    /// Delete the runs that only have rows before `first_row`, returning how many were deleted
+    pub fn remove_before(&mut self, first_row: usize) -> usize {
+        let dropped = self.runs.partition_point(|r| r.end_row() <= first_row);
+
+        for run in self.runs.drain(..dropped) {
+            let path = Clusters::get_path(&self.dir, run.first_row());
+
+            if let Err(e) = fs::remove_file(&path) {
+                if e.kind() != ErrorKind::NotFound {
+                    warn!("Could not remove cluster run {:?}: {}", path, e);
+                }
+            }
+        }
+
+        dropped
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use crate::constants::DATA_DIRECTORY;
+
+    #[test]
+    fn write_and_open_test() {
+        let dir = Path::new("./").join(DATA_DIRECTORY).join("cluster-test");
+        let _ = fs::remove_dir_all(&dir);
+        fs::create_dir_all(&dir).unwrap();
+
+        let mut clusters = Clusters::open(&dir);
+        assert_eq!(clusters.end(), 0);
+
+        clusters.write(0, 4, &[2, 1, 2, 2], &[10, 20, 30, 40]);
+        clusters.write(4, 6, &[1, 1], &[50, 60]);
+
+        let run = &clusters.runs()[0];
+        assert_eq!((run.first_row(), run.end_row()), (0, 4));
+        assert_eq!(run.count(2), 3);
+        assert_eq!(run.count(7), 0);
+
+        let deltas: Vec<u64> = run
+            .deltas(2)
+            .chunks_exact(8)
+            .map(|b| u64::from_le_bytes(b.try_into().unwrap()))
+            .collect();
+        assert_eq!(deltas, [10, 30, 40]);
+        assert!(run.deltas(7).is_empty());
+
+        // Another handle finds the same runs
+        let mut other = Clusters::open(&dir);
+        assert_eq!(other.end(), 6);
+        assert_eq!(other.runs()[1].deltas(1), clusters.runs()[1].deltas(1));
+
+        clusters.write(6, 8, &[3, 3], &[1, 2]);
+        other.refresh();
+        assert_eq!(other.end(), 8);
+
+        // Only whole runs before the first row kept are removed
+        assert_eq!(clusters.remove_before(5), 1);
+        assert!(!Clusters::get_path(&dir, 0).exists());
+        assert_eq!(clusters.runs()[0].first_row(), 4);
+        assert_eq!(Clusters::open(&dir).runs().len(), 2);
+
+        let _ = fs::remove_dir_all(&dir);
+    }
+}
@@ -1,11 +1,17 @@
 use super::bufferpool::Bufferpool;
-use super::constants::DATA_DIRECTORY;
+use super::constants::{ENCODED_BLOCK_ROWS, PAGE_SIZE, SEGMENT_SIZE};
+use super::encoding::{decode_block, encode_block, Encoding};
 use super::filewriter::{build_binary_writer, Writer};
+use super::page::decode_value;
 use super::row::FieldType;
-use log::info;
+use super::sealed::{SealedFooter, SealedSegment};
+use log::{info, warn};
+use memmap2::Mmap;
 use serde::{Deserialize, Serialize};
-use std::path::Path;
-use std::sync::{Arc, RwLock};
+use std::fs::{self, File, OpenOptions};
+use std::io::Write;
+use std::path::{Path, PathBuf};
+use std::sync::{Arc, Mutex, RwLock};
 
 /// Used to safe the state of the Column struct
 #[derive(Serialize, Deserialize, Debug)]
@@ -15,6 +21,25 @@ pub struct ColumnMetadata {
     pub current_index: usize,
     pub name: String,
     pub field_type: FieldType,
+    // The size of the pages this column was written with
+    pub extent_size: usize,
+    pub encoding: Encoding,
+    // Where each full block of an encoded column is in its segments
+    pub blocks: Vec<BlockEntry>,
+    // The values of an encoded column that do not fill a block yet, these are kept in their own
+    // file so saving only has to append the new ones
+    #[serde(skip)]
+    pub tail: Vec<u128>,
+}
+
+/// The location of one encoded block in the segments of a column, and the smallest and largest
+/// value in it
+#[derive(Serialize, Deserialize, Debug, Clone, Copy, PartialEq)]
+pub struct BlockEntry {
+    pub offset: u64,
+    pub len: usize,
+    pub min: u128,
+    pub max: u128,
 }
 
 /// Implement column specific traits
@@ -25,44 +50,270 @@ impl ColumnMetadata {
             current_index: 0,
             name,
             field_type,
+            extent_size: PAGE_SIZE,
+            encoding: Encoding::Plain,
+            blocks: vec![],
+            tail: vec![],
         }
     }
 }
 
+// Plain columns keep one fixed size value per slot in pages of the bufferpool.
+//
+// Encoded columns keep their newest values in `tail`, which is saved to `column-{n}.tail`. Once
+// the tail has ENCODED_BLOCK_ROWS values it is encoded into a block and appended to the segments
+// of the column, and the tail file starts over. A row is then found with
+// `index / ENCODED_BLOCK_ROWS` in the block directory, and the last block that was decoded is
+// kept so reading rows one after another decodes it once.
+//
+// The tail file starts with the number of blocks before it as a little endian u64. A reader in
+// another process can load the metadata just before the writer starts a new tail file, and this
+// is how it finds out that the tail it read does not go with that metadata.
+//
+// Each block also has a zone map, the smallest and largest value in it, so a search for values in
+// a range can skip the blocks that can not have any. For values that mostly go up, like `start`,
+// the column keeps the largest value up to each block and the smallest value from each block on.
+// Both of those are sorted, so the first and last block that can match are found with a binary
+// search, and only the blocks between them are checked.
+//
+// Once a segment of the column is full and saved, it is sealed: compacted into a compressed file
+// that is only ever read, see `sealed.rs`. Its footer has the rows in it and their smallest and
+// largest value.
+
 pub struct Column {
     pub metadata: ColumnMetadata,
+    // The directory of the shard the column is in, the same one as its segments
+    dir: PathBuf,
+    bufferpool: Arc<RwLock<Bufferpool>>,
+    // The number and values of the last block that was decoded, shared by the readers
+    decoded: Mutex<Option<(usize, Arc<Vec<u128>>)>>,
+    // How many values of the tail are in the tail file
+    tail_saved: usize,
+    // The tail was sealed into a block since the last save, so the tail file is out of date
+    tail_reset: bool,
+    // The largest value in each block or any block before it
+    max_up_to: Vec<u128>,
+    // The smallest value in each block or any block after it
+    min_from: Vec<u128>,
+    // Where the next value went in the segments when the column was last saved, nothing before
+    // it is written again
+    saved_offset: u64,
+}
+
+/// The full segments of a column that are not sealed yet, taken while the column is read
+///
+/// Nothing writes to them again, so `run` compresses them without holding the database or the
+/// bufferpool, and only reads the bufferpool for a moment to put each sealed segment in place.
+/// The next sealing of the column can start once this is dropped.
+pub struct SealJob {
     bufferpool: Arc<RwLock<Bufferpool>>,
+    dir: PathBuf,
+    column_index: usize,
+    end: usize,
+    // Every segment before this one is sealed, once `run` is done
+    sealed_to: usize,
+    // For a plain column the size of a value, to find the smallest and largest in the bytes
+    plain_size: Option<usize>,
+    segments: Vec<(usize, Option<Arc<Mmap>>, SealedFooter)>,
+}
+
+impl SealJob {
+    /// Seal the segments, returning how many were sealed
+    pub fn run(mut self) -> usize {
+        let mut sealed = 0;
+
+        for (segment, map, mut footer) in std::mem::take(&mut self.segments) {
+            let bytes: &[u8] = map.as_deref().map_or(&[], |m| &m[..]);
+
+            if let Some(size) = self.plain_size {
+                (footer.min, footer.max) = value_range(bytes, size);
+            }
+
+            let path = SealedSegment::get_path(&self.dir, self.column_index, segment);
+            SealedSegment::write(&path, bytes, footer);
+            drop(map);
+
+            let bp = self.bufferpool.read().expect("Should read.");
+            if bp.install_sealed(self.column_index, segment) {
+                sealed += 1;
+            }
+        }
+
+        self.sealed_to = self.end;
+        sealed
+    }
+}
+
+impl Drop for SealJob {
+    fn drop(&mut self) {
+        let bp = self.bufferpool.read().expect("Should read.");
+        bp.end_seal(self.column_index, self.sealed_to);
+    }
+}
+
+/// The smallest and largest of the values of `size` bytes in `bytes`
+fn value_range(bytes: &[u8], size: usize) -> (u128, u128) {
+    let values = bytes
+        .chunks_exact(size)
+        .filter_map(|b| decode_value(b, size))
+        .map(|v| to_value(&v));
+    let (min, max) = values.fold((u128::MAX, 0), |(lo, hi), v| (lo.min(v), hi.max(v)));
+
+    (min.min(max), max)
 }
 
 /// Implement common traits from Metadata
 /// TODO: How do I use ./metadata.rs as a trait and then have the return time for `load` be the
 /// correct type? Right now, I will just have load and save be their own functions
 impl Column {
-    pub fn metadata_exists(column_index: usize) -> bool {
-        let filepath = format!("{}/column-{}.data", DATA_DIRECTORY, column_index);
+    pub fn get_metadata_path(dir: &Path, column_index: usize) -> PathBuf {
+        dir.join(format!("column-{}.data", column_index))
+    }
+
+    pub fn metadata_exists(dir: &Path, column_index: usize) -> bool {
+        Column::get_metadata_path(dir, column_index).exists()
+    }
 
-        Path::new(&filepath).exists()
+    pub fn get_tail_path(dir: &Path, column_index: usize) -> PathBuf {
+        dir.join(format!("column-{}.tail", column_index))
     }
 
-    pub fn save(&self) {
+    pub fn save(&mut self) {
+        // The tail goes first so the metadata never counts values that are not on disk
+        if self.metadata.encoding != Encoding::Plain {
+            self.save_tail();
+        }
+
         let writer: Writer<ColumnMetadata> = build_binary_writer();
-        let filepath = format!(
-            "{}/column-{}.data",
-            DATA_DIRECTORY, self.metadata.column_index
-        );
+        let filepath = Column::get_metadata_path(&self.dir, self.metadata.column_index);
         info!(
-            "Saving Column {} to {}",
+            "Saving Column {} to {:?}",
             self.metadata.column_index, filepath
         );
-        writer.write_file(filepath.as_str(), &self.metadata);
+        writer.write_file(&filepath.to_string_lossy(), &self.metadata);
+
+        self.saved_offset = self.write_offset();
     }
 
-    pub fn load(column_index: usize) -> ColumnMetadata {
+    fn save_tail(&mut self) {
+        let path = Column::get_tail_path(&self.dir, self.metadata.column_index);
+
+        let mut bytes = vec![];
+
+        let (mut file, new_values) = if self.tail_reset {
+            let file = File::create(&path).expect("Should create tail file.");
+            bytes.extend_from_slice(&(self.metadata.blocks.len() as u64).to_le_bytes());
+            (file, &self.metadata.tail[..])
+        } else {
+            let file = OpenOptions::new()
+                .create(true)
+                .append(true)
+                .open(&path)
+                .expect("Should open tail file.");
+            (file, &self.metadata.tail[self.tail_saved..])
+        };
+
+        bytes.reserve(new_values.len() * 16);
+        for v in new_values {
+            bytes.extend_from_slice(&v.to_le_bytes());
+        }
+        file.write_all(&bytes).expect("Should write tail file.");
+        file.sync_data().expect("Should sync tail file.");
+
+        self.tail_saved = self.metadata.tail.len();
+        self.tail_reset = false;
+    }
+
+    /// Read the tail of an encoded column back from its file
+    fn load_tail(dir: &Path, metadata: &mut ColumnMetadata) {
+        let expected = metadata.current_index - metadata.blocks.len() * ENCODED_BLOCK_ROWS;
+        let bytes = fs::read(Column::get_tail_path(dir, metadata.column_index)).unwrap_or_default();
+
+        let blocks = bytes
+            .get(..8)
+            .map(|b| u64::from_le_bytes(b.try_into().unwrap()) as usize);
+
+        // A tail that starts after some other block is not the tail of this metadata
+        let values = match blocks {
+            Some(b) if b == metadata.blocks.len() => &bytes[8..],
+            _ => &[],
+        };
+
+        metadata.tail = values
+            .chunks_exact(16)
+            .take(expected)
+            .map(|c| u128::from_le_bytes(c.try_into().unwrap()))
+            .collect();
+
+        if metadata.tail.len() != expected {
+            warn!(
+                "Column {} tail has {} values, expected {}",
+                metadata.column_index,
+                metadata.tail.len(),
+                expected
+            );
+            metadata.current_index =
+                metadata.blocks.len() * ENCODED_BLOCK_ROWS + metadata.tail.len();
+        }
+    }
+
+    pub fn load(dir: &Path, column_index: usize) -> ColumnMetadata {
         let writer: Writer<ColumnMetadata> = build_binary_writer();
-        let filepath = format!("{}/column-{}.data", DATA_DIRECTORY, column_index);
+        let filepath = Column::get_metadata_path(dir, column_index);
 
-        info!("Loading Column {} to {}", column_index, filepath);
-        writer.read_file(filepath.as_str())
+        info!("Loading Column {} to {:?}", column_index, filepath);
+        writer.read_file(&filepath.to_string_lossy())
+    }
+
+    /// Read the metadata and tail of the column again, after another process wrote to it
+    ///
+    /// Returns false, keeping what it had, if the saved column could not be read or its tail was
+    /// from a newer save. Blocks are never changed once written, so only the zone maps of the
+    /// new blocks are added.
+    pub fn reload(&mut self) -> bool {
+        let filepath = Column::get_metadata_path(&self.dir, self.metadata.column_index);
+
+        let mut metadata: ColumnMetadata = match fs::read(&filepath)
+            .ok()
+            .and_then(|bytes| bincode::deserialize(&bytes).ok())
+        {
+            Some(m) => m,
+            None => return false,
+        };
+
+        if metadata.encoding != Encoding::Plain {
+            let current_index = metadata.current_index;
+            Column::load_tail(&self.dir, &mut metadata);
+
+            if metadata.current_index != current_index {
+                return false;
+            }
+        }
+
+        if metadata.blocks.len() < self.metadata.blocks.len() {
+            warn!(
+                "Column {} has fewer blocks than before, it was written again",
+                self.metadata.column_index
+            );
+            return false;
+        }
+
+        let known = self.metadata.blocks.len();
+        for block in &metadata.blocks[known..] {
+            self.push_zone(block.min, block.max);
+        }
+
+        self.metadata = metadata;
+        true
+    }
+}
+
+/// Get a value of a column as a u128, the way encoded columns store it
+fn to_value(value: &FieldType) -> u128 {
+    match value {
+        FieldType::Epoch(e) => *e,
+        FieldType::Code(c) => *c as u128,
+        FieldType::Name(_) => unreachable!("Names are stored in the name dictionary"),
     }
 }
 
@@ -70,63 +321,520 @@ impl Column {
     pub fn insert(&mut self, value: &FieldType) {
         let i = self.metadata.current_index;
 
-        let mut bp = self.bufferpool.write().expect("Could write.");
-        // Index is auto-incremented
-        bp.insert(i, self.metadata.column_index, value);
+        if self.metadata.encoding == Encoding::Plain {
+            let mut bp = self.bufferpool.write().expect("Could write.");
+            // Index is auto-incremented
+            bp.insert(i, self.metadata.column_index, value);
+        } else {
+            self.metadata.tail.push(to_value(value));
+
+            if self.metadata.tail.len() == ENCODED_BLOCK_ROWS {
+                self.seal_block();
+            }
+        }
 
         self.metadata.current_index += 1;
     }
 
-    pub fn fetch(&mut self, index: usize) -> Option<FieldType> {
+    /// Encode the tail into a block and write it after the last block
+    fn seal_block(&mut self) {
+        let bytes = encode_block(self.metadata.encoding, &self.metadata.tail);
+
+        let mut offset = self
+            .metadata
+            .blocks
+            .last()
+            .map(|b| b.offset + b.len as u64)
+            .unwrap_or(0);
+
+        // A block is never split between two segment files
+        let segment_size = SEGMENT_SIZE as u64;
+        if offset % segment_size + bytes.len() as u64 > segment_size {
+            offset = (offset / segment_size + 1) * segment_size;
+        }
+
+        {
+            let mut bp = self.bufferpool.write().expect("Should write.");
+            bp.write_bytes(self.metadata.column_index, offset, &bytes);
+        }
+
+        info!(
+            "Sealed block {} of column {} in {} bytes",
+            self.metadata.blocks.len(),
+            self.metadata.column_index,
+            bytes.len()
+        );
+
+        let min = self.metadata.tail.iter().copied().min().unwrap_or(0);
+        let max = self.metadata.tail.iter().copied().max().unwrap_or(0);
+
+        self.metadata.blocks.push(BlockEntry {
+            offset,
+            len: bytes.len(),
+            min,
+            max,
+        });
+        self.push_zone(min, max);
+        self.metadata.tail.clear();
+        self.tail_saved = 0;
+        self.tail_reset = true;
+    }
+
+    /// Add the zone map of a new last block
+    fn push_zone(&mut self, min: u128, max: u128) {
+        let max = self.max_up_to.last().map_or(max, |m| max.max(*m));
+        self.max_up_to.push(max);
+
+        // Only the blocks before it with a bigger smallest value change, which for values that
+        // mostly go up is none or a few
+        for m in self.min_from.iter_mut().rev() {
+            if *m <= min {
+                break;
+            }
+            *m = min;
+        }
+        self.min_from.push(min);
+    }
+
+    /// Get the runs of rows, as `(start, end)`, that can have a value from `low` up to `high`
+    ///
+    /// Only the zone maps are read, so the rows still have to be checked. A plain column has no
+    /// zone maps, so this is every row.
+    pub fn zone_ranges(&self, low: u128, high: u128) -> Vec<(usize, usize)> {
+        if self.metadata.encoding == Encoding::Plain {
+            return vec![(0, self.metadata.current_index)];
+        }
+
+        let mut ranges: Vec<(usize, usize)> = vec![];
+        let mut add = |start: usize, end: usize| match ranges.last_mut() {
+            Some(last) if last.1 == start => last.1 = end,
+            _ => ranges.push((start, end)),
+        };
+
+        if low < high {
+            // Every block before `first` only has values below `low`, and every block from
+            // `last` on only has values from `high` up
+            let first = self.max_up_to.partition_point(|m| *m < low);
+            let last = self.min_from.partition_point(|m| *m < high);
+
+            for block in first..last.max(first) {
+                let entry = &self.metadata.blocks[block];
+
+                if entry.max >= low && entry.min < high {
+                    let start = block * ENCODED_BLOCK_ROWS;
+                    add(start, start + ENCODED_BLOCK_ROWS);
+                }
+            }
+
+            let sealed = self.metadata.blocks.len() * ENCODED_BLOCK_ROWS;
+            if self.metadata.tail.iter().any(|v| *v >= low && *v < high) {
+                add(sealed, self.metadata.current_index);
+            }
+        }
+
+        ranges
+    }
+
+    /// How many rows at the start of the column are in sealed blocks that only have values
+    /// below `value`, with every block before them the same
+    ///
+    /// A plain column has no zone maps, so this is always 0 for it.
+    pub fn rows_before(&self, value: u128) -> usize {
+        if self.metadata.encoding == Encoding::Plain {
+            return 0;
+        }
+
+        self.max_up_to.partition_point(|m| *m < value) * ENCODED_BLOCK_ROWS
+    }
+
+    /// Delete the segment files that only have rows before `index`, returning how many were
+    /// deleted
+    ///
+    /// The rows before `index` can not be read after this.
+    pub fn remove_before(&mut self, index: usize) -> usize {
+        let mut bp = self.bufferpool.write().expect("Should write.");
+
+        // The byte of the column that row `index` is stored at
+        let offset = if self.metadata.encoding == Encoding::Plain {
+            let values_per_page =
+                bp.extent_size(self.metadata.column_index) / self.metadata.field_type.get_size();
+            ((index / values_per_page) * bp.extent_size(self.metadata.column_index)) as u64
+        } else {
+            match self.metadata.blocks.get(index / ENCODED_BLOCK_ROWS) {
+                Some(block) => block.offset,
+                None => self
+                    .metadata
+                    .blocks
+                    .last()
+                    .map_or(0, |b| b.offset + b.len as u64),
+            }
+        };
+
+        *self.decoded.lock().unwrap() = None;
+        bp.remove_segments_before(self.metadata.column_index, offset)
+    }
+
+    /// The byte of the segments the next value will be written at or after
+    fn write_offset(&self) -> u64 {
+        if self.metadata.encoding == Encoding::Plain {
+            let extent_size = self.metadata.extent_size;
+            let values_per_page = extent_size / self.metadata.field_type.get_size();
+
+            // The page the next value goes in might already have some values
+            return ((self.metadata.current_index / values_per_page) * extent_size) as u64;
+        }
+
+        self.metadata
+            .blocks
+            .last()
+            .map_or(0, |b| b.offset + b.len as u64)
+    }
+
+    /// How many segments at the start of the column are full and saved, so they are never
+    /// written again
+    pub fn full_segments(&self) -> usize {
+        (self.saved_offset / SEGMENT_SIZE as u64) as usize
+    }
+
+    /// Check if there is a full segment that is not sealed yet
+    pub fn needs_compaction(&self) -> bool {
+        let bp = self.bufferpool.read().expect("Should read.");
+        self.full_segments() > bp.next_seal(self.metadata.column_index)
+    }
+
+    /// Seal the full segments that are not sealed yet, returning how many were sealed
+    ///
+    /// The segments are only read, so this can run while the column is read.
+    pub fn compact(&self) -> usize {
+        self.seal_job().map_or(0, SealJob::run)
+    }
+
+    /// Take the full segments that are not sealed yet, to be sealed with `SealJob::run`
+    ///
+    /// Returns None if there are none or they are already being sealed.
+    pub fn seal_job(&self) -> Option<SealJob> {
+        if !self.needs_compaction() {
+            return None;
+        }
+
+        // The last page of a segment that just filled up might not be written yet
+        self.bufferpool.write().expect("Should write.").flush();
+
+        let column_index = self.metadata.column_index;
+        let end = self.full_segments();
+        let maps = self
+            .bufferpool
+            .read()
+            .expect("Should read.")
+            .begin_seal(column_index, end)?;
+
+        let plain_size = (self.metadata.encoding == Encoding::Plain)
+            .then(|| self.metadata.field_type.get_size());
+
+        Some(SealJob {
+            bufferpool: self.bufferpool.clone(),
+            dir: self.dir.clone(),
+            column_index,
+            end,
+            sealed_to: 0,
+            plain_size,
+            segments: maps
+                .into_iter()
+                .map(|(segment, map)| (segment, map, self.segment_footer(segment)))
+                .collect(),
+        })
+    }
+
+    /// Work out which rows are in a full segment, and for an encoded column their smallest and
+    /// largest value
+    ///
+    /// A plain column has no zone maps, so its smallest and largest value are found in the bytes
+    /// of the segment when it is sealed.
+    fn segment_footer(&self, segment: usize) -> SealedFooter {
+        let segment_start = (segment * SEGMENT_SIZE) as u64;
+        let segment_end = segment_start + SEGMENT_SIZE as u64;
+
+        if self.metadata.encoding == Encoding::Plain {
+            let rows = SEGMENT_SIZE / self.metadata.field_type.get_size();
+            return SealedFooter::new(segment * rows, rows, 0, 0);
+        }
+
+        // Blocks are never split between segments, so the ones in it are the ones that start in it
+        let blocks = &self.metadata.blocks;
+        let first = blocks.partition_point(|b| b.offset < segment_start);
+        let last = blocks.partition_point(|b| b.offset < segment_end);
+
+        let in_segment = &blocks[first..last];
+        let min = in_segment.iter().map(|b| b.min).min().unwrap_or(0);
+        let max = in_segment.iter().map(|b| b.max).max().unwrap_or(0);
+
+        SealedFooter::new(
+            first * ENCODED_BLOCK_ROWS,
+            (last - first) * ENCODED_BLOCK_ROWS,
+            min,
+            max,
+        )
+    }
+
+    /// Decode block number `block` of an encoded column into `out`
+    fn read_block(&self, block: usize, out: &mut Vec<u128>) {
+        let entry = self.metadata.blocks[block];
+
+        let bp = self.bufferpool.read().expect("Should read.");
+        bp.with_bytes(
+            self.metadata.column_index,
+            entry.offset,
+            entry.len,
+            |bytes| decode_block(bytes, out),
+        );
+    }
+
+    /// Turn a value of an encoded column back into the field type of the column
+    fn to_field(&self, value: u128) -> FieldType {
+        match self.metadata.field_type {
+            FieldType::Code(_) => FieldType::Code(value as u32),
+            _ => FieldType::Epoch(value),
+        }
+    }
+
+    fn fetch_encoded(&self, index: usize) -> Option<FieldType> {
+        if index >= self.metadata.current_index {
+            return None;
+        }
+
+        let block = index / ENCODED_BLOCK_ROWS;
+        let in_block = index % ENCODED_BLOCK_ROWS;
+
+        if block >= self.metadata.blocks.len() {
+            let value = self.metadata.tail[index - block * ENCODED_BLOCK_ROWS];
+            return Some(self.to_field(value));
+        }
+
+        let cached = match &*self.decoded.lock().unwrap() {
+            Some((b, values)) if *b == block => Some(values.clone()),
+            _ => None,
+        };
+
+        // The block is decoded without holding the cache, so other readers are not held up
+        let values = match cached {
+            Some(values) => values,
+            None => {
+                let mut values = vec![];
+                self.read_block(block, &mut values);
+
+                let values = Arc::new(values);
+                *self.decoded.lock().unwrap() = Some((block, values.clone()));
+                values
+            }
+        };
+
+        // A block whose segment was removed decodes to nothing
+        values.get(in_block).map(|v| self.to_field(*v))
+    }
+
+    /// Get the value of row `index`
+    ///
+    /// This only takes the bufferpool for reading, so many readers can fetch at once.
+    pub fn fetch(&self, index: usize) -> Option<FieldType> {
         info!("Fetching {}", index);
+
+        if self.metadata.encoding != Encoding::Plain {
+            return self.fetch_encoded(index);
+        }
+
         let field_type_size = self.metadata.field_type.get_size();
 
-        let bufferpool = self.bufferpool.write();
+        let bufferpool = self.bufferpool.read();
 
         match bufferpool {
-            Ok(mut bp) => return bp.fetch(index, self.metadata.column_index, field_type_size),
+            Ok(bp) => bp.fetch_shared(index, self.metadata.column_index, field_type_size),
             Err(e) => {
                 info!("{}", e);
-                return None;
+                None
             }
         }
     }
 
+    /// Call `f` with the row index and value of every row from `start` up to `end`
+    ///
+    /// Each page is read once, straight from memory or from the memory-mapped segment, instead
+    /// of looking up every value on its own.
+    pub fn scan(&self, start: usize, end: usize, mut f: impl FnMut(usize, FieldType)) {
+        if self.metadata.encoding != Encoding::Plain {
+            return self.scan_encoded(start, end, f);
+        }
+
+        let field_type_size = self.metadata.field_type.get_size();
+        let column_index = self.metadata.column_index;
+
+        let bp = self.bufferpool.read().expect("Should read.");
+        let values_per_page = bp.extent_size(column_index) / field_type_size;
+
+        let mut index = start;
+        while index < end {
+            let pid = index / values_per_page;
+            let page_end = end.min((pid + 1) * values_per_page);
+
+            bp.with_page_bytes(column_index, pid, |bytes| {
+                for i in index..page_end {
+                    let offset = (i % values_per_page) * field_type_size;
+
+                    if let Some(value) = decode_value(&bytes[offset..], field_type_size) {
+                        f(i, value);
+                    }
+                }
+            });
+
+            index = page_end;
+        }
+    }
+
+    /// Decode each block once and call `f` with its values, then go through the tail
+    fn scan_encoded(&self, start: usize, end: usize, mut f: impl FnMut(usize, FieldType)) {
+        let end = end.min(self.metadata.current_index);
+        let sealed = self.metadata.blocks.len() * ENCODED_BLOCK_ROWS;
+
+        let mut values = vec![];
+        let mut index = start;
+
+        while index < end.min(sealed) {
+            let block = index / ENCODED_BLOCK_ROWS;
+            let first = block * ENCODED_BLOCK_ROWS;
+            let block_end = end.min(first + ENCODED_BLOCK_ROWS);
+
+            self.read_block(block, &mut values);
+
+            for (i, v) in (index..block_end).zip(values.iter().skip(index - first)) {
+                f(i, self.to_field(*v));
+            }
+
+            index = block_end;
+        }
+
+        while index < end {
+            f(index, self.to_field(self.metadata.tail[index - sealed]));
+            index += 1;
+        }
+    }
+
     pub fn new(
         name: String,
         column_index: usize,
         bufferpool: Arc<RwLock<Bufferpool>>,
         field_type: FieldType,
     ) -> Self {
-        {
-            // let mut bp = bufferpool.write().expect("Should write.");
-            // bp.create_column(column_index);
-        }
+        Column::with_extent_size(name, column_index, bufferpool, field_type, PAGE_SIZE)
+    }
+
+    /// Make a column that stores its values in pages of `extent_size` bytes
+    ///
+    /// A column that already exists on disk keeps the extent size it was written with.
+    pub fn with_extent_size(
+        name: String,
+        column_index: usize,
+        bufferpool: Arc<RwLock<Bufferpool>>,
+        field_type: FieldType,
+        extent_size: usize,
+    ) -> Self {
+        Column::with_encoding(
+            name,
+            column_index,
+            bufferpool,
+            field_type,
+            extent_size,
+            Encoding::Plain,
+        )
+    }
+
+    /// Make a column that stores its values with `encoding`
+    ///
+    /// A column that already exists on disk keeps the extent size and encoding it was written
+    /// with.
+    pub fn with_encoding(
+        name: String,
+        column_index: usize,
+        bufferpool: Arc<RwLock<Bufferpool>>,
+        field_type: FieldType,
+        extent_size: usize,
+        encoding: Encoding,
+    ) -> Self {
+        let dir = bufferpool.read().expect("Should read.").dir().to_path_buf();
 
         // Use existing metadata if it's around
-        if Column::metadata_exists(column_index) {
-            return Column {
-                metadata: Column::load(column_index),
-                bufferpool,
-            };
+        let metadata = if Column::metadata_exists(&dir, column_index) {
+            let mut m = Column::load(&dir, column_index);
+            if m.encoding != Encoding::Plain {
+                Column::load_tail(&dir, &mut m);
+            }
+            m
+        } else {
+            let mut m = ColumnMetadata::new(name, column_index, field_type);
+            m.extent_size = extent_size;
+            m.encoding = encoding;
+            m
+        };
+
+        if metadata.extent_size != extent_size {
+            warn!(
+                "Column {} was written with extent size {}, ignoring {}",
+                column_index, metadata.extent_size, extent_size
+            );
+        }
+
+        if metadata.encoding != encoding {
+            warn!(
+                "Column {} was written with {:?}, ignoring {:?}",
+                column_index, metadata.encoding, encoding
+            );
         }
 
-        Column {
-            metadata: ColumnMetadata::new(name, column_index, field_type),
+        {
+            let mut bp = bufferpool.write().expect("Should write.");
+            bp.create_column(column_index, metadata.extent_size);
+        }
+
+        let tail_saved = metadata.tail.len();
+        let blocks = metadata.blocks.clone();
+
+        let mut column = Column {
+            metadata,
+            dir,
             bufferpool,
+            decoded: Mutex::new(None),
+            tail_saved,
+            // A new column might have a tail file left over from an old one
+            tail_reset: true,
+            max_up_to: vec![],
+            min_from: vec![],
+            saved_offset: 0,
+        };
+
+        for block in blocks {
+            column.push_zone(block.min, block.max);
         }
+
+        column.saved_offset = column.write_offset();
+        column
     }
 }
 
 #[cfg(test)]
 mod tests {
     use super::*;
-    use crate::row::create_function_name;
+    use crate::constants::DATA_DIRECTORY;
+    use crate::sealed::SealedSegment;
+    use crate::segment::ColumnSegments;
     use std::fs;
 
+    fn data_dir() -> PathBuf {
+        Path::new("./").join(DATA_DIRECTORY)
+    }
+
     fn cleanup_test_file(column_index: usize) {
-        let filepath = format!("{}/column-{}.data", DATA_DIRECTORY, column_index);
-        let _ = fs::remove_file(filepath);
+        let dir = data_dir();
+        let _ = fs::remove_file(Column::get_metadata_path(&dir, column_index));
+        let _ = fs::remove_file(ColumnSegments::get_segment_path(column_index, 0));
+        let _ = fs::remove_file(Column::get_tail_path(&dir, column_index));
     }
 
     #[test]
@@ -142,7 +850,7 @@ mod tests {
 
     #[test]
     fn column_metadata_with_name_field() {
-        let field_type = FieldType::Name(create_function_name("function"));
+        let field_type = FieldType::Code(0);
         let metadata = ColumnMetadata::new("name_column".to_string(), 1, field_type.clone());
 
         assert_eq!(metadata.column_index, 1);
@@ -229,12 +937,12 @@ mod tests {
     }
 
     #[test]
-    fn column_insert_name_field() {
+    fn column_insert_code_field() {
         let column_index = 1002;
         cleanup_test_file(column_index);
 
         let bufferpool = Arc::new(RwLock::new(Bufferpool::new(column_index + 1)));
-        let field_type = FieldType::Name(create_function_name("default"));
+        let field_type = FieldType::Code(0);
         let mut column = Column::new(
             "names".to_string(),
             column_index,
@@ -242,8 +950,8 @@ mod tests {
             field_type.clone(),
         );
 
-        let name1 = FieldType::Name(create_function_name("function_a"));
-        let name2 = FieldType::Name(create_function_name("function_b"));
+        let name1 = FieldType::Code(1);
+        let name2 = FieldType::Code(2);
 
         column.insert(&name1);
         column.insert(&name2);
@@ -306,10 +1014,10 @@ mod tests {
         column.save();
 
         // Verify metadata file exists
-        assert!(Column::metadata_exists(column_index));
+        assert!(Column::metadata_exists(&data_dir(), column_index));
 
         // Load the metadata
-        let loaded_metadata = Column::load(column_index);
+        let loaded_metadata = Column::load(&data_dir(), column_index);
 
         assert_eq!(loaded_metadata.column_index, column_index);
         assert_eq!(loaded_metadata.current_index, 3);
@@ -351,12 +1059,52 @@ mod tests {
         cleanup_test_file(column_index);
     }
 
+    #[test]
+    fn column_keeps_extent_size_it_was_written_with() {
+        let column_index = 1007;
+        cleanup_test_file(column_index);
+
+        let extent_size = 64 * 1024;
+        let bufferpool = Arc::new(RwLock::new(Bufferpool::new(column_index + 1)));
+        let mut column1 = Column::with_extent_size(
+            "extent".to_string(),
+            column_index,
+            Arc::clone(&bufferpool),
+            FieldType::Epoch(0),
+            extent_size,
+        );
+        column1.insert(&FieldType::Epoch(5));
+        column1.save();
+
+        assert_eq!(
+            bufferpool.read().unwrap().extent_size(column_index),
+            extent_size
+        );
+
+        // Opening it again with the default size still uses the stored extent size
+        let bufferpool2 = Arc::new(RwLock::new(Bufferpool::new(column_index + 1)));
+        let column2 = Column::new(
+            "extent".to_string(),
+            column_index,
+            Arc::clone(&bufferpool2),
+            FieldType::Epoch(0),
+        );
+
+        assert_eq!(column2.metadata.extent_size, extent_size);
+        assert_eq!(
+            bufferpool2.read().unwrap().extent_size(column_index),
+            extent_size
+        );
+
+        cleanup_test_file(column_index);
+    }
+
     #[test]
     fn column_metadata_exists_false_for_new_column() {
         let column_index = 9999;
         cleanup_test_file(column_index);
 
-        assert!(!Column::metadata_exists(column_index));
+        assert!(!Column::metadata_exists(&data_dir(), column_index));
     }
 
     #[test]
@@ -388,6 +1136,292 @@ mod tests {
         cleanup_test_file(column_index);
     }
 
+    #[test]
+    fn column_scan() {
+        let column_index = 1008;
+        cleanup_test_file(column_index);
+
+        let bufferpool = Arc::new(RwLock::new(Bufferpool::new(column_index + 1)));
+        let mut column = Column::new(
+            "scanned".to_string(),
+            column_index,
+            Arc::clone(&bufferpool),
+            FieldType::Epoch(0),
+        );
+
+        // Go over more than one page
+        let count = 3 * PAGE_SIZE / 16 + 10;
+        for i in 0..count {
+            column.insert(&FieldType::Epoch(i as u128));
+        }
+
+        // Push the first pages out so they are read from the segment
+        bufferpool.write().unwrap().set_page_limit(1);
+
+        let mut seen = vec![];
+        column.scan(5, count, |i, value| {
+            assert_eq!(value, FieldType::Epoch(i as u128));
+            seen.push(i);
+        });
+
+        assert_eq!(seen, (5..count).collect::<Vec<usize>>());
+
+        cleanup_test_file(column_index);
+    }
+
+    #[test]
+    fn encoded_column() {
+        let column_index = 1009;
+        cleanup_test_file(column_index);
+
+        let value = |i: usize| 1_000_000_000 + (i as u128) * 1500 + (i as u128 % 3);
+        let count = 2 * ENCODED_BLOCK_ROWS + ENCODED_BLOCK_ROWS / 2;
+
+        {
+            let bufferpool = Arc::new(RwLock::new(Bufferpool::new(column_index + 1)));
+            let mut column = Column::with_encoding(
+                "encoded".to_string(),
+                column_index,
+                bufferpool,
+                FieldType::Epoch(0),
+                PAGE_SIZE,
+                Encoding::DeltaOfDelta,
+            );
+
+            for i in 0..count {
+                column.insert(&FieldType::Epoch(value(i)));
+            }
+
+            // Two full blocks, and the rest waiting in the tail
+            assert_eq!(column.metadata.blocks.len(), 2);
+            assert_eq!(column.metadata.tail.len(), ENCODED_BLOCK_ROWS / 2);
+
+            // Both blocks together are much smaller than 16 bytes a value
+            let stored: usize = column.metadata.blocks.iter().map(|b| b.len).sum();
+            assert!(stored < 2 * ENCODED_BLOCK_ROWS);
+
+            column.save();
+        }
+
+        // Open it again to read the blocks from disk and the tail from the metadata
+        let bufferpool = Arc::new(RwLock::new(Bufferpool::new(column_index + 1)));
+        let column = Column::with_encoding(
+            "encoded".to_string(),
+            column_index,
+            bufferpool,
+            FieldType::Epoch(0),
+            PAGE_SIZE,
+            Encoding::DeltaOfDelta,
+        );
+
+        assert_eq!(column.metadata.current_index, count);
+
+        for i in [
+            0,
+            1,
+            ENCODED_BLOCK_ROWS,
+            2 * ENCODED_BLOCK_ROWS + 3,
+            count - 1,
+        ] {
+            assert_eq!(column.fetch(i), Some(FieldType::Epoch(value(i))));
+        }
+        assert_eq!(column.fetch(count), None);
+
+        let mut seen = 0;
+        column.scan(10, count + 5, |i, v| {
+            assert_eq!(v, FieldType::Epoch(value(i)));
+            seen += 1;
+        });
+        assert_eq!(seen, count - 10);
+
+        cleanup_test_file(column_index);
+    }
+
+    #[test]
+    fn zone_ranges() {
+        let column_index = 1010;
+        cleanup_test_file(column_index);
+
+        let bufferpool = Arc::new(RwLock::new(Bufferpool::new(column_index + 1)));
+        let mut column = Column::with_encoding(
+            "zones".to_string(),
+            column_index,
+            bufferpool,
+            FieldType::Epoch(0),
+            PAGE_SIZE,
+            Encoding::DeltaOfDelta,
+        );
+
+        // Mostly going up by 10, but the first value of block 2 is from before block 1
+        let value = |i: usize| {
+            if i == 2 * ENCODED_BLOCK_ROWS {
+                5
+            } else {
+                i as u128 * 10
+            }
+        };
+
+        let count = 4 * ENCODED_BLOCK_ROWS + 100;
+        for i in 0..count {
+            column.insert(&FieldType::Epoch(value(i)));
+        }
+
+        let rows = ENCODED_BLOCK_ROWS;
+        let time = |row: usize| row as u128 * 10;
+
+        // Only the block that has the range
+        assert_eq!(
+            column.zone_ranges(time(3 * rows + 5), time(3 * rows + 10)),
+            vec![(3 * rows, 4 * rows)]
+        );
+
+        // Block 2 has a value from the start of block 0, so it is checked too
+        assert_eq!(
+            column.zone_ranges(0, 20),
+            vec![(0, rows), (2 * rows, 3 * rows)]
+        );
+
+        // Blocks next to each other are joined, and the tail is checked in memory
+        assert_eq!(
+            column.zone_ranges(time(3 * rows), time(count)),
+            vec![(3 * rows, count)]
+        );
+
+        assert!(column.zone_ranges(time(count), u128::MAX).is_empty());
+        assert!(column.zone_ranges(50, 50).is_empty());
+
+        // The zone maps are loaded back with the blocks
+        column.save();
+        let zones = column.zone_ranges(0, 20);
+
+        let bufferpool = Arc::new(RwLock::new(Bufferpool::new(column_index + 1)));
+        let column = Column::with_encoding(
+            "zones".to_string(),
+            column_index,
+            bufferpool,
+            FieldType::Epoch(0),
+            PAGE_SIZE,
+            Encoding::DeltaOfDelta,
+        );
+        assert_eq!(column.zone_ranges(0, 20), zones);
+
+        cleanup_test_file(column_index);
+    }
+
+    #[test]
+    fn reload_from_other_process() {
+        let column_index = 1011;
+        cleanup_test_file(column_index);
+
+        let open = |bufferpool: Bufferpool| {
+            Column::with_encoding(
+                "reload".to_string(),
+                column_index,
+                Arc::new(RwLock::new(bufferpool)),
+                FieldType::Epoch(0),
+                PAGE_SIZE,
+                Encoding::FrameOfReference,
+            )
+        };
+
+        let mut writer = open(Bufferpool::new(column_index + 1));
+        for i in 0..10 {
+            writer.insert(&FieldType::Epoch(i));
+        }
+        writer.save();
+
+        let mut reader = open(Bufferpool::open(&data_dir(), column_index + 1, true));
+        assert_eq!(reader.metadata.current_index, 10);
+
+        // A whole block is sealed and the new tail is saved, but the metadata is not yet
+        let count = ENCODED_BLOCK_ROWS as u128 + 5;
+        for i in 10..count {
+            writer.insert(&FieldType::Epoch(i));
+        }
+        writer.save_tail();
+
+        assert!(!reader.reload());
+        assert_eq!(reader.metadata.current_index, 10);
+        assert_eq!(reader.fetch(9), Some(FieldType::Epoch(9)));
+
+        writer.save();
+        assert!(reader.reload());
+        assert_eq!(reader.metadata.current_index, count as usize);
+        assert_eq!(reader.zone_ranges(0, 1).len(), 1);
+
+        let mut values = vec![];
+        reader.scan(0, count as usize, |_, v| values.push(v));
+        assert_eq!(values, (0..count).map(FieldType::Epoch).collect::<Vec<_>>());
+
+        cleanup_test_file(column_index);
+    }
+
+    #[test]
+    fn compact_seals_full_segments_test() {
+        let column_index = 1020;
+        let dir = data_dir();
+        cleanup_test_file(column_index);
+        let _ = fs::remove_file(ColumnSegments::get_segment_path(column_index, 1));
+
+        let bufferpool = Arc::new(RwLock::new(Bufferpool::new(column_index + 1)));
+        let mut column = Column::new(
+            "sealed".to_string(),
+            column_index,
+            bufferpool.clone(),
+            FieldType::Epoch(0),
+        );
+
+        column.insert(&FieldType::Epoch(5));
+        column.insert(&FieldType::Epoch(9));
+
+        // Skip ahead to the first row of the second segment, the rows in between read as zeros
+        let rows_per_segment = SEGMENT_SIZE / 16;
+        column.metadata.current_index = rows_per_segment;
+        column.insert(&FieldType::Epoch(3));
+
+        // Nothing is sealed until the column is saved
+        assert_eq!(column.full_segments(), 0);
+        assert_eq!(column.compact(), 0);
+
+        column.save();
+        assert_eq!(column.full_segments(), 1);
+        assert!(column.needs_compaction());
+        assert_eq!(column.compact(), 1);
+        assert!(!column.needs_compaction());
+
+        assert!(!ColumnSegments::get_segment_path(column_index, 0).exists());
+        let footer = bufferpool
+            .read()
+            .unwrap()
+            .sealed_footer(column_index, 0)
+            .unwrap();
+        assert_eq!((footer.first_row, footer.rows), (0, rows_per_segment));
+        assert_eq!((footer.min, footer.max), (0, 9));
+
+        // Pages are read from the sealed segment whether they are in memory or not
+        bufferpool.write().unwrap().set_page_limit(1);
+        assert_eq!(column.fetch(1), Some(FieldType::Epoch(9)));
+        assert_eq!(column.fetch(rows_per_segment), Some(FieldType::Epoch(3)));
+        assert_eq!(column.fetch(0), Some(FieldType::Epoch(5)));
+
+        let mut values = vec![];
+        column.scan(0, 3, |_, v| values.push(v));
+        assert_eq!(
+            values,
+            vec![
+                FieldType::Epoch(5),
+                FieldType::Epoch(9),
+                FieldType::Epoch(0)
+            ]
+        );
+
+        drop(column);
+        drop(bufferpool);
+        cleanup_test_file(column_index);
+        let _ = fs::remove_file(ColumnSegments::get_segment_path(column_index, 1));
+        let _ = fs::remove_file(SealedSegment::get_path(&dir, column_index, 0));
+    }
+
     #[test]
     fn column_field_type_size_epoch() {
         let field_type = FieldType::Epoch(100);
@@ -397,10 +1431,10 @@ mod tests {
     }
 
     #[test]
-    fn column_field_type_size_name() {
-        let field_type = FieldType::Name(create_function_name("test"));
+    fn column_field_type_size_code() {
+        let field_type = FieldType::Code(0);
         let metadata = ColumnMetadata::new("test".to_string(), 0, field_type);
 
-        assert_eq!(metadata.field_type.get_size(), 64);
+        assert_eq!(metadata.field_type.get_size(), 4);
     }
 }
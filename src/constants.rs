@@ -1,9 +1,95 @@
-// How many logs need to be in the queue before we write to the database
-// Make configurable: https://github.com/JakeRoggenbuck/kronicler/issues/18
-pub const DB_WRITE_BUFFER_SIZE: usize = 0;
+// How many captures are written to the database together by default
+// This is the `batch_size` of `Database(...)`, see issue #18
+pub const DB_WRITE_BUFFER_SIZE: usize = 1;
 
 pub const DATA_DIRECTORY: &str = ".kronicler_data";
 
 pub const PAGE_SIZE: usize = 4096;
 
-pub const CONSUMER_DELAY: u64 = 1; // Half a second
+// The largest extent size a column can use for its pages, 1MB
+pub const MAX_EXTENT_SIZE: usize = 1024 * 1024;
+
+// How big each segment file of a column gets before a new one is started, 64MB
+// This has to be a multiple of MAX_EXTENT_SIZE so that a page is never split between two files
+pub const SEGMENT_SIZE: usize = 64 * 1024 * 1024;
+
+// How many bytes of a full segment are compressed together when it is sealed, 1MB
+// Reading a sealed segment decompresses one of these at a time. It is MAX_EXTENT_SIZE so a page is
+// never split between two frames
+pub const SEALED_FRAME_SIZE: usize = MAX_EXTENT_SIZE;
+
+// The zstd level sealed segments are compressed with
+pub const SEALED_COMPRESSION_LEVEL: i32 = 3;
+
+// The longest a capture waits in the queue before it is written, in milliseconds
+// This is the default `max_delay`, captures are written sooner once a whole batch is waiting
+pub const CONSUMER_DELAY: u64 = 500; // Half a second
+
+// How long a page can stay dirty in the bufferpool before the flusher writes it, in milliseconds
+pub const FLUSH_INTERVAL: u64 = 1000;
+
+// How many dirty pages there can be before the flusher writes them without waiting
+pub const DIRTY_PAGE_LIMIT: usize = 64;
+
+// How many pages can be in the bufferpool at once, across all columns
+pub const BUFFERPOOL_PAGE_LIMIT: usize = 1024;
+
+// How many captures fit in the queue before capturing has to wait for the consumer
+pub const QUEUE_CAPACITY: usize = 65536;
+
+// How many milliseconds a capture waits for a full queue that nothing is taken out of, before
+// `KQueue.capture` drops it and `Database.capture` writes the queue itself
+pub const QUEUE_FULL_WAIT: u64 = 100;
+
+// How many captures the consumer takes out of the queue at a time
+// This is also the default `batch_size` of the background consumer from `database_init`
+pub const CONSUME_BATCH_SIZE: usize = 1024;
+
+// How many values of an encoded column are packed into each block
+pub const ENCODED_BLOCK_ROWS: usize = 1024;
+
+// How many row IDs of a posting list in the name index are in each chunk
+// The first ID of each chunk is kept as it is, so finding an ID decodes at most this many gaps
+pub const POSTING_CHUNK_IDS: usize = 128;
+
+// How many rows each cluster run of `cluster_by_name` has
+// A run is written once this many more rows are in the columns
+pub const CLUSTER_ROWS: usize = 65536;
+
+// How many new rows there can be before the name index is saved again
+// It is also saved on every flush, and rows after the last save are indexed again on open
+pub const INDEX_CHECKPOINT_ROWS: usize = 65536;
+
+// How far a percentile from the quantile sketch can be from the real value, as a fraction of it
+pub const SKETCH_RELATIVE_ACCURACY: f64 = 0.01;
+
+// The most buckets the quantile sketch of one function keeps
+// At 1% this covers everything from 1ns to years, past that the smallest buckets are merged
+pub const SKETCH_MAX_BUCKETS: usize = 2048;
+
+// How many rows each batch of `Database.scan` has by default, one encoded block
+pub const SCAN_BATCH_SIZE: usize = 1024;
+
+// Row IDs have the number of their shard above this many bits and the row in the shard below it
+// Shard 0 is the only one of a single process, so its row IDs are just the row numbers
+pub const SHARD_ROW_BITS: u32 = 40;
+
+// The longest the write-ahead log goes without being synced while captures are written to it, in
+// milliseconds. This is the default `sync_interval` of `Database(...)`, 0 syncs every group
+pub const WAL_SYNC_INTERVAL: u64 = 100;
+
+// The longest the rows in the write-ahead log wait to be saved to the columns before the log
+// starts over, in milliseconds. Readers in other processes see new rows once they are saved, or
+// right away after a flush
+pub const CHECKPOINT_INTERVAL: u64 = 60_000;
+
+// How often the background checkpointer looks for work, in milliseconds. The write-ahead log is
+// synced on these ticks once it has gone `sync_interval` without a sync
+pub const CHECKPOINTER_TICK: u64 = 50;
+
+// How big the write-ahead log can get before it is checkpointed without waiting, 64MB
+pub const WAL_CHECKPOINT_BYTES: u64 = 64 * 1024 * 1024;
+
+// How often the background checkpointer drops the data that is older than the retention keeps,
+// in milliseconds
+pub const RETENTION_INTERVAL: u64 = 60 * 1000;
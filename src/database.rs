@@ -1,33 +1,84 @@
 use super::bufferpool::Bufferpool;
 use super::capture::Capture;
-use super::column::Column;
-use super::constants::{DATA_DIRECTORY, DB_WRITE_BUFFER_SIZE};
-use super::index::Index;
+use super::cluster::Clusters;
+use super::column::{Column, SealJob};
+use super::constants::{
+    CHECKPOINTER_TICK, CHECKPOINT_INTERVAL, CLUSTER_ROWS, CONSUMER_DELAY, CONSUME_BATCH_SIZE,
+    DATA_DIRECTORY, DB_WRITE_BUFFER_SIZE, INDEX_CHECKPOINT_ROWS, PAGE_SIZE, QUEUE_CAPACITY,
+    QUEUE_FULL_WAIT, RETENTION_INTERVAL, SCAN_BATCH_SIZE, SHARD_ROW_BITS, WAL_CHECKPOINT_BYTES,
+    WAL_SYNC_INTERVAL,
+};
+use super::dictionary::Dictionary;
+use super::encoding::Encoding;
+use super::index::{Index, Stats};
 use super::queue::KQueue;
-use super::row::{create_function_name, Epoch, FieldType, Row};
+use super::retention::Retention;
+use super::rollup::{Granularity, RollupPoint, Rollups};
+use super::row::{Epoch, FieldType, Row};
+use super::shard::{claim_shard, get_shard_dir, list_shards};
+use super::sketch::Sketch;
+use super::wal::{Wal, WalRecord};
+use super::watermark::Watermark;
 use log::{debug, info, warn};
+use pyo3::exceptions::PyValueError;
 use pyo3::prelude::*;
-use pyo3::types::PyList;
+use pyo3::types::{PyBytes, PyList};
+use std::collections::HashMap;
 use std::collections::HashSet;
-use std::collections::VecDeque;
-use std::fs;
-use std::path::Path;
-use std::sync::atomic::{AtomicBool, AtomicUsize, Ordering};
-use std::sync::{Arc, OnceLock, RwLock};
+use std::collections::{BTreeMap, VecDeque};
+use std::fs::{self, File};
+use std::path::{Path, PathBuf};
+use std::sync::atomic::{AtomicBool, AtomicU64, AtomicUsize, Ordering};
+use std::sync::{Arc, Condvar, Mutex, OnceLock, RwLock, RwLockReadGuard};
 use std::thread;
+use std::time::{Duration, Instant, SystemTime, UNIX_EPOCH};
+
+// Only `name`, `start` and `delta` are stored. The `end` of a row is always `start + delta`, so
+// it is worked out when the row is read.
+const NAME_COLUMN: usize = 0;
+const START_COLUMN: usize = 1;
+const DELTA_COLUMN: usize = 2;
+const COLUMN_COUNT: usize = 3;
 
 pub struct DatabaseInner {
-    queue: KQueue,
+    /// Which shard of the data directory this is, see `shard.rs`
+    shard: usize,
+    /// The directory of the shard
+    dir: PathBuf,
+    /// The lock that keeps other writers out of the shard, a reader does not have one
+    _lock: Option<File>,
     columns: Vec<Column>,
-    /// Index rows by `name` field in capture
+    bufferpool: Arc<RwLock<Bufferpool>>,
+    /// Index rows by the code of the `name` field in capture
     name_index: Index,
+    /// The names that the codes in the name column stand for
+    dictionary: Dictionary,
     /// Keep track of the current row being inserted
     row_id: AtomicUsize,
-    sync_consume: bool,
+    /// How many rows the name index had when it was last saved
+    index_checkpoint: usize,
+    /// Per function stats of each minute, hour and day
+    rollups: Rollups,
+    /// For a reader, how many rows the writer had published when it last looked
+    watermark: Option<usize>,
+    /// The log captures are written to before the columns, a reader does not have one
+    wal: Option<Wal>,
+    /// When the rows in the log were last saved to the columns
+    last_checkpoint: Instant,
+    /// The first row that retention has not dropped
+    first_row: usize,
+    /// How long rows and per minute rollups are kept
+    retention: Retention,
+    /// When retention was last applied
+    last_retention: Instant,
+    /// The deltas of the rows clustered by function, see `cluster.rs`
+    clusters: Clusters,
+    /// How many rows each new cluster run has, or None if runs are not written
+    cluster_rows: Option<usize>,
 }
 
 impl DatabaseInner {
-    fn new(sync_consume: bool) -> Self {
+    fn new(sync_consume: bool, config: &DatabaseConfig) -> Self {
         if !sync_consume {
             eprintln!(
                 "Async Consume not fully supported yet in v0.1.1. Please set `sync_consume=True`."
@@ -38,378 +89,2087 @@ impl DatabaseInner {
         Database::create_data_dir();
         Database::check_for_data();
 
-        let column_count = 4;
+        // Other processes of the same app write to their own shards
+        let (shard, lock) = claim_shard();
+        DatabaseInner::open_writer(shard, Some(lock), config)
+    }
+
+    /// Open shard `shard` for writing, holding `lock` for as long as it is open
+    fn open_writer(shard: usize, lock: Option<File>, config: &DatabaseConfig) -> Self {
+        let dir = get_shard_dir(shard);
 
-        let bp = Bufferpool::new(column_count);
+        let bp = Bufferpool::open(&dir, COLUMN_COUNT, false);
         let bufferpool = Arc::new(RwLock::new(bp));
+        Bufferpool::start_flusher(&bufferpool);
+
+        let columns = DatabaseInner::open_columns(&bufferpool, config);
+        let dictionary = Dictionary::open(&Dictionary::get_path(&dir));
+
+        let sync_interval = Duration::from_millis(config.sync_interval);
+        let (wal, base, records) = Wal::open(&dir, sync_interval);
+        let first_row = Retention::read_first_row(&dir);
+        let clusters = Clusters::open(&dir);
+
+        let mut db = DatabaseInner {
+            shard,
+            dir,
+            _lock: lock,
+            columns,
+            bufferpool,
+            name_index: Index::new(),
+            dictionary,
+            row_id: AtomicUsize::new(0),
+            index_checkpoint: 0,
+            rollups: Rollups::new(),
+            watermark: None,
+            wal: Some(wal),
+            last_checkpoint: Instant::now(),
+            first_row,
+            retention: config.retention,
+            last_retention: Instant::now(),
+            clusters,
+            cluster_rows: config.cluster_by_name.then_some(CLUSTER_ROWS),
+        };
+
+        if let Some(base) = base {
+            db.replay(base, records);
+        }
+
+        // New rows carry on from the ones already on disk
+        db.row_id.store(db.row_count(), Ordering::SeqCst);
+
+        // This also lets readers left from the last writer see everything on disk
+        db.checkpoint();
+        db.open_name_index();
+
+        db
+    }
+
+    /// Write the rows in the log from row `base` on that the saved columns do not have
+    ///
+    /// Each column only takes the rows past its own row count, so columns that were saved at
+    /// different rows all end up at the last row of the log.
+    fn replay(&mut self, base: usize, records: Vec<WalRecord>) {
+        if let Some(behind) = self
+            .columns
+            .iter()
+            .find(|c| c.metadata.current_index < base)
+        {
+            warn!(
+                "Column {} has {} rows but the write-ahead log starts at row {}, not replaying it",
+                behind.metadata.column_index, behind.metadata.current_index, base
+            );
+            return;
+        }
+
+        let before = self.row_count();
+        let mut id = base;
+
+        for record in records {
+            match record {
+                WalRecord::Name { code, name } => {
+                    // Names that were saved before the crash are already in the dictionary
+                    if code as usize == self.dictionary.len() {
+                        self.dictionary.encode(&name);
+                    }
+                }
+                WalRecord::Row { code, start, delta } => {
+                    let values = [
+                        (NAME_COLUMN, FieldType::Code(code)),
+                        (START_COLUMN, FieldType::Epoch(start)),
+                        (DELTA_COLUMN, FieldType::Epoch(delta)),
+                    ];
+
+                    for (col, value) in values {
+                        if self.columns[col].metadata.current_index == id {
+                            self.columns[col].insert(&value);
+                        }
+                    }
+
+                    id += 1;
+                }
+            }
+        }
+
+        if self.row_count() > before {
+            info!(
+                "Replayed rows {} to {} from the write-ahead log",
+                before,
+                self.row_count()
+            );
+        }
+    }
+
+    /// Open shard `shard` that another process is writing, without writing anything
+    ///
+    /// Only the rows up to the watermark the writer published are used, and `refresh` moves up
+    /// to a newer one. If the shard is not there yet it is empty until a refresh after the
+    /// writer starts.
+    fn open_reader(shard: usize) -> Self {
+        let dir = get_shard_dir(shard);
+        let bufferpool = Arc::new(RwLock::new(Bufferpool::open(&dir, COLUMN_COUNT, true)));
+        let columns = DatabaseInner::open_columns(&bufferpool, &DatabaseConfig::default());
+
+        let mut db = DatabaseInner {
+            shard,
+            columns,
+            bufferpool,
+            name_index: Index::new(),
+            dictionary: Dictionary::open_read_only(&Dictionary::get_path(&dir)),
+            row_id: AtomicUsize::new(0),
+            index_checkpoint: 0,
+            rollups: Rollups::new(),
+            watermark: Some(Watermark::read(&Watermark::get_path(&dir)).unwrap_or(0)),
+            wal: None,
+            last_checkpoint: Instant::now(),
+            first_row: Retention::read_first_row(&dir),
+            retention: Retention::default(),
+            last_retention: Instant::now(),
+            clusters: Clusters::open(&dir),
+            cluster_rows: None,
+            dir,
+            _lock: None,
+        };
+
+        let rows = db.row_count();
+        db.row_id.store(rows, Ordering::SeqCst);
+        db.load_name_index(rows);
+
+        info!("Opened reader of shard {} at {} rows", shard, rows);
+        db
+    }
 
-        let name_col = Column::new(
+    fn open_columns(bufferpool: &Arc<RwLock<Bufferpool>>, config: &DatabaseConfig) -> Vec<Column> {
+        let name_col = Column::with_extent_size(
             "name".to_string(),
-            0,
+            NAME_COLUMN,
             bufferpool.clone(),
-            FieldType::Name([0u8; 64]),
+            FieldType::Code(0),
+            config.extent_size,
         );
 
-        let start_col = Column::new(
+        // Starts mostly go up by similar amounts, so store how much each step changed
+        let start_col = Column::with_encoding(
             "start".to_string(),
-            1,
+            START_COLUMN,
             bufferpool.clone(),
             FieldType::Epoch(0),
+            config.extent_size,
+            Encoding::DeltaOfDelta,
         );
 
-        let end_col = Column::new(
-            "end".to_string(),
-            2,
-            bufferpool.clone(),
-            FieldType::Epoch(0),
-        );
-
-        let delta_col = Column::new(
+        // Deltas of a block are close to each other, so store them as offsets from the smallest
+        let delta_col = Column::with_encoding(
             "delta".to_string(),
-            3,
+            DELTA_COLUMN,
             bufferpool.clone(),
             FieldType::Epoch(0),
+            config.extent_size,
+            Encoding::FrameOfReference,
         );
 
-        let columns = vec![name_col, start_col, end_col, delta_col];
+        let columns = vec![name_col, start_col, delta_col];
 
-        assert_eq!(columns.len(), column_count);
+        assert_eq!(columns.len(), COLUMN_COUNT);
 
-        for col in &columns {
-            col.save();
+        columns
+    }
+
+    /// Move a reader up to the newest watermark, returning how many new rows it can see
+    ///
+    /// Only what was added since the last refresh is read: the column metadata, the new names and
+    /// the new rows for the name index. If the writer is in the middle of saving, the reader
+    /// keeps the rows it had and picks up the new ones on the next refresh.
+    fn refresh(&mut self) -> usize {
+        let first_row = Retention::read_first_row(&self.dir);
+        if first_row > self.first_row {
+            self.first_row = first_row;
+            self.name_index.trim(first_row);
+
+            // Let go of the segments and cluster runs the writer deleted
+            self.bufferpool.read().unwrap().unmap();
+            self.clusters = Clusters::open(&self.dir);
+        }
+
+        let Some(published) = Watermark::read(&Watermark::get_path(&self.dir)) else {
+            return 0;
+        };
+
+        let before = self.row_count();
+
+        if published <= before {
+            return 0;
         }
 
-        let name_index = Index::new();
+        // The columns and names are read after the watermark, so they have every published row
+        let reloaded = self
+            .columns
+            .iter_mut()
+            .filter_map(|c| c.reload().then_some(()))
+            .count();
+        if reloaded < self.columns.len() {
+            info!("Column is being saved, trying again on the next refresh");
+        }
+        self.dictionary.refresh();
+        self.clusters.refresh();
+        self.bufferpool.read().unwrap().unmap();
 
-        DatabaseInner {
-            queue: KQueue::new(),
-            columns,
-            name_index,
-            row_id: AtomicUsize::new(0),
-            sync_consume,
+        self.watermark = Some(published);
+
+        let rows = self.row_count();
+        if rows > before {
+            self.rebuild_name_index(before, rows);
         }
+
+        self.row_id.store(rows, Ordering::SeqCst);
+        rows - before
     }
 
-    fn consume_capture(&mut self, queue: Arc<RwLock<VecDeque<Capture>>>) {
-        info!("Calling consume_capture");
+    pub fn get_index_path(dir: &Path) -> PathBuf {
+        dir.join("index.data")
+    }
+
+    pub fn get_rollup_path(dir: &Path) -> PathBuf {
+        dir.join("rollup.data")
+    }
+
+    /// Load the saved name index and rollups, and add any rows that were written after they were
+    /// saved
+    ///
+    /// If one is not saved, or it does not match the data, it is built again from the columns.
+    fn open_name_index(&mut self) {
+        let rows = self.row_count();
+
+        if self.load_name_index(rows) {
+            self.checkpoint_index();
+        }
+    }
+
+    /// Load the saved name index and rollups that fit in the first `rows` rows, and index the
+    /// rows after them, without saving anything
+    ///
+    /// Returns true if any rows had to be indexed.
+    fn load_name_index(&mut self, rows: usize) -> bool {
+        let names = self.dictionary.len();
+
+        let saved = Index::load(&DatabaseInner::get_index_path(&self.dir)).filter(|index| {
+            // An index with rows or names that are not on disk is from some other data
+            let valid = index.rows <= rows
+                && index.index.keys().all(|k| match k {
+                    FieldType::Code(c) => (*c as usize) < names,
+                    _ => false,
+                });
+
+            if !valid {
+                warn!("Saved name index does not match the data, building it again");
+            }
+
+            valid
+        });
+
+        match saved {
+            Some(index) => {
+                info!("Loaded name index of {} rows", index.rows);
+                self.name_index = index;
+            }
+            None => self.name_index = Index::new(),
+        }
+
+        // The index might have been saved before retention dropped some rows
+        self.name_index.trim(self.first_row);
+
+        let saved = Rollups::load(&DatabaseInner::get_rollup_path(&self.dir)).filter(|rollups| {
+            let valid =
+                rollups.rows <= rows && rollups.max_code().map_or(true, |c| (c as usize) < names);
+
+            if !valid {
+                warn!("Saved rollups do not match the data, building them again");
+            }
+
+            valid
+        });
+
+        self.rollups = saved.unwrap_or_else(Rollups::new);
+
+        let from = self.name_index.rows.min(self.rollups.rows);
+        self.index_checkpoint = self.name_index.rows;
+
+        if from < rows {
+            self.rebuild_name_index(from, rows);
+            return true;
+        }
+
+        false
+    }
+
+    /// Add rows `from` up to `to` to the name index and the rollups, reading the columns once and
+    /// splitting the rows between threads
+    ///
+    /// Rows that the index or the rollups already have are skipped for that one.
+    fn rebuild_name_index(&mut self, from: usize, to: usize) {
+        // Rows that retention dropped can not be read
+        let from = from.max(self.first_row).min(to);
+        info!("Indexing rows {} to {}", from, to);
+
+        let mut codes = Vec::with_capacity(to - from);
+        self.columns[NAME_COLUMN].scan(from, to, |_, f| match f {
+            FieldType::Code(c) => codes.push(c),
+            _ => codes.push(0),
+        });
+
+        let mut starts = Vec::with_capacity(to - from);
+        self.columns[START_COLUMN].scan(from, to, |_, f| match f {
+            FieldType::Epoch(s) => starts.push(s),
+            _ => starts.push(0),
+        });
+
+        let mut deltas = Vec::with_capacity(to - from);
+        self.columns[DELTA_COLUMN].scan(from, to, |_, f| match f {
+            FieldType::Epoch(d) => deltas.push(d),
+            _ => deltas.push(0),
+        });
+
+        let index_from = self.name_index.rows;
+        let rollup_from = self.rollups.rows;
+
+        let threads = thread::available_parallelism()
+            .map(|n| n.get())
+            .unwrap_or(1);
+        let chunk = codes.len().div_ceil(threads).max(1);
+
+        // Each thread indexes its own run of rows, then they are merged in order so the IDs for
+        // each name stay sorted
+        let parts: Vec<(Index, Rollups)> = thread::scope(|s| {
+            let handles: Vec<_> = codes
+                .chunks(chunk)
+                .zip(starts.chunks(chunk))
+                .zip(deltas.chunks(chunk))
+                .enumerate()
+                .map(|(n, ((codes, starts), deltas))| {
+                    s.spawn(move || {
+                        let mut index = Index::new();
+                        let mut rollups = Rollups::new();
+                        let first = from + n * chunk;
+
+                        for (i, ((code, start), delta)) in
+                            codes.iter().zip(starts).zip(deltas).enumerate()
+                        {
+                            let id = first + i;
+
+                            if id >= index_from {
+                                index.insert_value(FieldType::Code(*code), id, *delta);
+                            }
+
+                            if id >= rollup_from {
+                                rollups.insert(*code, id, *start, *delta);
+                            }
+                        }
+
+                        (index, rollups)
+                    })
+                })
+                .collect();
+
+            handles
+                .into_iter()
+                .map(|h| h.join().expect("Should build index."))
+                .collect()
+        });
 
-        let mut q = queue.write().unwrap();
+        for (index, rollups) in parts {
+            self.name_index.merge(index);
+            self.rollups.merge(rollups);
+        }
+
+        self.name_index.rows = self.name_index.rows.max(to);
+        self.rollups.rows = self.rollups.rows.max(to);
+    }
+
+    /// Save the name index and the rollups so the next open does not have to build them
+    fn checkpoint_index(&mut self) {
+        self.name_index
+            .save(&DatabaseInner::get_index_path(&self.dir));
+        self.rollups
+            .save(&DatabaseInner::get_rollup_path(&self.dir));
+        self.index_checkpoint = self.name_index.rows;
+    }
+
+    /// Write everything in the queue as one group
+    ///
+    /// The group is added to the log with one write, and the columns are only saved by the next
+    /// checkpoint instead of once per group.
+    fn consume_capture(&mut self, queue: &KQueue) {
+        info!("Calling consume_capture");
 
-        if q.len() > DB_WRITE_BUFFER_SIZE {
+        if !queue.empty() {
             info!("Starting bulk write!");
 
-            while !q.is_empty() {
-                let capture = q.pop_front();
+            // Take the captures out in batches, producers can keep adding while this runs
+            let mut batch = Vec::with_capacity(CONSUME_BATCH_SIZE);
 
-                if let Some(c) = capture {
+            while queue.pop_batch(CONSUME_BATCH_SIZE, &mut batch) > 0 {
+                for c in batch.drain(..) {
                     // TODO: Replace for real ID
                     // Maybe it does not need an ID?
                     // Because the columns keep track of that
 
                     // Get the self.row_id value (prev) and then add one to self.row_id
                     let prev = self.row_id.fetch_add(1, Ordering::SeqCst);
-                    let row = c.to_row(prev);
+                    let names = self.dictionary.len();
+                    let code = self.dictionary.encode(&c.name);
+                    let row = c.to_row(prev, code);
+
+                    let wal = self.wal.as_mut().expect("Should only write with a log.");
+                    if code as usize == names {
+                        wal.log_name(code, &c.name);
+                    }
+                    wal.log_row(code, c.start, c.delta);
 
                     info!("Writing {:?}...", &row);
 
-                    let mut col_index = 0;
-                    for field in &row.fields {
-                        self.columns[col_index].insert(field);
-                        debug!("{:?}", self.name_index);
-                        col_index += 1;
+                    self.columns[NAME_COLUMN].insert(&row.fields[0]);
+                    self.columns[START_COLUMN].insert(&row.fields[1]);
+                    self.columns[DELTA_COLUMN].insert(&row.fields[3]);
+
+                    if let (FieldType::Epoch(start), FieldType::Epoch(delta)) =
+                        (&row.fields[1], &row.fields[3])
+                    {
+                        self.rollups.insert(code, prev, *start, *delta);
                     }
 
-                    self.name_index.insert(row.clone(), 0);
+                    self.name_index.insert(row, 0);
+                    debug!("{:?}", self.name_index);
                 }
             }
 
-            // Save columns if there was new data
-            for col in &self.columns {
-                col.save();
+            self.wal
+                .as_mut()
+                .expect("Should only write with a log.")
+                .commit();
+
+            if self.needs_checkpoint() {
+                self.checkpoint();
             }
         }
     }
-}
 
-// Separate singleton instances for sync and async modes
-static DATABASE_SYNC: OnceLock<Arc<RwLock<DatabaseInner>>> = OnceLock::new();
-static DATABASE_ASYNC: OnceLock<Arc<RwLock<DatabaseInner>>> = OnceLock::new();
+    /// Check if the log has rows that should be saved to the columns now
+    fn needs_checkpoint(&self) -> bool {
+        match &self.wal {
+            Some(wal) if wal.rows() > 0 => {
+                wal.len() >= WAL_CHECKPOINT_BYTES
+                    || self.last_checkpoint.elapsed() >= Duration::from_millis(CHECKPOINT_INTERVAL)
+            }
+            _ => false,
+        }
+    }
 
-// Shared queue state using atomic bools - one for each database type
-static QUEUE_HAS_DATA_SYNC: AtomicBool = AtomicBool::new(false);
-static QUEUE_HAS_DATA_ASYNC: AtomicBool = AtomicBool::new(false);
+    /// Save the rows in the log to the columns, sync them to disk and start the log over
+    ///
+    /// Everything is synced before the log is cut, so a crash at any point keeps each row in the
+    /// columns or in the log.
+    fn checkpoint(&mut self) {
+        let rows = self.row_count();
 
-#[pyclass]
-pub struct Database {
-    sync_consume: bool,
-}
+        // The pages go first so the saved columns never count values that are not on disk
+        self.bufferpool.write().unwrap().sync();
 
-impl Database {
-    fn get_instance(&self) -> Arc<RwLock<DatabaseInner>> {
-        if self.sync_consume {
-            DATABASE_SYNC
-                .get_or_init(|| {
-                    info!("Creating sync DatabaseInner with sync_consume=true");
-                    Arc::new(RwLock::new(DatabaseInner::new(true)))
-                })
-                .clone()
-        } else {
-            DATABASE_ASYNC
-                .get_or_init(|| {
-                    info!("Creating async DatabaseInner with sync_consume=false");
-                    Arc::new(RwLock::new(DatabaseInner::new(false)))
-                })
-                .clone()
+        // Save the names before the columns that use their codes
+        self.dictionary.save();
+
+        for col in &mut self.columns {
+            col.save();
         }
-    }
 
-    fn get_queue_state(&self) -> &'static AtomicBool {
-        if self.sync_consume {
-            &QUEUE_HAS_DATA_SYNC
-        } else {
-            &QUEUE_HAS_DATA_ASYNC
+        if let Some(wal) = &mut self.wal {
+            wal.reset(rows);
         }
-    }
+        self.last_checkpoint = Instant::now();
 
-    fn check_for_data() {
-        if !Database::exists() {
-            eprintln!("Database does not exist at \"{}\".", &DATA_DIRECTORY);
-            std::process::exit(0);
+        // The index is saved after the data it points to
+        if self.name_index.rows - self.index_checkpoint >= INDEX_CHECKPOINT_ROWS {
+            self.checkpoint_index();
         }
+
+        // Readers can see the new rows now that everything they need is on disk
+        self.bufferpool.write().unwrap().stage_watermark(rows);
     }
-}
 
-#[pymethods]
-impl Database {
-    #[new]
-    #[pyo3(signature = (sync_consume = false))]
-    pub fn new(sync_consume: bool) -> Self {
-        info!("Creating Database with sync_consume={}", sync_consume);
-        Database { sync_consume }
+    /// Check if the log has a group that has not been synced for `sync_interval`
+    fn needs_wal_sync(&self) -> bool {
+        self.wal.as_ref().is_some_and(|wal| wal.needs_sync())
     }
 
-    pub fn init(&mut self) {
-        let db_instance = self.get_instance();
-        let queue_state = self.get_queue_state();
+    /// Check if retention is set and has not been applied for RETENTION_INTERVAL
+    fn needs_retention(&self) -> bool {
+        self.wal.is_some()
+            && self.retention.is_set()
+            && self.last_retention.elapsed() >= Duration::from_millis(RETENTION_INTERVAL)
+    }
 
-        info!("Called init!");
-        loop {
-            // Use relaxed ordering since we don't need strict synchronization here
-            if queue_state.load(Ordering::Relaxed) {
-                info!("Running consume.");
+    /// Drop the rows and the per minute rollups that are older than the retention keeps, as of
+    /// `now`, returning how many rows were dropped
+    fn apply_retention(&mut self, now: Epoch) -> usize {
+        self.last_retention = Instant::now();
+        let before = self.first_row;
 
-                let queue_clone = {
-                    let db = db_instance.read().unwrap();
-                    Arc::clone(&db.queue.queue)
-                };
+        if let Some(cutoff) = self.retention.raw_cutoff(now) {
+            // Rows that are only in the log would come back if it was replayed
+            let saved = self.wal.as_ref().map_or(0, |wal| wal.base());
+            let first_row = self.columns[START_COLUMN].rows_before(cutoff).min(saved);
 
-                {
-                    let mut db = db_instance.write().unwrap();
-                    db.consume_capture(queue_clone);
-                }
+            if first_row > self.first_row {
+                // The index and rollups are saved with every row first, since the rows they are
+                // missing could not be indexed again once they are dropped
+                self.checkpoint();
+                self.checkpoint_index();
 
-                // Mark queue as processed
-                queue_state.store(false, Ordering::Relaxed);
+                // Saved before anything is deleted, so the rows are never read after a crash
+                Retention::write_first_row(&self.dir, first_row);
 
-                // let timeout = time::Duration::from_millis(CONSUMER_DELAY);
-                // thread::sleep(timeout);
+                self.first_row = first_row;
+                self.name_index.trim(first_row);
             }
         }
-    }
 
-    #[staticmethod]
-    pub fn exists() -> bool {
-        Path::new(&DATA_DIRECTORY).exists()
-    }
+        // Segments that could not be deleted last time are tried again
+        let first_row = self.first_row;
+        let removed: usize = self
+            .columns
+            .iter_mut()
+            .map(|c| c.remove_before(first_row))
+            .sum();
+        self.clusters.remove_before(first_row);
+
+        let trimmed = match self.retention.minute_cutoff(now) {
+            Some(cutoff) => self.rollups.trim(Granularity::Minute, cutoff),
+            None => 0,
+        };
 
-    #[staticmethod]
-    #[pyo3(signature = (sync_consume = false))]
-    pub fn new_reader(sync_consume: bool) -> Self {
-        info!(
-            "Creating Database reader with sync_consume={}",
-            sync_consume
-        );
-        Database::new(sync_consume)
+        if self.first_row > before || trimmed > 0 {
+            info!(
+                "Retention dropped {} rows, {} segments and {} minute rollups",
+                self.first_row - before,
+                removed,
+                trimmed
+            );
+            self.checkpoint_index();
+        }
+
+        self.first_row - before
     }
 
-    fn clear(&mut self) {
-        // Should match the hard coded value
-        assert_eq!(DATA_DIRECTORY, ".kronicler_data");
+    /// Check if a column has a full segment that is not sealed yet
+    fn needs_compaction(&self) -> bool {
+        self.wal.is_some() && self.columns.iter().any(|c| c.needs_compaction())
+    }
 
-        fs::remove_dir_all(DATA_DIRECTORY)
-            .expect(&format!("Could not remove directory '{}'.", DATA_DIRECTORY));
+    /// Take the full segments of every column that are not sealed yet
+    ///
+    /// Full segments are never written again, so this only needs to read the database, and the
+    /// jobs can be run once it is no longer held.
+    fn seal_jobs(&self) -> Vec<SealJob> {
+        if self.wal.is_none() {
+            return vec![];
+        }
 
-        info!("Removed data directory at '{}'!", DATA_DIRECTORY);
+        self.columns.iter().filter_map(|c| c.seal_job()).collect()
     }
 
-    #[staticmethod]
-    fn create_data_dir() {
-        fs::create_dir_all(DATA_DIRECTORY)
-            .expect(&format!("Could not create directory '{}'.", DATA_DIRECTORY));
+    /// The rows the next cluster run would have, if they are all in the columns
+    ///
+    /// Runs start where the last one ended, or at the first row kept, and end on a multiple of
+    /// the run size, so every run after the first one after a retention has the same rows.
+    fn next_cluster(&self) -> Option<(usize, usize)> {
+        let run_rows = self.cluster_rows?;
+        self.wal.as_ref()?;
 
-        info!("Created data directory at '{}'!", DATA_DIRECTORY);
-    }
+        let from = self.clusters.end().max(self.first_row);
+        let to = (from / run_rows + 1) * run_rows;
 
-    pub fn contains_name(&mut self, name: String) -> bool {
-        let db_instance = self.get_instance();
-        let db = db_instance.write().unwrap();
+        (to <= self.row_count()).then_some((from, to))
+    }
 
-        let found = db
-            .name_index
-            .get(FieldType::Name(create_function_name(&name)));
-        found.is_some()
+    /// Read the first and end row, name codes and deltas of the next cluster run, if there are
+    /// enough rows for one
+    ///
+    /// This only needs to read the database, and the run can be written once it is no longer
+    /// held.
+    fn cluster_rows(&self) -> Option<(usize, usize, Vec<u32>, Vec<u64>)> {
+        let (from, to) = self.next_cluster()?;
+
+        let mut codes = Vec::with_capacity(to - from);
+        self.columns[NAME_COLUMN].scan(from, to, |_, f| {
+            codes.push(match f {
+                FieldType::Code(c) => c,
+                _ => 0,
+            })
+        });
+
+        let mut deltas = Vec::with_capacity(to - from);
+        self.columns[DELTA_COLUMN].scan(from, to, |_, f| deltas.push(delta_value(f)));
+
+        Some((from, to, codes, deltas))
     }
 
-    /// Capture a function and write it to the queue
-    pub fn capture(&mut self, name: String, args: Vec<PyObject>, start: Epoch, end: Epoch) {
-        let db_instance = self.get_instance();
-        let queue_state = self.get_queue_state();
+    /// Add the deltas of every kept row of the function with `code` to `out` as little endian
+    /// u64s, in row order
+    ///
+    /// The rows in cluster runs are copied from them as they are, and only the rows after the
+    /// last run are fetched one by one from the delta column.
+    fn write_deltas(&self, code: u32, out: &mut Vec<u8>) {
+        let rows = self.row_count();
+        let mut from = self.first_row;
+
+        for run in self.clusters.runs() {
+            // A reader might have a run the writer wrote after the watermark it read
+            if run.end_row() <= from || run.end_row() > rows {
+                continue;
+            }
 
-        let mut db = db_instance.write().unwrap();
+            self.write_fetched_deltas(code, from, run.first_row(), out);
+
+            // Retention might have dropped the start of the run
+            let mut skip = 0;
+            if run.first_row() < from {
+                let kept = self
+                    .name_index
+                    .ids_from(&FieldType::Code(code), from)
+                    .take_while(|id| *id < run.end_row())
+                    .count();
+                skip = run.count(code).saturating_sub(kept);
+            }
 
-        // Signal that queue has new data
-        queue_state.store(true, Ordering::Relaxed);
+            out.extend_from_slice(&run.deltas(code)[skip * 8..]);
+            from = run.end_row();
+        }
 
-        info!("Capturing with sync_consume={}", db.sync_consume);
-        db.queue.capture(name, args, start, end);
+        self.write_fetched_deltas(code, from, rows, out);
+    }
 
-        if db.sync_consume {
-            info!("Performing synchronous consume");
-            let queue_clone = Arc::clone(&db.queue.queue);
-            db.consume_capture(queue_clone);
-            // For sync consume, we immediately mark as processed
-            queue_state.store(false, Ordering::Relaxed);
+    /// Add the deltas of the rows of the function with `code` from `from` up to `to` to `out`,
+    /// fetching them one by one through the name index
+    fn write_fetched_deltas(&self, code: u32, from: usize, to: usize, out: &mut Vec<u8>) {
+        for id in self.name_index.ids_from(&FieldType::Code(code), from) {
+            if id >= to {
+                break;
+            }
+
+            if let Some(delta) = self.columns[DELTA_COLUMN].fetch(id) {
+                out.extend_from_slice(&delta_value(delta).to_le_bytes());
+            }
         }
     }
 
-    pub fn fetch(&mut self, index: usize) -> Option<Row> {
-        info!("Starting fetch on index {}", index);
+    /// Spawn the background checkpointer for a shared database
+    ///
+    /// Captures only sync the log and start a checkpoint when they are written, so this syncs the
+    /// last group within `sync_interval` and saves the last rows within CHECKPOINT_INTERVAL even
+    /// if no more come in. It also drops old data for retention, writes cluster runs and seals
+    /// full segments. It only holds a weak reference, so it stops when the database is dropped.
+    fn start_checkpointer(db: &Arc<RwLock<DatabaseInner>>) {
+        let weak = Arc::downgrade(db);
+
+        thread::spawn(move || loop {
+            thread::sleep(Duration::from_millis(CHECKPOINTER_TICK));
+
+            match weak.upgrade() {
+                Some(db) => {
+                    let work = {
+                        let db = db.read().unwrap();
+                        db.needs_wal_sync() || db.needs_checkpoint() || db.needs_retention()
+                    };
+
+                    if work {
+                        let mut db = db.write().unwrap();
+
+                        // A capture might have done it while this one waited
+                        if db.needs_checkpoint() {
+                            db.checkpoint();
+                        } else if db.needs_wal_sync() {
+                            // The last group is synced even if no group comes after it
+                            db.wal.as_mut().unwrap().sync();
+                        }
 
-        let db_instance = self.get_instance();
-        let mut db = db_instance.write().unwrap();
-        let mut data = vec![];
+                        if db.needs_retention() {
+                            db.apply_retention(now_nanos());
+                        }
+                    }
 
-        for col in &mut db.columns {
-            let field = col.fetch(index);
+                    // One run a tick, written and synced while the database is not held
+                    let rows = {
+                        let db = db.read().unwrap();
+                        db.cluster_rows().map(|rows| (db.dir.clone(), rows))
+                    };
 
-            if let Some(f) = field {
-                data.push(f);
-            }
-        }
+                    if let Some((dir, (from, to, codes, deltas))) = rows {
+                        let run = Clusters::write_run(&dir, from, to, &codes, &deltas);
+                        db.write().unwrap().clusters.push(run);
+                    }
 
-        // TODO: Fix this to make it a better check for unwritten data
-        if data.len() > 1 && data[1] == FieldType::Epoch(0) {
-            return None;
-        }
+                    // The database is only held to find the segments, captures and readers
+                    // can go on while they are compressed
+                    let jobs = {
+                        let db = db.read().unwrap();
+                        if db.needs_compaction() {
+                            db.seal_jobs()
+                        } else {
+                            vec![]
+                        }
+                    };
 
-        Some(Row {
-            id: index,
-            fields: data,
-        })
+                    for job in jobs {
+                        job.run();
+                    }
+                }
+                None => break,
+            }
+        });
     }
 
-    pub fn fetch_all(&mut self) -> Vec<Row> {
-        let mut all = vec![];
-        let mut index = 0;
+    /// The number of rows that are in every column, and for a reader that were published
+    fn row_count(&self) -> usize {
+        let rows = self
+            .columns
+            .iter()
+            .map(|c| c.metadata.current_index)
+            .min()
+            .unwrap_or(0);
 
-        loop {
-            let row = self.fetch(index);
+        rows.min(self.watermark.unwrap_or(usize::MAX))
+    }
 
-            if let Some(r) = row {
-                all.push(r);
-            } else {
-                break;
-            }
+    /// Make a row from the stored columns, looking up the name and working out `end`
+    fn make_row(&self, id: usize, code: FieldType, start: FieldType, delta: FieldType) -> Row {
+        let name = match code {
+            FieldType::Code(c) => self.dictionary.name(c).unwrap_or_default().to_string(),
+            other => other.to_string(),
+        };
 
-            index += 1;
-        }
+        let (start, delta) = match (start, delta) {
+            (FieldType::Epoch(s), FieldType::Epoch(d)) => (s, d),
+            _ => unreachable!(),
+        };
 
-        all
+        Row::new(
+            id,
+            vec![
+                FieldType::Name(name),
+                FieldType::Epoch(start),
+                FieldType::Epoch(start + delta),
+                FieldType::Epoch(delta),
+            ],
+        )
     }
 
-    pub fn fetch_all_as_list<'py>(&mut self, py: Python<'py>) -> Vec<Bound<'py, PyList>> {
-        let a = self.fetch_all().into_iter().map(|x| x.to_list(py));
-        let rows_dict: Vec<Bound<'py, PyList>> = a.collect();
-        rows_dict
+    /// Get the key of `name` in the name index, if it has ever been captured
+    fn name_key(&self, name: &str) -> Option<FieldType> {
+        self.dictionary.code(name).map(FieldType::Code)
     }
 
-    pub fn logs<'py>(&mut self, py: Python<'py>) -> Vec<Bound<'py, PyList>> {
-        self.fetch_all_as_list(py)
-    }
+    /// Get the row with ID `index`, if it has been written
+    fn fetch_row(&self, index: usize) -> Option<Row> {
+        if index < self.first_row || index >= self.row_count() {
+            return None;
+        }
 
-    pub fn get_function_names(&mut self) -> HashSet<String> {
-        let db_instance = self.get_instance();
+        let code = self.columns[NAME_COLUMN].fetch(index)?;
+        let start = self.columns[START_COLUMN].fetch(index)?;
+        let delta = self.columns[DELTA_COLUMN].fetch(index)?;
 
-        let db = db_instance.read().unwrap();
+        Some(self.make_row(index, code, start, delta))
+    }
 
-        let mut function_names = HashSet::new();
-        let keys: Vec<&FieldType> = db.name_index.index.keys().into_iter().collect();
+    /// Get up to `limit` rows with IDs from `since` on, only of the function with `code` if it
+    /// is given
+    fn fetch_since(&self, since: usize, limit: usize, code: Option<u32>) -> Vec<Row> {
+        match code {
+            None => self.fetch_batch(since, since.saturating_add(limit)),
+            Some(code) => {
+                // The IDs of a name are in order, so the first one from `since` on is found with a
+                // binary search over the chunks of its posting list
+                self.name_index
+                    .ids_from(&FieldType::Code(code), since)
+                    .take(limit)
+                    .filter_map(|id| self.fetch_row(id))
+                    .collect()
+            }
+        }
+    }
 
-        for key in keys {
-            function_names.insert(key.to_string());
+    /// Get rows `from` up to `to`, reading each column from start to end instead of going row by
+    /// row
+    fn fetch_batch(&self, from: usize, to: usize) -> Vec<Row> {
+        let from = from.max(self.first_row);
+        let to = to.min(self.row_count());
+        let count = to.saturating_sub(from);
+
+        let mut columns: Vec<Vec<FieldType>> = vec![];
+        for col in &self.columns {
+            let mut values = Vec::with_capacity(count);
+            col.scan(from, to, |_, field| values.push(field));
+            columns.push(values);
         }
 
-        function_names
+        let deltas = columns.pop().expect("Should have delta column.");
+        let starts = columns.pop().expect("Should have start column.");
+        let codes = columns.pop().expect("Should have name column.");
+
+        codes
+            .into_iter()
+            .zip(starts)
+            .zip(deltas)
+            .enumerate()
+            .map(|(i, ((code, start), delta))| self.make_row(from + i, code, start, delta))
+            .collect()
     }
 
-    /// Find the average time a function took to run
-    pub fn average(&mut self, function_name: &str) -> Option<f64> {
-        let name_bytes = create_function_name(function_name);
+    /// Get the rows that started from `start` up to `end`, only of the function with `code` if
+    /// it is given
+    ///
+    /// Only the blocks whose zone maps overlap the range are read from each column.
+    fn fetch_range(&self, start: Epoch, end: Epoch, code: Option<u32>) -> Vec<Row> {
+        let mut rows = vec![];
 
-        let db_instance = self.get_instance();
+        for (from, to) in self.columns[START_COLUMN].zone_ranges(start, end) {
+            let from = from.max(self.first_row);
+            let to = to.min(self.row_count());
 
-        let db = db_instance.read().unwrap();
-        if let Some(avg) = db.name_index.get_average(FieldType::Name(name_bytes)) {
-            info!("Using amortized const average!");
-            return Some(avg);
-        }
+            if from >= to {
+                continue;
+            }
 
-        info!("Manually calculating average!");
+            let mut starts = Vec::with_capacity(to.saturating_sub(from));
+            self.columns[START_COLUMN].scan(from, to, |i, f| {
+                if let FieldType::Epoch(s) = f {
+                    if s >= start && s < end {
+                        starts.push((i, f));
+                    }
+                }
+            });
 
-        // Get the IDs we need to fetch
-        let ids = {
-            let db = db_instance.read().unwrap();
-            db.name_index.get(FieldType::Name(name_bytes))
-        };
+            if starts.is_empty() {
+                continue;
+            }
 
-        if let Some(ids) = ids {
-            let mut values = vec![];
+            let mut codes = Vec::with_capacity(to - from);
+            self.columns[NAME_COLUMN].scan(from, to, |_, f| codes.push(f));
 
-            for id in &ids {
-                if let Some(row) = self.fetch(*id) {
-                    let delta_index = 3;
+            let mut deltas = Vec::with_capacity(to - from);
+            self.columns[DELTA_COLUMN].scan(from, to, |_, f| deltas.push(f));
 
-                    let fs = row.fields;
-                    if fs.len() > delta_index {
-                        let f = fs[delta_index].clone();
+            for (i, s) in starts {
+                let c = codes[i - from].clone();
 
-                        match f {
-                            FieldType::Epoch(e) => values.push(e),
-                            _ => {}
-                        }
-                    }
+                if code.is_some_and(|code| c != FieldType::Code(code)) {
+                    continue;
                 }
-            }
 
-            if !values.is_empty() {
-                let sum: u128 = values.iter().sum();
-                let avg = sum as f64 / values.len() as f64;
-                return Some(avg);
+                rows.push(self.make_row(i, c, s, deltas[i - from].clone()));
             }
-        } else {
-            warn!("Could not get IDs");
         }
 
-        None
+        rows
     }
-}
 
-#[pyfunction]
-pub fn database_init() {
-    thread::spawn(|| {
-        let mut db = Database::new(false);
-        db.init();
-    });
+    /// How many rows there are from the first one retention kept on
+    fn kept_rows(&self) -> usize {
+        self.row_count().saturating_sub(self.first_row)
+    }
+
+    /// Write the values of column `col` from the first row that is kept on into `out` as little
+    /// endian integers of `width` bytes
+    ///
+    /// Values too big for `width` bytes are written as the largest value that fits.
+    fn write_column(&self, col: usize, width: usize, out: &mut [u8]) {
+        let from = self.first_row;
+        let count = out.len() / width;
+
+        self.columns[col].scan(from, from + count, |i, f| {
+            let value = match f {
+                FieldType::Epoch(e) => e,
+                FieldType::Code(c) => c as u128,
+                FieldType::Name(_) => 0,
+            };
+
+            let largest = u128::MAX >> (128 - width * 8);
+            let bytes = value.min(largest).to_le_bytes();
+            let at = (i - from) * width;
+            out[at..at + width].copy_from_slice(&bytes[..width]);
+        });
+    }
+
+    /// Consume anything left in the queue and write all dirty pages to disk
+    fn flush(&mut self, queue: &KQueue) {
+        self.consume_capture(queue);
+
+        if self.wal.as_ref().is_some_and(|wal| wal.rows() > 0) {
+            self.checkpoint();
+        } else {
+            self.bufferpool.write().unwrap().flush();
+        }
+
+        if self.name_index.rows != self.index_checkpoint {
+            self.checkpoint_index();
+        }
+    }
+}
+
+// Separate singleton instances for sync and async modes
+static DATABASE_SYNC: OnceLock<Arc<RwLock<DatabaseInner>>> = OnceLock::new();
+static DATABASE_ASYNC: OnceLock<Arc<RwLock<DatabaseInner>>> = OnceLock::new();
+
+// The capture queues live outside of the database lock so capturing never waits for a write
+static QUEUE_SYNC: OnceLock<KQueue> = OnceLock::new();
+static QUEUE_ASYNC: OnceLock<KQueue> = OnceLock::new();
+
+// Shared queue state using atomic bools - one for each database type
+static QUEUE_HAS_DATA_SYNC: AtomicBool = AtomicBool::new(false);
+static QUEUE_HAS_DATA_ASYNC: AtomicBool = AtomicBool::new(false);
+
+// The consumer thread sleeps on a condvar until a capture wakes it up, so it uses no CPU while
+// nothing is being captured. Capturing only touches the mutex for the first capture after the
+// queue was drained and when a full batch is waiting, every other capture is just the push.
+//
+// Once woken, the consumer waits up to the consumer delay for more captures to arrive so that
+// they get written together. If a whole batch of captures is waiting it writes right away.
+
+/// Wakes the consumer thread when there are captures for it to write
+pub struct ConsumerSignal {
+    lock: Mutex<()>,
+    condvar: Condvar,
+}
+
+impl ConsumerSignal {
+    pub const fn new() -> Self {
+        ConsumerSignal {
+            lock: Mutex::new(()),
+            condvar: Condvar::new(),
+        }
+    }
+
+    pub fn notify(&self) {
+        // Taking the lock makes sure the consumer is either waiting or has not checked yet
+        let _guard = self.lock.lock().unwrap();
+        self.condvar.notify_one();
+    }
+
+    /// Sleep until `has_data` is set
+    pub fn wait_for_data(&self, has_data: &AtomicBool) {
+        let mut guard = self.lock.lock().unwrap();
+
+        while !has_data.load(Ordering::SeqCst) {
+            guard = self.condvar.wait(guard).unwrap();
+        }
+    }
+
+    /// Sleep until `batch_size` captures are in the queue or `delay` has passed
+    pub fn wait_for_batch(&self, queue: &KQueue, batch_size: usize, delay: Duration) {
+        let deadline = Instant::now() + delay;
+        let mut guard = self.lock.lock().unwrap();
+
+        while queue.len() < batch_size {
+            let now = Instant::now();
+            if now >= deadline {
+                break;
+            }
+
+            guard = self.condvar.wait_timeout(guard, deadline - now).unwrap().0;
+        }
+    }
+}
+
+static CONSUMER_SIGNAL_SYNC: ConsumerSignal = ConsumerSignal::new();
+static CONSUMER_SIGNAL_ASYNC: ConsumerSignal = ConsumerSignal::new();
+
+// When the oldest capture still in the sync queue was captured, in milliseconds since the epoch
+static PENDING_SINCE_SYNC: AtomicU64 = AtomicU64::new(0);
+
+// The `max_delay` of the handle that made the last sync capture, which the drainer waits for
+static MAX_DELAY_SYNC: AtomicU64 = AtomicU64::new(CONSUMER_DELAY);
+
+fn now_nanos() -> Epoch {
+    SystemTime::now()
+        .duration_since(UNIX_EPOCH)
+        .map(|d| d.as_nanos())
+        .unwrap_or(0)
+}
+
+fn now_millis() -> u64 {
+    SystemTime::now()
+        .duration_since(UNIX_EPOCH)
+        .map(|d| d.as_millis() as u64)
+        .unwrap_or(0)
+}
+
+/// Settings used when the database is opened
+///
+/// The database is shared by every `Database` handle in the process, so `extent_size`,
+/// `sync_interval`, `retention` and `cluster_by_name` only take effect for the handle that opens
+/// it first. `batch_size` and `max_delay` apply to the captures made through each handle.
+#[derive(Debug, Clone)]
+pub struct DatabaseConfig {
+    /// The size in bytes of the pages each column is stored in, from PAGE_SIZE up to 1MB
+    pub extent_size: usize,
+    /// How many captures are written together, from 1 up to QUEUE_CAPACITY
+    pub batch_size: usize,
+    /// The longest a capture waits before it is written, in milliseconds
+    pub max_delay: u64,
+    /// The longest the write-ahead log goes without being synced to disk, in milliseconds
+    pub sync_interval: u64,
+    /// How long rows and per minute rollups are kept
+    pub retention: Retention,
+    /// Also keep the deltas of the rows clustered by function, see `cluster.rs`
+    pub cluster_by_name: bool,
+}
+
+impl Default for DatabaseConfig {
+    fn default() -> Self {
+        DatabaseConfig {
+            extent_size: PAGE_SIZE,
+            batch_size: DB_WRITE_BUFFER_SIZE,
+            max_delay: CONSUMER_DELAY,
+            sync_interval: WAL_SYNC_INTERVAL,
+            retention: Retention::default(),
+            cluster_by_name: false,
+        }
+    }
+}
+
+impl DatabaseConfig {
+    pub fn validate(&self) -> Result<(), String> {
+        if !Bufferpool::valid_extent_size(self.extent_size) {
+            return Err(format!(
+                "extent_size must be a power of two from {} to 1MB, got {}",
+                PAGE_SIZE, self.extent_size
+            ));
+        }
+
+        // A batch bigger than the queue would never fill up, and capture would wait forever
+        if self.batch_size == 0 || self.batch_size > QUEUE_CAPACITY {
+            return Err(format!(
+                "batch_size must be from 1 to {}, got {}",
+                QUEUE_CAPACITY, self.batch_size
+            ));
+        }
+
+        self.retention.validate()
+    }
+}
+
+/// The value of a delta as a u64, or the largest one if it does not fit
+fn delta_value(field: FieldType) -> u64 {
+    match field {
+        FieldType::Epoch(e) => u64::try_from(e).unwrap_or(u64::MAX),
+        _ => 0,
+    }
+}
+
+/// The ID of the first row of shard `shard`
+fn shard_base(shard: usize) -> usize {
+    shard << SHARD_ROW_BITS
+}
+
+/// Turn the row numbers of a shard into row IDs
+fn rebase(rows: &mut [Row], base: usize) {
+    for row in rows {
+        row.id += base;
+    }
+}
+
+/// One shard of the database, with the ID of its first row
+#[derive(Clone)]
+struct Shard {
+    base: usize,
+    db: Arc<RwLock<DatabaseInner>>,
+}
+
+/// Where a poll of `logs` starts
+#[derive(FromPyObject)]
+pub enum SinceId {
+    /// The rows with this ID or later
+    Id(usize),
+    /// The `high_water()` of the last poll, the next ID of each shard
+    Shards(Vec<usize>),
+}
+
+impl SinceId {
+    /// The first row of the shard whose first ID is `base` that comes after this
+    fn row_in(&self, base: usize) -> usize {
+        match self {
+            SinceId::Id(id) => id.saturating_sub(base),
+            // A shard that is not in it started after the poll, so all of its rows are new
+            SinceId::Shards(ids) => ids
+                .iter()
+                .find(|id| **id >> SHARD_ROW_BITS == base >> SHARD_ROW_BITS)
+                .map_or(0, |id| id - base),
+        }
+    }
+}
+
+/// Shards taken for reading, with the ID of the first row of each
+type ShardReads<'a> = [(usize, RwLockReadGuard<'a, DatabaseInner>)];
+
+// Reads go through every shard and merge what they get. Rows come shard by shard, and the stats,
+// sketches and rollups of a function are merged the same way the threads that build the index
+// merge theirs. Each shard has its own name dictionary, so `names_by_code` and
+// `column("name_codes")` use codes of all of the names of every shard.
+
+/// Merge the stats of a function from every shard
+fn merged_stats(dbs: &ShardReads, function_name: &str) -> Option<Stats> {
+    let mut merged: Option<Stats> = None;
+
+    for (_, db) in dbs {
+        let stats = db
+            .name_key(function_name)
+            .and_then(|key| db.name_index.get_stats(key));
+
+        match (&mut merged, stats) {
+            (Some(m), Some(stats)) => m.merge(stats),
+            (None, Some(stats)) => merged = Some(stats.clone()),
+            _ => {}
+        }
+    }
+
+    merged
+}
+
+/// Merge the quantile sketch of a function from every shard
+fn merged_sketch(dbs: &ShardReads, function_name: &str) -> Option<Sketch> {
+    let mut merged: Option<Sketch> = None;
+
+    for (_, db) in dbs {
+        let sketch = db
+            .name_key(function_name)
+            .and_then(|key| db.name_index.get_sketch(key));
+
+        match (&mut merged, sketch) {
+            (Some(m), Some(sketch)) => m.merge(sketch),
+            (None, Some(sketch)) => merged = Some(sketch.clone()),
+            _ => {}
+        }
+    }
+
+    merged
+}
+
+/// Get every name of every shard, in the order they were first seen, and for each shard the
+/// code in that list of each of its own codes
+fn merged_names(dbs: &ShardReads) -> (Vec<String>, Vec<Vec<u32>>) {
+    let mut names: Vec<String> = vec![];
+    let mut codes: HashMap<String, u32> = HashMap::new();
+
+    let maps = dbs
+        .iter()
+        .map(|(_, db)| {
+            (0..db.dictionary.len() as u32)
+                .map(|code| {
+                    let name = db.dictionary.name(code).unwrap_or_default();
+
+                    *codes.entry(name.to_string()).or_insert_with(|| {
+                        names.push(name.to_string());
+                        names.len() as u32 - 1
+                    })
+                })
+                .collect()
+        })
+        .collect();
+
+    (names, maps)
+}
+
+#[pyclass]
+pub struct Database {
+    sync_consume: bool,
+    config: DatabaseConfig,
+    /// The shards of a reader from `new_reader`, which are its own instead of the shared database
+    readers: Vec<Shard>,
+}
+
+impl Database {
+    pub fn new(sync_consume: bool) -> Self {
+        Database::with_config(sync_consume, DatabaseConfig::default())
+    }
+
+    pub fn with_config(sync_consume: bool, config: DatabaseConfig) -> Self {
+        info!(
+            "Creating Database with sync_consume={} and {:?}",
+            sync_consume, config
+        );
+        Database {
+            sync_consume,
+            config,
+            readers: vec![],
+        }
+    }
+
+    /// Get the database this process writes to
+    fn get_instance(&self) -> Arc<RwLock<DatabaseInner>> {
+        if self.sync_consume {
+            DATABASE_SYNC
+                .get_or_init(|| {
+                    info!("Creating sync DatabaseInner with sync_consume=true");
+                    let db = Arc::new(RwLock::new(DatabaseInner::new(true, &self.config)));
+                    DatabaseInner::start_checkpointer(&db);
+                    Database::start_sync_drainer(&db);
+                    db
+                })
+                .clone()
+        } else {
+            DATABASE_ASYNC
+                .get_or_init(|| {
+                    info!("Creating async DatabaseInner with sync_consume=false");
+                    let db = Arc::new(RwLock::new(DatabaseInner::new(false, &self.config)));
+                    DatabaseInner::start_checkpointer(&db);
+                    db
+                })
+                .clone()
+        }
+    }
+
+    /// Spawn the thread that writes a partial group of sync captures once it has waited for
+    /// `max_delay`
+    ///
+    /// Sync captures are otherwise only written by a capture, so without it the last captures
+    /// before a quiet spell would wait for the next capture or a flush. It sleeps on the sync
+    /// consumer signal while the queue is empty.
+    fn start_sync_drainer(db: &Arc<RwLock<DatabaseInner>>) {
+        let weak = Arc::downgrade(db);
+
+        thread::spawn(move || loop {
+            CONSUMER_SIGNAL_SYNC.wait_for_data(&QUEUE_HAS_DATA_SYNC);
+
+            let delay = MAX_DELAY_SYNC.load(Ordering::SeqCst);
+            let waited = now_millis().saturating_sub(PENDING_SINCE_SYNC.load(Ordering::SeqCst));
+            if waited < delay {
+                thread::sleep(Duration::from_millis(delay - waited));
+                continue;
+            }
+
+            let Some(db) = weak.upgrade() else {
+                break;
+            };
+
+            // A capture might have written the group while this one slept
+            if QUEUE_HAS_DATA_SYNC.swap(false, Ordering::SeqCst) {
+                info!("Writing sync captures that waited for max_delay");
+                let queue = QUEUE_SYNC.get_or_init(KQueue::new);
+                db.write().unwrap().consume_capture(queue);
+            }
+        });
+    }
+
+    /// Get the shards reads go through, every one for a reader and the one this process writes
+    /// to for anything else
+    fn get_shards(&self) -> Vec<Shard> {
+        if !self.readers.is_empty() {
+            return self.readers.clone();
+        }
+
+        let db = self.get_instance();
+        let base = shard_base(db.read().unwrap().shard);
+
+        vec![Shard { base, db }]
+    }
+
+    /// Get up to `limit` rows from `since_id` on, only of the function `name` if it is given
+    fn fetch_logs(
+        &self,
+        since_id: Option<&SinceId>,
+        limit: Option<usize>,
+        name: Option<&str>,
+    ) -> Vec<Row> {
+        let shards = self.get_shards();
+        let mut remaining = limit.unwrap_or(usize::MAX);
+
+        let mut rows = vec![];
+        for (base, db) in &Database::read_shards(&shards) {
+            if remaining == 0 {
+                break;
+            }
+
+            let code = match name {
+                Some(name) => match db.dictionary.code(name) {
+                    Some(code) => Some(code),
+                    None => continue,
+                },
+                None => None,
+            };
+
+            let since = since_id.map_or(0, |s| s.row_in(*base));
+            let mut shard_rows = db.fetch_since(since, remaining, code);
+            rebase(&mut shard_rows, *base);
+
+            remaining -= shard_rows.len();
+            rows.append(&mut shard_rows);
+        }
+
+        rows
+    }
+
+    fn read_shards(shards: &[Shard]) -> Vec<(usize, RwLockReadGuard<'_, DatabaseInner>)> {
+        shards
+            .iter()
+            .map(|s| (s.base, s.db.read().unwrap()))
+            .collect()
+    }
+
+    fn get_queue(&self) -> &'static KQueue {
+        if self.sync_consume {
+            QUEUE_SYNC.get_or_init(KQueue::new)
+        } else {
+            QUEUE_ASYNC.get_or_init(KQueue::new)
+        }
+    }
+
+    fn get_queue_state(&self) -> &'static AtomicBool {
+        if self.sync_consume {
+            &QUEUE_HAS_DATA_SYNC
+        } else {
+            &QUEUE_HAS_DATA_ASYNC
+        }
+    }
+
+    fn get_consumer_signal(&self) -> &'static ConsumerSignal {
+        if self.sync_consume {
+            &CONSUMER_SIGNAL_SYNC
+        } else {
+            &CONSUMER_SIGNAL_ASYNC
+        }
+    }
+
+    fn check_for_data() {
+        if !Database::exists() {
+            eprintln!("Database does not exist at \"{}\".", &DATA_DIRECTORY);
+            std::process::exit(0);
+        }
+    }
+}
+
+#[pymethods]
+impl Database {
+    #[new]
+    #[pyo3(signature = (
+        sync_consume = false,
+        extent_size = PAGE_SIZE,
+        batch_size = DB_WRITE_BUFFER_SIZE,
+        max_delay = CONSUMER_DELAY,
+        sync_interval = WAL_SYNC_INTERVAL,
+        retention_days = None,
+        minute_retention_days = None,
+        cluster_by_name = false
+    ))]
+    fn py_new(
+        sync_consume: bool,
+        extent_size: usize,
+        batch_size: usize,
+        max_delay: u64,
+        sync_interval: u64,
+        retention_days: Option<u64>,
+        minute_retention_days: Option<u64>,
+        cluster_by_name: bool,
+    ) -> PyResult<Self> {
+        let config = DatabaseConfig {
+            extent_size,
+            batch_size,
+            max_delay,
+            sync_interval,
+            retention: Retention {
+                raw_days: retention_days,
+                minute_days: minute_retention_days,
+            },
+            cluster_by_name,
+        };
+
+        config.validate().map_err(PyValueError::new_err)?;
+
+        Ok(Database::with_config(sync_consume, config))
+    }
+
+    pub fn init(&mut self) {
+        if self.is_reader() {
+            warn!("A reader does not write, so it has nothing to consume");
+            return;
+        }
+
+        let db_instance = self.get_instance();
+        let queue = self.get_queue();
+        let queue_state = self.get_queue_state();
+        let signal = self.get_consumer_signal();
+        let delay = Duration::from_millis(self.config.max_delay);
+
+        info!("Called init!");
+        loop {
+            // Park until a capture comes in
+            signal.wait_for_data(queue_state);
+
+            // Give more captures a chance to come in so they are written together
+            signal.wait_for_batch(queue, self.config.batch_size, delay);
+
+            info!("Running consume.");
+
+            // Mark the queue as processed before draining it. A capture that comes in while the
+            // consume is running sets it again and wakes this thread for another round.
+            queue_state.store(false, Ordering::SeqCst);
+
+            let mut db = db_instance.write().unwrap();
+            db.consume_capture(queue);
+        }
+    }
+
+    #[staticmethod]
+    pub fn exists() -> bool {
+        Path::new(&DATA_DIRECTORY).exists()
+    }
+
+    /// Open the database read only, for a process other than the ones capturing
+    ///
+    /// The reader reads every shard, so it sees the rows of every worker process, but only the
+    /// rows each writer has published. It never writes to the data directory. Call `refresh` to
+    /// see rows published since it was opened. `sync_consume` is only kept so older callers
+    /// still work.
+    #[staticmethod]
+    #[pyo3(signature = (sync_consume = false))]
+    pub fn new_reader(sync_consume: bool) -> Self {
+        info!(
+            "Creating Database reader with sync_consume={}",
+            sync_consume
+        );
+
+        let mut db = Database::new(sync_consume);
+        db.readers = list_shards()
+            .into_iter()
+            .map(|shard| Shard {
+                base: shard_base(shard),
+                db: Arc::new(RwLock::new(DatabaseInner::open_reader(shard))),
+            })
+            .collect();
+        db
+    }
+
+    /// Check if this is a read only handle from `new_reader`
+    pub fn is_reader(&self) -> bool {
+        !self.readers.is_empty()
+    }
+
+    /// Move a reader up to the rows the writers have published since it last looked, returning
+    /// how many new rows it can see
+    ///
+    /// This also opens the shards of worker processes that started since. Handles that are not
+    /// readers already see every row of their shard, so this is always 0 for them.
+    pub fn refresh(&mut self) -> usize {
+        if !self.is_reader() {
+            return 0;
+        }
+
+        let mut new_rows: usize = self
+            .readers
+            .iter()
+            .map(|s| s.db.write().unwrap().refresh())
+            .sum();
+
+        for shard in list_shards() {
+            let base = shard_base(shard);
+
+            if self.readers.iter().any(|s| s.base == base) {
+                continue;
+            }
+
+            let db = DatabaseInner::open_reader(shard);
+            new_rows += db.row_count();
+
+            self.readers.push(Shard {
+                base,
+                db: Arc::new(RwLock::new(db)),
+            });
+        }
+
+        self.readers.sort_by_key(|s| s.base);
+        new_rows
+    }
+
+    fn clear(&mut self) {
+        // Should match the hard coded value
+        assert_eq!(DATA_DIRECTORY, ".kronicler_data");
+
+        fs::remove_dir_all(DATA_DIRECTORY)
+            .expect(&format!("Could not remove directory '{}'.", DATA_DIRECTORY));
+
+        info!("Removed data directory at '{}'!", DATA_DIRECTORY);
+    }
+
+    #[staticmethod]
+    fn create_data_dir() {
+        fs::create_dir_all(DATA_DIRECTORY)
+            .expect(&format!("Could not create directory '{}'.", DATA_DIRECTORY));
+
+        info!("Created data directory at '{}'!", DATA_DIRECTORY);
+    }
+
+    /// Write all captured data to disk now instead of waiting for the background flusher
+    pub fn flush(&mut self) {
+        if self.is_reader() {
+            return;
+        }
+
+        let db_instance = self.get_instance();
+        let mut db = db_instance.write().unwrap();
+
+        db.flush(self.get_queue());
+
+        // Nothing is left in the queue after a flush
+        self.get_queue_state().store(false, Ordering::Relaxed);
+    }
+
+    /// Drop the rows and per minute rollups that are older than `retention_days` and
+    /// `minute_retention_days` right away, returning how many rows were dropped
+    ///
+    /// This is otherwise done in the background every minute. Nothing is dropped if neither was
+    /// set when the database was opened, or for a reader.
+    pub fn apply_retention(&mut self) -> usize {
+        if self.is_reader() {
+            return 0;
+        }
+
+        let db_instance = self.get_instance();
+        let mut db = db_instance.write().unwrap();
+
+        db.apply_retention(now_nanos())
+    }
+
+    /// Compress the full segments of each column that are not sealed yet right away, returning
+    /// how many were sealed
+    ///
+    /// This is otherwise done in the background within a second of a segment filling up. A
+    /// reader never seals anything.
+    pub fn compact(&self) -> usize {
+        if self.is_reader() {
+            return 0;
+        }
+
+        let db_instance = self.get_instance();
+        let jobs = db_instance.read().unwrap().seal_jobs();
+
+        jobs.into_iter().map(SealJob::run).sum()
+    }
+
+    /// Set how many pages the bufferpool can keep in memory, across all columns
+    ///
+    /// Each shard of a reader has its own bufferpool with this limit.
+    pub fn set_page_limit(&mut self, limit: usize) {
+        let shards = self.get_shards();
+
+        for (_, db) in &Database::read_shards(&shards) {
+            db.bufferpool.write().unwrap().set_page_limit(limit);
+        }
+    }
+
+    /// Get the bufferpool counters, as `hits`, `misses`, `evictions`, `pages` and `page_limit`,
+    /// added up over the shards
+    pub fn cache_stats(&self) -> HashMap<String, usize> {
+        let shards = self.get_shards();
+
+        let mut stats = HashMap::new();
+        for (_, db) in &Database::read_shards(&shards) {
+            let bp = db.bufferpool.read().unwrap();
+
+            for (key, value) in [
+                ("hits", bp.hit_count()),
+                ("misses", bp.miss_count()),
+                ("evictions", bp.eviction_count()),
+                ("pages", bp.size()),
+                ("page_limit", bp.page_limit()),
+            ] {
+                *stats.entry(key.to_string()).or_insert(0) += value;
+            }
+        }
+
+        stats
+    }
+
+    pub fn contains_name(&self, name: String) -> bool {
+        let shards = self.get_shards();
+        let dbs = Database::read_shards(&shards);
+
+        dbs.iter().any(|(_, db)| match db.name_key(&name) {
+            Some(key) => db.name_index.get(key).is_some(),
+            None => false,
+        })
+    }
+
+    /// Capture a function and write it to the queue
+    pub fn capture(&mut self, name: String, args: Vec<PyObject>, start: Epoch, end: Epoch) {
+        if self.is_reader() {
+            warn!("Dropping capture of {}, readers do not write", name);
+            return;
+        }
+
+        let db_instance = self.get_instance();
+        let queue = self.get_queue();
+        let queue_state = self.get_queue_state();
+
+        info!("Capturing with sync_consume={}", self.sync_consume);
+
+        // This does not take the database lock, so it only waits for the consumer if the queue is
+        // full. If it stays full the consumer might not be running, so the queue is written here
+        // the same way sync consume does.
+        let wait = Duration::from_millis(QUEUE_FULL_WAIT);
+        let mut pending = Capture::new(name, args, start, end);
+
+        while let Err(c) = queue.push_within(pending, wait) {
+            warn!("Capture queue is still full, writing it in this thread");
+
+            let mut db = db_instance.write().unwrap();
+            db.consume_capture(queue);
+            pending = c;
+        }
+
+        // Signal that queue has new data
+        let had_data = queue_state.swap(true, Ordering::SeqCst);
+        let batch_full = queue.len() >= self.config.batch_size;
+
+        if !self.sync_consume {
+            // Wake the consumer if it was not already awake or a whole batch is waiting
+            if !had_data || queue.len() == self.config.batch_size {
+                self.get_consumer_signal().notify();
+            }
+
+            return;
+        }
+
+        // Sync consume writes the queue as one group once a batch is full or the oldest capture
+        // has waited for max_delay. If no capture comes after it, the sync drainer writes it.
+        let now = now_millis();
+        MAX_DELAY_SYNC.store(self.config.max_delay, Ordering::SeqCst);
+
+        if !had_data {
+            PENDING_SINCE_SYNC.store(now, Ordering::SeqCst);
+            self.get_consumer_signal().notify();
+        }
+
+        let waited = now.saturating_sub(PENDING_SINCE_SYNC.load(Ordering::SeqCst));
+
+        if batch_full || waited >= self.config.max_delay {
+            info!("Performing synchronous consume");
+
+            // Mark as processed before the write so captures made meanwhile start a new group
+            queue_state.store(false, Ordering::SeqCst);
+
+            let mut db = db_instance.write().unwrap();
+            db.consume_capture(queue);
+        }
+    }
+
+    pub fn fetch(&self, index: usize) -> Option<Row> {
+        info!("Starting fetch on index {}", index);
+
+        let base = shard_base(index >> SHARD_ROW_BITS);
+        let shard = self.get_shards().into_iter().find(|s| s.base == base)?;
+        let db = shard.db.read().unwrap();
+
+        let mut row = db.fetch_row(index - base)?;
+        row.id = index;
+        Some(row)
+    }
+
+    pub fn fetch_all(&self) -> Vec<Row> {
+        let shards = self.get_shards();
+
+        let mut rows = vec![];
+        for (base, db) in &Database::read_shards(&shards) {
+            let mut shard_rows = db.fetch_batch(0, db.row_count());
+            rebase(&mut shard_rows, *base);
+            rows.append(&mut shard_rows);
+        }
+
+        rows
+    }
+
+    /// Go through the rows from `start_id` on in batches of `batch_size`
+    ///
+    /// Only one batch is read at a time, so this uses the same memory no matter how many rows
+    /// there are. Rows written after the scan starts are not included. A batch never has rows of
+    /// two shards, so the last batch of a shard can be smaller.
+    #[pyo3(signature = (batch_size = SCAN_BATCH_SIZE, start_id = 0))]
+    pub fn scan(&self, batch_size: usize, start_id: usize) -> PyResult<Scan> {
+        if batch_size == 0 {
+            return Err(PyValueError::new_err("batch_size must be at least 1"));
+        }
+
+        let parts = self
+            .get_shards()
+            .into_iter()
+            .map(|s| {
+                let (first_row, end) = {
+                    let db = s.db.read().unwrap();
+                    (db.first_row, db.row_count())
+                };
+
+                ScanPart {
+                    base: s.base,
+                    next_id: start_id.saturating_sub(s.base).max(first_row),
+                    end,
+                    db: s.db,
+                }
+            })
+            .collect();
+
+        Ok(Scan { parts, batch_size })
+    }
+
+    /// Get the rows of captures that started from `start` up to `end`, in nanoseconds since the
+    /// epoch, of only `name` if it is given
+    #[pyo3(signature = (start, end, name = None))]
+    pub fn fetch_range(&self, start: Epoch, end: Epoch, name: Option<String>) -> Vec<Row> {
+        let shards = self.get_shards();
+
+        let mut rows = vec![];
+        for (base, db) in &Database::read_shards(&shards) {
+            let code = match &name {
+                Some(name) => match db.dictionary.code(name) {
+                    Some(code) => Some(code),
+                    None => continue,
+                },
+                None => None,
+            };
+
+            let mut shard_rows = db.fetch_range(start, end, code);
+            rebase(&mut shard_rows, *base);
+            rows.append(&mut shard_rows);
+        }
+
+        rows
+    }
+
+    /// Get every value of a column as one `bytes` object, without making a Python object per row
+    ///
+    /// `"start"` and `"delta"` are little endian u64 nanoseconds and `"name_codes"` are little
+    /// endian u32 codes, in row order. The values are decoded into one new `bytes` object, and
+    /// `numpy.frombuffer(db.column("delta"), dtype="<u8")` reads it without copying it again.
+    pub fn column<'py>(&self, py: Python<'py>, name: &str) -> PyResult<Bound<'py, PyBytes>> {
+        let (col, width) = match name {
+            "start" => (START_COLUMN, 8),
+            "delta" => (DELTA_COLUMN, 8),
+            "name_codes" => (NAME_COLUMN, 4),
+            _ => {
+                return Err(PyValueError::new_err(format!(
+                    "column must be \"start\", \"delta\" or \"name_codes\", got \"{}\"",
+                    name
+                )))
+            }
+        };
+
+        let shards = self.get_shards();
+        let dbs = Database::read_shards(&shards);
+        let counts: Vec<usize> = dbs.iter().map(|(_, db)| db.kept_rows()).collect();
+
+        let code_maps = match col {
+            NAME_COLUMN if dbs.len() > 1 => Some(merged_names(&dbs).1),
+            _ => None,
+        };
+
+        // The column is decoded straight into the buffer of the bytes object
+        PyBytes::new_with(py, counts.iter().sum::<usize>() * width, |out| {
+            let mut at = 0;
+
+            for (i, (_, db)) in dbs.iter().enumerate() {
+                let part = &mut out[at..at + counts[i] * width];
+                db.write_column(col, width, part);
+
+                // Each shard has its own codes, so they are changed to the merged ones
+                if let Some(maps) = &code_maps {
+                    for value in part.chunks_exact_mut(width) {
+                        let code = u32::from_le_bytes(value.try_into().unwrap());
+                        let merged = maps[i].get(code as usize).copied().unwrap_or(code);
+                        value.copy_from_slice(&merged.to_le_bytes());
+                    }
+                }
+
+                at += counts[i] * width;
+            }
+
+            Ok(())
+        })
+    }
+
+    /// Get the deltas of every row of `function_name` as one `bytes` object of little endian u64
+    /// nanoseconds, in row order within each shard
+    ///
+    /// With `cluster_by_name` most of them are read from the cluster runs in one go instead of
+    /// row by row.
+    pub fn deltas<'py>(&self, py: Python<'py>, function_name: &str) -> Bound<'py, PyBytes> {
+        let shards = self.get_shards();
+        let dbs = Database::read_shards(&shards);
+
+        let mut out = vec![];
+        for (_, db) in &dbs {
+            if let Some(code) = db.dictionary.code(function_name) {
+                db.write_deltas(code, &mut out);
+            }
+        }
+
+        PyBytes::new(py, &out)
+    }
+
+    /// Get the names that the codes from `column("name_codes")` stand for, where the name at
+    /// position `i` has code `i`
+    pub fn names_by_code(&self) -> Vec<String> {
+        let shards = self.get_shards();
+        let dbs = Database::read_shards(&shards);
+
+        merged_names(&dbs).0
+    }
+
+    pub fn fetch_all_as_list<'py>(&self, py: Python<'py>) -> Vec<Bound<'py, PyList>> {
+        let a = self.fetch_all().into_iter().map(|x| x.to_list(py));
+        let rows_dict: Vec<Bound<'py, PyList>> = a.collect();
+        rows_dict
+    }
+
+    /// Get rows as lists for the `/logs` route
+    ///
+    /// With `since_id`, only new rows are returned: a dashboard passes the `high_water()` of its
+    /// last poll, which has the next ID of each shard, and gets the rows written since in every
+    /// shard. A single ID returns the rows with that ID or later. `limit` caps how many rows are
+    /// returned, oldest first, and `name` keeps only the rows of one function.
+    #[pyo3(signature = (since_id = None, limit = None, name = None))]
+    pub fn logs<'py>(
+        &self,
+        py: Python<'py>,
+        since_id: Option<SinceId>,
+        limit: Option<usize>,
+        name: Option<String>,
+    ) -> Vec<Bound<'py, PyList>> {
+        if since_id.is_none() && limit.is_none() && name.is_none() {
+            return self.fetch_all_as_list(py);
+        }
+
+        self.fetch_logs(since_id.as_ref(), limit, name.as_deref())
+            .into_iter()
+            .map(|row| row.to_list(py))
+            .collect()
+    }
+
+    /// Get the next ID of each shard, in shard order, which is where new rows start
+    ///
+    /// Pass it as `since_id` to `logs` to get only the rows written after this call. With one
+    /// shard it is one ID, the number of rows that have been written.
+    pub fn high_water(&self) -> Vec<usize> {
+        let shards = self.get_shards();
+        let dbs = Database::read_shards(&shards);
+
+        dbs.iter().map(|(base, db)| base + db.row_count()).collect()
+    }
+
+    pub fn get_function_names(&self) -> HashSet<String> {
+        let shards = self.get_shards();
+
+        let mut function_names = HashSet::new();
+        for (_, db) in &Database::read_shards(&shards) {
+            let keys: Vec<&FieldType> = db.name_index.index.keys().into_iter().collect();
+
+            for key in keys {
+                if let FieldType::Code(code) = key {
+                    if let Some(name) = db.dictionary.name(*code) {
+                        function_names.insert(name.to_string());
+                    }
+                }
+            }
+        }
+
+        function_names
+    }
+
+    /// Get the stats of how long a function took to run, without reading any rows
+    ///
+    /// Returns `count`, `sum`, `min`, `max`, `mean`, `variance`, `std_dev` and `std_error`, all
+    /// in nanoseconds, or None if the function has never been captured.
+    pub fn stats(&self, function_name: &str) -> Option<HashMap<String, f64>> {
+        let shards = self.get_shards();
+        let s = merged_stats(&Database::read_shards(&shards), function_name)?;
+
+        let mut stats = HashMap::new();
+        stats.insert("count".to_string(), s.count as f64);
+        stats.insert("sum".to_string(), s.sum as f64);
+        stats.insert("min".to_string(), s.min as f64);
+        stats.insert("max".to_string(), s.max as f64);
+        stats.insert("mean".to_string(), s.mean);
+        stats.insert("variance".to_string(), s.variance());
+        stats.insert("std_dev".to_string(), s.std_dev());
+        stats.insert("std_error".to_string(), s.std_error());
+
+        Some(stats)
+    }
+
+    /// Get the run time, in nanoseconds, that a fraction `q` of the calls of a function took at
+    /// most, like 0.95 for the p95
+    ///
+    /// This comes from the quantile sketch in the name index, so it does not read any rows and is
+    /// within 1% of the real value. Returns None if the function has never been captured.
+    pub fn percentile(&self, function_name: &str, q: f64) -> PyResult<Option<f64>> {
+        Ok(self.percentiles(function_name, vec![q])?.map(|p| p[0]))
+    }
+
+    /// Get `percentile` for each fraction in `qs`, in the same order
+    pub fn percentiles(&self, function_name: &str, qs: Vec<f64>) -> PyResult<Option<Vec<f64>>> {
+        if let Some(q) = qs.iter().find(|q| !(0.0..=1.0).contains(*q)) {
+            return Err(PyValueError::new_err(format!(
+                "q must be from 0.0 to 1.0, got {}",
+                q
+            )));
+        }
+
+        let shards = self.get_shards();
+        let dbs = Database::read_shards(&shards);
+
+        let (sketch, stats) = match (
+            merged_sketch(&dbs, function_name),
+            merged_stats(&dbs, function_name),
+        ) {
+            (Some(sketch), Some(stats)) => (sketch, stats),
+            _ => return Ok(None),
+        };
+
+        // The smallest and largest values are known exactly, and the middle of a bucket can be
+        // past either of them
+        let (min, max) = (stats.min as f64, stats.max as f64);
+
+        let values = qs
+            .iter()
+            .filter_map(|&q| match q {
+                0.0 => Some(min),
+                1.0 => Some(max),
+                _ => sketch.quantile(q).map(|v| v.clamp(min, max)),
+            })
+            .collect();
+
+        Ok(Some(values))
+    }
+
+    /// Get the per `granularity` stats of a function for the buckets that overlap `start` up to
+    /// `end`, in nanoseconds
+    ///
+    /// `granularity` is "minute", "hour" or "day". Each bucket is
+    /// `(bucket_start, count, sum, min, max)`, in order, and buckets with no calls are left out.
+    pub fn rollup(
+        &self,
+        function_name: &str,
+        granularity: &str,
+        start: Epoch,
+        end: Epoch,
+    ) -> PyResult<Vec<(Epoch, u64, Epoch, Epoch, Epoch)>> {
+        let granularity = Granularity::from_name(granularity).ok_or_else(|| {
+            PyValueError::new_err(format!(
+                "granularity must be \"minute\", \"hour\" or \"day\", got \"{}\"",
+                granularity
+            ))
+        })?;
+
+        let shards = self.get_shards();
+
+        // The same bucket can be in more than one shard
+        let mut buckets: BTreeMap<Epoch, RollupPoint> = BTreeMap::new();
+        for (_, db) in &Database::read_shards(&shards) {
+            let code = match db.dictionary.code(function_name) {
+                Some(code) => code,
+                None => continue,
+            };
+
+            for (time, p) in db.rollups.query(code, granularity, start, end) {
+                match buckets.get_mut(&time) {
+                    Some(point) => point.merge(&p),
+                    None => {
+                        buckets.insert(time, p);
+                    }
+                }
+            }
+        }
+
+        let points = buckets
+            .into_iter()
+            .map(|(time, p)| (time, p.count, p.sum, p.min, p.max))
+            .collect();
+
+        Ok(points)
+    }
+
+    /// Find the average time a function took to run
+    pub fn average(&self, function_name: &str) -> Option<f64> {
+        let shards = self.get_shards();
+        let dbs = Database::read_shards(&shards);
+
+        merged_stats(&dbs, function_name).map(|s| s.mean)
+    }
+}
+
+/// The rows of one shard that a `Scan` has not gone through yet
+struct ScanPart {
+    base: usize,
+    db: Arc<RwLock<DatabaseInner>>,
+    next_id: usize,
+    end: usize,
+}
+
+/// Iterator over the rows of the database in batches, made by `Database.scan`
+///
+/// The database lock is only held while each batch is read, so captures can be written between
+/// batches.
+#[pyclass]
+pub struct Scan {
+    parts: VecDeque<ScanPart>,
+    batch_size: usize,
+}
+
+impl Iterator for Scan {
+    type Item = Vec<Row>;
+
+    fn next(&mut self) -> Option<Vec<Row>> {
+        while let Some(part) = self.parts.front_mut() {
+            if part.next_id >= part.end {
+                self.parts.pop_front();
+                continue;
+            }
+
+            let to = part.end.min(part.next_id + self.batch_size);
+            let mut rows = part.db.read().unwrap().fetch_batch(part.next_id, to);
+            rebase(&mut rows, part.base);
+            part.next_id = to;
+
+            return Some(rows);
+        }
+
+        None
+    }
+}
+
+#[pymethods]
+impl Scan {
+    fn __iter__(slf: PyRef<'_, Self>) -> PyRef<'_, Self> {
+        slf
+    }
+
+    fn __next__(mut slf: PyRefMut<'_, Self>) -> Option<Vec<Row>> {
+        slf.next()
+    }
+}
+
+#[pyfunction]
+#[pyo3(signature = (batch_size = CONSUME_BATCH_SIZE, max_delay = CONSUMER_DELAY))]
+pub fn database_init(batch_size: usize, max_delay: u64) -> PyResult<()> {
+    let config = DatabaseConfig {
+        batch_size,
+        max_delay,
+        ..DatabaseConfig::default()
+    };
+
+    config.validate().map_err(PyValueError::new_err)?;
+
+    thread::spawn(move || {
+        let mut db = Database::with_config(false, config);
+        db.init();
+    });
+
+    Ok(())
 }
 
 #[cfg(test)]
@@ -435,6 +2195,18 @@ mod tests {
         assert_eq!(avg, Some(150.5));
     }
 
+    #[test]
+    fn sync_flush_test() {
+        let mut db = Database::new(true);
+
+        db.capture("flushed".to_string(), vec![], 100, 200);
+        db.flush();
+
+        let db_instance = db.get_instance();
+        let inner = db_instance.read().unwrap();
+        assert_eq!(inner.bufferpool.read().unwrap().dirty_count(), 0);
+    }
+
     #[test]
     fn get_function_names() {
         let mut db = Database::new(true);
@@ -453,10 +2225,37 @@ mod tests {
         assert_eq!(db.get_function_names(), r);
     }
 
+    #[test]
+    fn page_cache_stats_test() {
+        let mut db = Database::new(true);
+
+        db.capture("cached".to_string(), vec![], 100, 200);
+        db.fetch(0);
+
+        let stats = db.cache_stats();
+        assert!(stats["hits"] > 0);
+        assert!(stats["pages"] <= stats["page_limit"]);
+    }
+
+    #[test]
+    fn scan_fetch_all_test() {
+        let mut db = Database::new(true);
+
+        db.capture("scanned".to_string(), vec![], 500, 800);
+
+        let all = db.fetch_all();
+        let last = all.last().unwrap();
+
+        assert_eq!(last.fields[0].to_string(), "scanned");
+        assert_eq!(last.fields[1], FieldType::Epoch(500));
+        assert_eq!(last.fields[3], FieldType::Epoch(300));
+        assert_eq!(db.fetch(last.id), Some(last.clone()));
+    }
+
     #[test]
     fn singleton_test() {
         let mut db1 = Database::new(true);
-        let mut db2 = Database::new(true);
+        let db2 = Database::new(true);
 
         // Data inserted through db1 should be visible through db2
         db1.capture("test".to_string(), vec![], 100, 200);
@@ -502,4 +2301,892 @@ mod tests {
         queue_state.store(false, Ordering::Relaxed);
         assert!(!db2.get_queue_state().load(Ordering::Relaxed));
     }
+
+    #[test]
+    fn consumer_signal_wakes_waiting_thread_test() {
+        let signal = Arc::new(ConsumerSignal::new());
+        let has_data = Arc::new(AtomicBool::new(false));
+
+        let waiter = {
+            let signal = Arc::clone(&signal);
+            let has_data = Arc::clone(&has_data);
+            thread::spawn(move || signal.wait_for_data(&has_data))
+        };
+
+        thread::sleep(Duration::from_millis(20));
+        assert!(!waiter.is_finished());
+
+        has_data.store(true, Ordering::SeqCst);
+        signal.notify();
+
+        waiter.join().unwrap();
+    }
+
+    #[test]
+    fn consumer_signal_batch_wait_test() {
+        let signal = ConsumerSignal::new();
+        let queue = KQueue::with_capacity(8);
+
+        // Nothing comes in, so this waits for the whole delay
+        let start = Instant::now();
+        signal.wait_for_batch(&queue, 2, Duration::from_millis(30));
+        assert!(start.elapsed() >= Duration::from_millis(30));
+
+        // A full batch is already waiting, so this returns right away
+        queue.capture("batch".to_string(), vec![], 1, 2);
+        queue.capture("batch".to_string(), vec![], 1, 2);
+
+        let start = Instant::now();
+        signal.wait_for_batch(&queue, 2, Duration::from_secs(10));
+        assert!(start.elapsed() < Duration::from_secs(10));
+    }
+
+    #[test]
+    fn read_only_reader_test() {
+        let mut db = Database::new(true);
+        db.capture("read_only_a".to_string(), vec![], 10, 25);
+        db.flush();
+
+        let mut reader = Database::new_reader(true);
+        assert!(reader.is_reader());
+        assert!(!db.is_reader());
+
+        // Everything was flushed, so it was all published
+        assert_eq!(reader.high_water(), db.high_water());
+        let mark = reader.high_water()[0];
+
+        let row = reader.fetch(mark - 1).unwrap();
+        assert_eq!(row.fields[0], FieldType::Name("read_only_a".to_string()));
+        assert_eq!(row.fields[3], FieldType::Epoch(15));
+
+        db.capture("read_only_b".to_string(), vec![], 30, 32);
+        db.capture("read_only_b".to_string(), vec![], 40, 42);
+
+        // The reader keeps what it saw until it refreshes
+        assert_eq!(reader.high_water(), [mark]);
+        assert!(reader.fetch(mark).is_none());
+
+        db.flush();
+        assert_eq!(reader.high_water(), [mark]);
+
+        assert_eq!(reader.refresh(), 2);
+        assert_eq!(reader.refresh(), 0);
+        assert_eq!(reader.high_water(), [mark + 2]);
+        assert!(reader.contains_name("read_only_b".to_string()));
+
+        let rows: Vec<Row> = reader.scan(10, mark).unwrap().flatten().collect();
+        assert_eq!(rows.len(), 2);
+        assert_eq!(rows[1].fields[1], FieldType::Epoch(40));
+
+        // A reader never writes
+        reader.capture("read_only_c".to_string(), vec![], 1, 2);
+        reader.flush();
+        assert_eq!(db.high_water(), [mark + 2]);
+        assert!(!db.contains_name("read_only_c".to_string()));
+        assert_eq!(db.refresh(), 0);
+    }
+
+    #[test]
+    fn retention_test() {
+        use crate::constants::ENCODED_BLOCK_ROWS;
+
+        let day = Granularity::Day.nanos();
+        let now = 30 * day;
+
+        let config = DatabaseConfig {
+            retention: Retention {
+                raw_days: Some(7),
+                minute_days: Some(1),
+            },
+            ..DatabaseConfig::default()
+        };
+
+        let (shard, lock) = claim_shard();
+        let mut db = DatabaseInner::open_writer(shard, Some(lock), &config);
+        let before = db.row_count();
+
+        // Two blocks of rows from 20 days ago, then one block from today
+        let queue = KQueue::with_capacity(4096);
+        for i in 0..2 * ENCODED_BLOCK_ROWS as u128 {
+            queue.capture(
+                "retention_old".to_string(),
+                vec![],
+                10 * day + i,
+                10 * day + i + 5,
+            );
+        }
+        for i in 0..ENCODED_BLOCK_ROWS as u128 {
+            queue.capture(
+                "retention_new".to_string(),
+                vec![],
+                now - day + i,
+                now - day + i + 9,
+            );
+        }
+        db.flush(&queue);
+
+        let rows = db.row_count();
+        let dropped = db.apply_retention(now);
+
+        // Only whole blocks with nothing newer before them are dropped
+        assert!(dropped > 0);
+        assert_eq!(db.first_row % ENCODED_BLOCK_ROWS, 0);
+        assert!(db.first_row <= before + 2 * ENCODED_BLOCK_ROWS);
+        assert_eq!(db.row_count(), rows);
+        assert_eq!(db.apply_retention(now), 0);
+
+        assert!(db.fetch_row(db.first_row - 1).is_none());
+        assert!(db.fetch_row(db.first_row).is_some());
+        assert_eq!(db.fetch_batch(0, rows).len(), rows - db.first_row);
+        assert_eq!(db.fetch_range(0, now, None).len(), rows - db.first_row);
+
+        let mut out = vec![0u8; db.kept_rows() * 8];
+        db.write_column(DELTA_COLUMN, 8, &mut out);
+        assert_eq!(
+            u64::from_le_bytes(out[out.len() - 8..].try_into().unwrap()),
+            9
+        );
+
+        // The stats still have every row, but the dropped ones can not be fetched
+        let old = db.name_key("retention_old").unwrap();
+        assert!(db.name_index.ids(&old).all(|id| id >= db.first_row));
+        assert!(db.name_index.get_stats(old).unwrap().count >= 2 * ENCODED_BLOCK_ROWS as u64);
+
+        // The minute rollups of 20 days ago are gone, the hours are not
+        let code = db.dictionary.code("retention_old").unwrap();
+        assert!(db
+            .rollups
+            .query(code, Granularity::Minute, 0, now)
+            .is_empty());
+        assert!(!db.rollups.query(code, Granularity::Hour, 0, now).is_empty());
+
+        // A reader and the next writer start from the same row
+        let first_row = db.first_row;
+        drop(db);
+
+        let reader = DatabaseInner::open_reader(shard);
+        assert_eq!(reader.first_row, first_row);
+        assert!(reader.fetch_row(first_row - 1).is_none());
+
+        let reopened = DatabaseInner::open_writer(shard, None, &config);
+        assert_eq!(reopened.first_row, first_row);
+
+        // The other tests that take a shard expect an empty one
+        drop(reader);
+        drop(reopened);
+        fs::remove_dir_all(get_shard_dir(shard)).unwrap();
+    }
+
+    #[test]
+    fn retention_reopen_test() {
+        use crate::constants::ENCODED_BLOCK_ROWS;
+
+        let day = Granularity::Day.nanos();
+        let now = 30 * day;
+
+        let config = DatabaseConfig {
+            retention: Retention {
+                raw_days: Some(7),
+                minute_days: None,
+            },
+            ..DatabaseConfig::default()
+        };
+
+        let (shard, lock) = claim_shard();
+        let mut db = DatabaseInner::open_writer(shard, Some(lock), &config);
+        let old_rows = 2 * ENCODED_BLOCK_ROWS;
+
+        let queue = KQueue::with_capacity(4096);
+        for i in 0..old_rows as u128 {
+            queue.capture(
+                "reopen_old".to_string(),
+                vec![],
+                10 * day + i,
+                10 * day + i + 5,
+            );
+        }
+        for i in 0..ENCODED_BLOCK_ROWS as u128 {
+            queue.capture("reopen_new".to_string(), vec![], now + i, now + i + 9);
+        }
+
+        // The columns are saved, but the index and rollups are not until INDEX_CHECKPOINT_ROWS
+        db.consume_capture(&queue);
+        db.checkpoint();
+        let index_path = DatabaseInner::get_index_path(&db.dir);
+        assert!(Index::load(&index_path).is_none());
+
+        assert!(db.apply_retention(now) > 0);
+        let rows = db.row_count();
+        assert_eq!(Index::load(&index_path).unwrap().rows, rows);
+        drop(db);
+
+        // The dropped rows are still in the stats and rollups after the database is opened again
+        let db = DatabaseInner::open_writer(shard, None, &config);
+        let old = db.name_key("reopen_old").unwrap();
+        assert_eq!(db.name_index.get_stats(old).unwrap().count, old_rows as u64);
+
+        let code = db.dictionary.code("reopen_old").unwrap();
+        let hours = db.rollups.query(code, Granularity::Hour, 0, now);
+        assert_eq!(
+            hours.iter().map(|(_, p)| p.count).sum::<u64>(),
+            old_rows as u64
+        );
+
+        drop(db);
+        fs::remove_dir_all(get_shard_dir(shard)).unwrap();
+    }
+
+    #[test]
+    fn cluster_test() {
+        let day = Granularity::Day.nanos();
+        let now = 30 * day;
+
+        let config = DatabaseConfig {
+            retention: Retention {
+                raw_days: Some(7),
+                minute_days: None,
+            },
+            cluster_by_name: true,
+            ..DatabaseConfig::default()
+        };
+
+        let (shard, lock) = claim_shard();
+        let mut db = DatabaseInner::open_writer(shard, Some(lock), &config);
+        db.cluster_rows = Some(1536);
+
+        // The first 1024 rows are old enough for retention to drop, which cuts the first run
+        let name = |i: usize| if i % 3 == 0 { "cluster_a" } else { "cluster_b" };
+        let queue = KQueue::with_capacity(4096);
+        for i in 0..3100 {
+            let start = if i < 1024 { 10 * day } else { now - day } + i as u128;
+            let delta = (i % 50 + 1) as u128;
+            queue.capture(name(i).to_string(), vec![], start, start + delta);
+        }
+        db.flush(&queue);
+
+        let expected = |from: usize| -> Vec<u8> {
+            (from..3100)
+                .filter(|i| name(*i) == "cluster_a")
+                .flat_map(|i| ((i % 50 + 1) as u64).to_le_bytes())
+                .collect()
+        };
+
+        // The same steps as the checkpointer
+        let cluster = |db: &mut DatabaseInner| match db.cluster_rows() {
+            Some((from, to, codes, deltas)) => {
+                let run = Clusters::write_run(&db.dir, from, to, &codes, &deltas);
+                db.clusters.push(run);
+                true
+            }
+            None => false,
+        };
+
+        assert!(db.next_cluster().is_some());
+        assert!(cluster(&mut db));
+        assert!(cluster(&mut db));
+        assert!(!cluster(&mut db));
+        assert_eq!(db.clusters.end(), 3072);
+
+        // Each run has the deltas of a function next to each other
+        let code = db.dictionary.code("cluster_a").unwrap();
+        assert_eq!(db.clusters.runs()[0].count(code), 512);
+
+        let mut out = vec![];
+        db.write_deltas(code, &mut out);
+        assert_eq!(out, expected(0));
+
+        assert_eq!(db.apply_retention(now), 1024);
+        out.clear();
+        db.write_deltas(code, &mut out);
+        assert_eq!(out, expected(1024));
+
+        // A reader uses the same runs
+        let reader = DatabaseInner::open_reader(shard);
+        assert_eq!(reader.clusters.end(), 3072);
+        out.clear();
+        reader.write_deltas(code, &mut out);
+        assert_eq!(out, expected(1024));
+
+        // The other tests that take a shard expect an empty one
+        drop(reader);
+        drop(db);
+        fs::remove_dir_all(get_shard_dir(shard)).unwrap();
+    }
+
+    #[test]
+    fn shard_reader_test() {
+        let mut db = Database::new(true);
+        db.capture("shard_a".to_string(), vec![], 10, 20);
+        db.capture("shard_both".to_string(), vec![], 0, 100);
+        db.flush();
+
+        // Another worker process writes to a shard of its own
+        let (shard, lock) = claim_shard();
+        let mut worker = DatabaseInner::open_writer(shard, Some(lock), &DatabaseConfig::default());
+        assert_ne!(shard, db.get_instance().read().unwrap().shard);
+
+        let queue = KQueue::with_capacity(16);
+        queue.capture("shard_b".to_string(), vec![], 50, 55);
+        queue.capture("shard_both".to_string(), vec![], 0, 300);
+        worker.flush(&queue);
+
+        let base = shard_base(shard);
+        let worker_rows = worker.row_count();
+        assert_eq!(worker_rows, 2);
+
+        // The writer only sees its own shard
+        assert!(!db.contains_name("shard_b".to_string()));
+
+        let mut reader = Database::new_reader(true);
+        assert!(reader.contains_name("shard_a".to_string()));
+        assert!(reader.contains_name("shard_b".to_string()));
+        assert_eq!(reader.high_water().last(), Some(&(base + worker_rows)));
+
+        // Row IDs have the shard in them
+        let row = reader.fetch(base + 1).unwrap();
+        assert_eq!(row.id, base + 1);
+        assert_eq!(row.fields[0], FieldType::Name("shard_both".to_string()));
+        assert_eq!(row.fields[3], FieldType::Epoch(300));
+
+        let rows = reader.fetch_all();
+        assert_eq!(rows.last().unwrap().id, base + 1);
+        assert_eq!(rows.len(), reader.scan(3, 0).unwrap().flatten().count());
+
+        // Functions captured by both processes are merged
+        let stats = reader.stats("shard_both").unwrap();
+        assert_eq!(stats["count"], 2.0);
+        assert_eq!(stats["max"], 300.0);
+        assert_eq!(reader.average("shard_both"), Some(200.0));
+        assert_eq!(reader.percentile("shard_both", 1.0).unwrap(), Some(300.0));
+
+        let buckets = reader.rollup("shard_both", "day", 0, 1000).unwrap();
+        assert_eq!(buckets, vec![(0, 2, 400, 100, 300)]);
+
+        let names = reader.names_by_code();
+        let unique: HashSet<&String> = names.iter().collect();
+        assert_eq!(names.len(), unique.len());
+        assert!(reader.get_function_names().contains("shard_b"));
+
+        // Rows the worker publishes later are seen on refresh
+        queue.capture("shard_b".to_string(), vec![], 60, 61);
+        worker.flush(&queue);
+        assert_eq!(reader.refresh(), 1);
+        assert_eq!(reader.high_water().last(), Some(&(base + worker_rows + 1)));
+
+        // A poll from the high water gets the new rows of every shard, not only the last one
+        let mark = reader.high_water();
+        assert_eq!(mark.len(), 2);
+
+        db.capture("shard_a".to_string(), vec![], 70, 71);
+        db.flush();
+        queue.capture("shard_b".to_string(), vec![], 80, 81);
+        worker.flush(&queue);
+        assert_eq!(reader.refresh(), 2);
+
+        let since = SinceId::Shards(mark.clone());
+        let rows = reader.fetch_logs(Some(&since), None, None);
+        assert_eq!(rows.len(), 2);
+        assert_eq!(rows[0].id, mark[0]);
+        assert_eq!(rows[1].id, mark[1]);
+
+        let rows = reader.fetch_logs(Some(&since), None, Some("shard_b"));
+        assert_eq!(rows.len(), 1);
+
+        // A single ID only gets the rows with that ID or later
+        let since = SinceId::Id(mark[1]);
+        assert_eq!(reader.fetch_logs(Some(&since), None, None).len(), 1);
+    }
+
+    #[test]
+    fn reader_threads_test() {
+        let mut db = Database::new(true);
+        db.capture("reader_threads".to_string(), vec![], 0, 100);
+        let first = db.high_water()[0] - 1;
+
+        // Readers keep going while captures are written
+        let readers: Vec<_> = (0..4)
+            .map(|_| {
+                thread::spawn(move || {
+                    let reader = Database::new(true);
+
+                    for _ in 0..200 {
+                        let row = reader.fetch(first).expect("Should fetch row.");
+                        assert_eq!(row.fields[3], FieldType::Epoch(100));
+                        assert!(reader.contains_name("reader_threads".to_string()));
+                        assert!(reader.average("reader_threads").is_some());
+                    }
+                })
+            })
+            .collect();
+
+        for i in 0..200 {
+            db.capture("reader_threads".to_string(), vec![], i, i + 100);
+        }
+
+        for r in readers {
+            r.join().expect("Reader should not panic.");
+        }
+
+        assert_eq!(db.average("reader_threads"), Some(100.0));
+    }
+
+    #[test]
+    fn scan_batches_test() {
+        let mut db = Database::new(true);
+        for i in 0..25 {
+            db.capture("scan_batches".to_string(), vec![], i, i + 5);
+        }
+
+        let all = db.fetch_all();
+        let start_id = all.len() - 25;
+
+        let batches: Vec<Vec<Row>> = db.scan(10, start_id).unwrap().collect();
+        assert_eq!(
+            batches.iter().map(|b| b.len()).collect::<Vec<_>>(),
+            [10, 10, 5]
+        );
+
+        let rows: Vec<Row> = batches.into_iter().flatten().collect();
+        assert_eq!(rows, all[start_id..]);
+
+        // Rows captured after the scan started are left out
+        let mut scan = db.scan(SCAN_BATCH_SIZE, all.len()).unwrap();
+        db.capture("scan_batches".to_string(), vec![], 100, 105);
+        assert!(scan.next().is_none());
+
+        assert!(db.scan(0, 0).is_err());
+    }
+
+    #[test]
+    fn sync_group_commit_test() {
+        let config = DatabaseConfig {
+            batch_size: 3,
+            max_delay: 60_000,
+            ..DatabaseConfig::default()
+        };
+        let mut db = Database::with_config(true, config);
+
+        let written = |db: &Database| {
+            db.get_instance()
+                .read()
+                .unwrap()
+                .row_id
+                .load(Ordering::SeqCst)
+        };
+        let before = written(&db);
+
+        // The first two captures wait in the queue for the rest of their group
+        db.capture("group_commit".to_string(), vec![], 100, 200);
+        db.capture("group_commit".to_string(), vec![], 100, 200);
+        assert_eq!(written(&db), before);
+
+        // The third fills the batch, so all three are written together
+        db.capture("group_commit".to_string(), vec![], 100, 200);
+        assert_eq!(written(&db), before + 3);
+
+        // A flush writes a partial group
+        db.capture("group_commit".to_string(), vec![], 100, 200);
+        assert_eq!(written(&db), before + 3);
+        db.flush();
+        assert_eq!(written(&db), before + 4);
+    }
+
+    #[test]
+    fn sync_max_delay_test() {
+        let config = DatabaseConfig {
+            batch_size: 3,
+            max_delay: 50,
+            ..DatabaseConfig::default()
+        };
+        let mut db = Database::with_config(true, config);
+        db.flush();
+
+        let written = |db: &Database| {
+            db.get_instance()
+                .read()
+                .unwrap()
+                .row_id
+                .load(Ordering::SeqCst)
+        };
+        let before = written(&db);
+
+        // Less than a batch, and nothing is captured after it
+        db.capture("max_delay".to_string(), vec![], 100, 200);
+        db.capture("max_delay".to_string(), vec![], 100, 200);
+        assert_eq!(written(&db), before);
+
+        // The drainer writes them once they have waited for max_delay
+        let start = Instant::now();
+        while written(&db) < before + 2 && start.elapsed() < Duration::from_secs(5) {
+            thread::sleep(Duration::from_millis(10));
+        }
+        assert_eq!(written(&db), before + 2);
+        assert!(start.elapsed() < Duration::from_secs(1));
+    }
+
+    #[test]
+    fn validate_config_test() {
+        assert!(DatabaseConfig::default().validate().is_ok());
+
+        let bad_batch = DatabaseConfig {
+            batch_size: 0,
+            ..DatabaseConfig::default()
+        };
+        assert!(bad_batch.validate().is_err());
+
+        let too_big = DatabaseConfig {
+            batch_size: QUEUE_CAPACITY + 1,
+            ..DatabaseConfig::default()
+        };
+        assert!(too_big.validate().is_err());
+
+        let bad_extent = DatabaseConfig {
+            extent_size: 1000,
+            ..DatabaseConfig::default()
+        };
+        assert!(bad_extent.validate().is_err());
+    }
+
+    #[test]
+    fn long_name_test() {
+        let mut db = Database::new(true);
+
+        // Longer than the 64 bytes names used to be cut off at
+        let name = format!("package.module.Class.{}", "method".repeat(20));
+        db.capture(name.clone(), vec![], 100, 200);
+
+        assert!(db.contains_name(name.clone()));
+        assert!(!db.contains_name(name[..64].to_string()));
+
+        let rows = db.fetch_all();
+        let last = rows.last().expect("Should have a row.");
+        assert_eq!(last.fields[0], FieldType::Name(name.clone()));
+        assert_eq!(db.average(&name), Some(100.0));
+    }
+
+    #[test]
+    fn range_fetch_test() {
+        let mut db = Database::new(true);
+
+        // Far past the times the other tests capture at
+        let base: u128 = 1 << 62;
+        let count = crate::constants::ENCODED_BLOCK_ROWS as u128 + 50;
+
+        for i in 0..count {
+            let name = if i % 2 == 0 {
+                "range_even"
+            } else {
+                "range_odd"
+            };
+            db.capture(name.to_string(), vec![], base + i * 10, base + i * 10 + 3);
+        }
+
+        let rows = db.fetch_range(base + 100, base + 200, None);
+        assert_eq!(rows.len(), 10);
+        assert_eq!(rows[0].fields[1], FieldType::Epoch(base + 100));
+        assert_eq!(rows[0].fields[3], FieldType::Epoch(3));
+
+        // Runs across the last block and the tail
+        let rows = db.fetch_range(
+            base + 10_000,
+            base + count * 10,
+            Some("range_odd".to_string()),
+        );
+        assert_eq!(rows.len(), ((count - 1000) / 2) as usize);
+        assert!(rows
+            .iter()
+            .all(|r| r.fields[0] == FieldType::Name("range_odd".to_string())));
+
+        assert_eq!(db.fetch(rows[0].id), Some(rows[0].clone()));
+        assert!(db
+            .fetch_range(base, base + 100, Some("no_such_fn".to_string()))
+            .is_empty());
+        assert!(db
+            .fetch_range(base + count * 10, u128::MAX, None)
+            .is_empty());
+    }
+
+    #[test]
+    fn write_column_test() {
+        let mut db = Database::new(true);
+        db.capture("write_column".to_string(), vec![], 1000, 1042);
+        db.capture("write_column".to_string(), vec![], 2000, 2007);
+        db.capture("write_column".to_string(), vec![], 0, 1 << 40);
+
+        let instance = db.get_instance();
+        let inner = instance.read().unwrap();
+        let count = inner.row_count();
+
+        let mut deltas = vec![0u8; count * 8];
+        inner.write_column(DELTA_COLUMN, 8, &mut deltas);
+
+        let mut codes = vec![0u8; count * 4];
+        inner.write_column(NAME_COLUMN, 4, &mut codes);
+
+        let delta = |i: usize| u64::from_le_bytes(deltas[i * 8..i * 8 + 8].try_into().unwrap());
+        let code = |i: usize| u32::from_le_bytes(codes[i * 4..i * 4 + 4].try_into().unwrap());
+
+        assert_eq!(delta(count - 3), 42);
+        assert_eq!(delta(count - 2), 7);
+        assert_eq!(delta(count - 1), 1 << 40);
+
+        let expected = inner.dictionary.code("write_column").unwrap();
+        assert_eq!(code(count - 1), expected);
+        assert_eq!(code(count - 2), expected);
+
+        // Values too big for the width are written as the largest value that fits
+        let mut narrow = vec![0u8; count * 4];
+        inner.write_column(DELTA_COLUMN, 4, &mut narrow);
+        let narrow = |i: usize| u32::from_le_bytes(narrow[i * 4..i * 4 + 4].try_into().unwrap());
+
+        assert_eq!(narrow(count - 2), 7);
+        assert_eq!(narrow(count - 1), u32::MAX);
+    }
+
+    #[test]
+    fn logs_since_test() {
+        let mut db = Database::new(true);
+        db.capture("logs_since_a".to_string(), vec![], 10, 20);
+
+        let mark = db.high_water()[0];
+
+        for i in 0..6 {
+            let name = if i % 3 == 0 {
+                "logs_since_b"
+            } else {
+                "logs_since_a"
+            };
+            db.capture(name.to_string(), vec![], i, i + 1);
+        }
+
+        assert_eq!(db.high_water(), [mark + 6]);
+
+        let instance = db.get_instance();
+        let inner = instance.read().unwrap();
+
+        let rows = inner.fetch_since(mark, usize::MAX, None);
+        assert_eq!(
+            rows.iter().map(|r| r.id).collect::<Vec<_>>(),
+            (mark..mark + 6).collect::<Vec<_>>()
+        );
+
+        let rows = inner.fetch_since(mark + 1, 2, None);
+        assert_eq!(
+            rows.iter().map(|r| r.id).collect::<Vec<_>>(),
+            [mark + 1, mark + 2]
+        );
+
+        // Only the rows of one name from the mark on, and not the one before it
+        let code = inner.dictionary.code("logs_since_a");
+        let rows = inner.fetch_since(mark, usize::MAX, code);
+        assert_eq!(
+            rows.iter().map(|r| r.id - mark).collect::<Vec<_>>(),
+            [1, 2, 4, 5]
+        );
+
+        let code = inner.dictionary.code("logs_since_b");
+        let rows = inner.fetch_since(mark, 1, code);
+        assert_eq!(rows.len(), 1);
+        assert_eq!(rows[0].id, mark);
+
+        assert!(inner.fetch_since(mark + 6, 10, None).is_empty());
+    }
+
+    #[test]
+    fn many_rows_test() {
+        let mut db = Database::new(true);
+        let before = db.fetch_all().len();
+
+        // Enough rows to fill more than one encoded block
+        let count = 2 * crate::constants::ENCODED_BLOCK_ROWS + 7;
+        for i in 0..count as u128 {
+            db.capture(
+                "many_rows".to_string(),
+                vec![],
+                1000 + i * 10,
+                1050 + i * 10 + i % 4,
+            );
+        }
+
+        let all = db.fetch_all();
+        assert_eq!(all.len(), before + count);
+
+        for (i, row) in all[before..].iter().enumerate() {
+            let i = i as u128;
+            assert_eq!(row.fields[1], FieldType::Epoch(1000 + i * 10));
+            assert_eq!(row.fields[2], FieldType::Epoch(1050 + i * 10 + i % 4));
+            assert_eq!(row.fields[3], FieldType::Epoch(50 + i % 4));
+        }
+
+        assert_eq!(db.fetch(before + 5), Some(all[before + 5].clone()));
+    }
+
+    #[test]
+    fn percentile_test() {
+        let mut db = Database::new(true);
+
+        for i in 1..=100 {
+            db.capture("percentile_fn".to_string(), vec![], 1000, 1000 + i * 1000);
+        }
+
+        let p = db
+            .percentiles("percentile_fn", vec![0.0, 0.5, 0.95, 1.0])
+            .unwrap()
+            .unwrap();
+
+        // The smallest and largest are exact, the rest are within 1%
+        assert_eq!(p[0], 1000.0);
+        assert!((p[1] - 50_000.0).abs() <= 500.0);
+        assert!((p[2] - 95_000.0).abs() <= 950.0);
+        assert_eq!(p[3], 100_000.0);
+
+        assert_eq!(db.percentile("percentile_fn", 0.5).unwrap(), Some(p[1]));
+        assert_eq!(db.percentile("never_captured", 0.5).unwrap(), None);
+        assert!(db.percentile("percentile_fn", 95.0).is_err());
+    }
+
+    #[test]
+    fn rollup_test() {
+        let mut db = Database::new(true);
+        let minute: u128 = 60 * 1_000_000_000;
+
+        // Two calls in the first minute and one in the third
+        db.capture("rollup_fn".to_string(), vec![], 10, 30);
+        db.capture("rollup_fn".to_string(), vec![], 20, 60);
+        db.capture(
+            "rollup_fn".to_string(),
+            vec![],
+            2 * minute + 5,
+            2 * minute + 15,
+        );
+
+        let minutes = db.rollup("rollup_fn", "minute", 0, 10 * minute).unwrap();
+        assert_eq!(
+            minutes,
+            vec![(0, 2, 60, 20, 40), (2 * minute, 1, 10, 10, 10)]
+        );
+
+        let days = db.rollup("rollup_fn", "day", 0, minute).unwrap();
+        assert_eq!(days, vec![(0, 3, 70, 10, 40)]);
+
+        assert!(db.rollup("rollup_fn", "week", 0, minute).is_err());
+        assert!(db
+            .rollup("never_captured", "hour", 0, minute)
+            .unwrap()
+            .is_empty());
+    }
+
+    #[test]
+    fn stats_test() {
+        let mut db = Database::new(true);
+
+        db.capture("stats_fn".to_string(), vec![], 100, 110);
+        db.capture("stats_fn".to_string(), vec![], 200, 230);
+        db.capture("stats_fn".to_string(), vec![], 300, 320);
+
+        let stats = db.stats("stats_fn").unwrap();
+        assert_eq!(stats["count"], 3.0);
+        assert_eq!(stats["sum"], 60.0);
+        assert_eq!(stats["min"], 10.0);
+        assert_eq!(stats["max"], 30.0);
+        assert_eq!(stats["mean"], 20.0);
+        assert!((stats["variance"] - 100.0).abs() < 1e-9);
+        assert!((stats["std_dev"] - 10.0).abs() < 1e-9);
+
+        assert_eq!(db.average("stats_fn"), Some(20.0));
+        assert!(db.stats("never_captured").is_none());
+    }
+
+    #[test]
+    fn wal_replay_test() {
+        let config = DatabaseConfig::default();
+        let (shard, lock) = claim_shard();
+
+        let mut writer = DatabaseInner::open_writer(shard, Some(lock), &config);
+        let before = writer.row_count();
+
+        let queue = KQueue::with_capacity(16);
+        queue.capture("wal_a".to_string(), vec![], 10, 15);
+        queue.capture("wal_b".to_string(), vec![], 20, 40);
+        writer.consume_capture(&queue);
+
+        // The rows are only in the log until the next checkpoint
+        assert_eq!(writer.row_count(), before + 2);
+        assert_eq!(writer.wal.as_ref().unwrap().rows(), 2);
+        assert_eq!(
+            Column::load(&writer.dir, DELTA_COLUMN).current_index,
+            before
+        );
+
+        // The process dies in the middle of a checkpoint, with only one column saved
+        writer.columns[START_COLUMN].save();
+        drop(writer);
+
+        let reopened = DatabaseInner::open_writer(shard, None, &config);
+        assert_eq!(reopened.row_count(), before + 2);
+
+        for col in &reopened.columns {
+            assert_eq!(col.metadata.current_index, before + 2);
+        }
+
+        let row = reopened.fetch_row(before + 1).unwrap();
+        assert_eq!(row.fields[0], FieldType::Name("wal_b".to_string()));
+        assert_eq!(row.fields[1], FieldType::Epoch(20));
+        assert_eq!(row.fields[3], FieldType::Epoch(20));
+
+        let key = reopened.name_key("wal_a").unwrap();
+        assert_eq!(reopened.name_index.get_stats(key).unwrap().count, 1);
+
+        // The replayed rows were checkpointed, so the log starts after them
+        let wal = reopened.wal.as_ref().unwrap();
+        assert_eq!(wal.rows(), 0);
+        assert_eq!(wal.base(), before + 2);
+        assert_eq!(
+            Column::load(&reopened.dir, DELTA_COLUMN).current_index,
+            before + 2
+        );
+    }
+
+    #[test]
+    fn warm_start_test() {
+        let mut db = Database::new(true);
+        db.capture("warm_start".to_string(), vec![], 100, 250);
+        db.capture("warm_start".to_string(), vec![], 300, 310);
+        db.flush();
+
+        let (shard, key, ids, average, rows) = {
+            let instance = db.get_instance();
+            let live = instance.read().unwrap();
+            let key = live.name_key("warm_start").unwrap();
+
+            (
+                live.shard,
+                key.clone(),
+                live.name_index.get(key.clone()).cloned(),
+                live.name_index.get_average(key).unwrap(),
+                live.row_count(),
+            )
+        };
+
+        // Opening the data again loads the index that flush saved
+        let warm = DatabaseInner::open_writer(shard, None, &DatabaseConfig::default());
+        assert_eq!(warm.row_id.load(Ordering::SeqCst), rows);
+        assert_eq!(warm.name_index.rows, rows);
+        assert_eq!(warm.name_index.get(key.clone()), ids.as_ref());
+
+        // Without a saved index it is built again from the columns
+        fs::remove_file(DatabaseInner::get_index_path(&warm.dir)).unwrap();
+
+        let cold = DatabaseInner::open_writer(shard, None, &DatabaseConfig::default());
+        assert_eq!(cold.name_index.get(key.clone()), ids.as_ref());
+        assert_eq!(cold.rollups.rows, rows);
+
+        let code = cold.dictionary.code("warm_start").unwrap();
+        let points = cold.rollups.query(code, Granularity::Day, 0, 1000);
+        assert_eq!(points[0].1.count, 2);
+
+        let rebuilt = cold.name_index.get_average(key).unwrap();
+        assert!((rebuilt - average).abs() < 1e-6);
+        assert!(DatabaseInner::get_index_path(&cold.dir).exists());
+    }
 }
@@ -0,0 +1,315 @@
+use super::constants::DATA_DIRECTORY;
+use log::{info, warn};
+use std::fs::{File, OpenOptions};
+use std::io::{Read, Seek, SeekFrom, Write};
+use std::path::{Path, PathBuf};
+
+// I had planned to test many different hashmap implementations
+type BHashMap<K, V> = std::collections::HashMap<K, V>;
+
+// Function names are stored once in the name dictionary instead of once per row.
+//
+// Each new name gets the next u32 code, and the name column stores that code. A code is four
+// bytes no matter how long the name is, so long qualified names are not cut off and the name
+// column is 16 times smaller than when it stored a [u8; 64] for every row.
+//
+// The dictionary file is append only. Each entry is the length of the name as a little endian
+// u32 followed by the bytes of the name, and the code of a name is its position in the file.
+
+/// Map between function names and the codes stored in the name column
+pub struct Dictionary {
+    path: PathBuf,
+    names: Vec<String>,
+    codes: BHashMap<String, u32>,
+    // How many of the names are already in the file
+    saved: usize,
+    // How many bytes of the file are whole entries that have been read or written
+    bytes: u64,
+}
+
+impl Dictionary {
+    /// Get the path of the dictionary of the shard in `dir`
+    pub fn get_path(dir: &Path) -> PathBuf {
+        dir.join("names.data")
+    }
+
+    fn empty(path: &Path) -> Self {
+        Dictionary {
+            path: path.to_path_buf(),
+            names: vec![],
+            codes: BHashMap::new(),
+            saved: 0,
+            bytes: 0,
+        }
+    }
+
+    /// Open the dictionary at `path`, loading the names that are already stored there
+    pub fn open(path: &Path) -> Self {
+        let mut dictionary = Dictionary::empty(path);
+
+        // A name that was only partly written is cut off the file, so new names are appended
+        // after the last whole one. It gets a new code the next time it is captured.
+        if dictionary.read_new() > 0 {
+            warn!("Name dictionary ends with a partial entry, removing it");
+
+            OpenOptions::new()
+                .write(true)
+                .open(path)
+                .and_then(|f| f.set_len(dictionary.bytes))
+                .expect("Should truncate name dictionary.");
+        }
+
+        dictionary
+    }
+
+    /// Open the dictionary at `path` for a reader while another process might be adding to it
+    ///
+    /// A partial entry at the end is left alone, it is most likely still being written.
+    pub fn open_read_only(path: &Path) -> Self {
+        let mut dictionary = Dictionary::empty(path);
+        dictionary.read_new();
+        dictionary
+    }
+
+    /// Load the names another process added to the file since it was last read
+    pub fn refresh(&mut self) {
+        self.read_new();
+    }
+
+    /// Read the whole entries after the ones already loaded, returning how many bytes of a
+    /// partial entry are left after them
+    fn read_new(&mut self) -> usize {
+        let mut bytes = vec![];
+
+        let read = File::open(&self.path).and_then(|mut f| {
+            f.seek(SeekFrom::Start(self.bytes))?;
+            f.read_to_end(&mut bytes)
+        });
+
+        if read.is_err() {
+            return 0;
+        }
+
+        let loaded = self.names.len();
+        let mut offset = 0;
+
+        while offset + 4 <= bytes.len() {
+            let mut len_bytes = [0u8; 4];
+            len_bytes.copy_from_slice(&bytes[offset..offset + 4]);
+            let len = u32::from_le_bytes(len_bytes) as usize;
+
+            if offset + 4 + len > bytes.len() {
+                break;
+            }
+
+            let name = String::from_utf8_lossy(&bytes[offset + 4..offset + 4 + len]);
+            self.push(name.to_string());
+
+            offset += 4 + len;
+        }
+
+        if self.names.len() > loaded {
+            info!(
+                "Loaded {} names from {:?}",
+                self.names.len() - loaded,
+                self.path
+            );
+        }
+
+        self.bytes += offset as u64;
+        self.saved = self.names.len();
+
+        bytes.len() - offset
+    }
+
+    fn push(&mut self, name: String) -> u32 {
+        let code = self.names.len() as u32;
+
+        self.codes.insert(name.clone(), code);
+        self.names.push(name);
+
+        code
+    }
+
+    /// Get the code for `name`, giving it a new one if it has not been seen before
+    pub fn encode(&mut self, name: &str) -> u32 {
+        match self.codes.get(name) {
+            Some(code) => *code,
+            None => self.push(name.to_string()),
+        }
+    }
+
+    /// Get the code for `name` without adding it
+    pub fn code(&self, name: &str) -> Option<u32> {
+        self.codes.get(name).copied()
+    }
+
+    /// Get the name that has `code`
+    pub fn name(&self, code: u32) -> Option<&str> {
+        self.names.get(code as usize).map(|n| n.as_str())
+    }
+
+    pub fn len(&self) -> usize {
+        self.names.len()
+    }
+
+    /// Append the names that are not in the file yet
+    pub fn save(&mut self) {
+        if self.saved == self.names.len() {
+            return;
+        }
+
+        let mut bytes = vec![];
+        for name in &self.names[self.saved..] {
+            bytes.extend_from_slice(&(name.len() as u32).to_le_bytes());
+            bytes.extend_from_slice(name.as_bytes());
+        }
+
+        let mut file = OpenOptions::new()
+            .create(true)
+            .append(true)
+            .open(&self.path)
+            .expect("Should open name dictionary.");
+
+        file.write_all(&bytes)
+            .expect("Should write to name dictionary.");
+        file.sync_data().expect("Should sync name dictionary.");
+        self.bytes += bytes.len() as u64;
+
+        info!(
+            "Saved {} new names to {:?}",
+            self.names.len() - self.saved,
+            self.path
+        );
+        self.saved = self.names.len();
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use std::fs;
+
+    fn test_path(name: &str) -> PathBuf {
+        let dir = Path::new("./").join(DATA_DIRECTORY);
+        if !dir.exists() {
+            let _ = fs::create_dir_all(&dir);
+        }
+
+        let path = dir.join(name);
+        let _ = fs::remove_file(&path);
+        path
+    }
+
+    #[test]
+    fn encode_gives_same_code_for_same_name() {
+        let path = test_path("names-test-1.data");
+        let mut dictionary = Dictionary::open(&path);
+
+        let a = dictionary.encode("a");
+        let b = dictionary.encode("b");
+
+        assert_eq!(a, 0);
+        assert_eq!(b, 1);
+        assert_eq!(dictionary.encode("a"), a);
+        assert_eq!(dictionary.len(), 2);
+
+        assert_eq!(dictionary.name(b), Some("b"));
+        assert_eq!(dictionary.name(7), None);
+        assert_eq!(dictionary.code("c"), None);
+
+        let _ = fs::remove_file(&path);
+    }
+
+    #[test]
+    fn save_and_load() {
+        let path = test_path("names-test-2.data");
+        let long = format!("package.module.Class.{}", "a".repeat(200));
+
+        {
+            let mut dictionary = Dictionary::open(&path);
+            dictionary.encode("first");
+            dictionary.encode(&long);
+            dictionary.save();
+
+            // Only the new name is appended
+            dictionary.encode("third");
+            dictionary.save();
+            dictionary.save();
+        }
+
+        let dictionary = Dictionary::open(&path);
+
+        assert_eq!(dictionary.len(), 3);
+        assert_eq!(dictionary.code("first"), Some(0));
+        assert_eq!(dictionary.name(1), Some(long.as_str()));
+        assert_eq!(dictionary.code("third"), Some(2));
+
+        let _ = fs::remove_file(&path);
+    }
+
+    #[test]
+    fn partial_entry_is_dropped() {
+        let path = test_path("names-test-3.data");
+
+        {
+            let mut dictionary = Dictionary::open(&path);
+            dictionary.encode("whole");
+            dictionary.save();
+        }
+
+        // A length with only part of its name after it
+        let mut file = OpenOptions::new().append(true).open(&path).unwrap();
+        file.write_all(&10u32.to_le_bytes()).unwrap();
+        file.write_all(b"abc").unwrap();
+
+        {
+            let mut dictionary = Dictionary::open(&path);
+            assert_eq!(dictionary.len(), 1);
+            assert_eq!(dictionary.code("whole"), Some(0));
+
+            // New names go after the last whole entry
+            dictionary.encode("next");
+            dictionary.save();
+        }
+
+        let dictionary = Dictionary::open(&path);
+        assert_eq!(dictionary.code("next"), Some(1));
+
+        let _ = fs::remove_file(&path);
+    }
+
+    #[test]
+    fn read_only_refresh() {
+        let path = test_path("names-test-4.data");
+
+        let mut writer = Dictionary::open(&path);
+        writer.encode("first");
+        writer.save();
+
+        let mut reader = Dictionary::open_read_only(&path);
+        assert_eq!(reader.len(), 1);
+
+        writer.encode("second");
+        writer.save();
+
+        // Half of an entry the writer has not finished
+        let mut file = OpenOptions::new().append(true).open(&path).unwrap();
+        file.write_all(&10u32.to_le_bytes()).unwrap();
+        file.write_all(b"thi").unwrap();
+
+        reader.refresh();
+        assert_eq!(reader.len(), 2);
+        assert_eq!(reader.code("second"), Some(1));
+
+        file.write_all(b"rd_name").unwrap();
+
+        reader.refresh();
+        assert_eq!(reader.code("third_name"), Some(2));
+
+        // The reader did not cut off the partial entry
+        assert_eq!(Dictionary::open(&path).len(), 3);
+
+        let _ = fs::remove_file(&path);
+    }
+}
@@ -0,0 +1,338 @@
+use serde::{Deserialize, Serialize};
+
+// Encoded blocks for the epoch columns.
+//
+// Instead of a u128 for every row, an encoded column stores blocks of ENCODED_BLOCK_ROWS values.
+// Each block is encoded on its own, so one can be decoded without reading any other block.
+//
+// - FrameOfReference stores the smallest value of the block once, then every value minus that
+//   smallest value packed into as few bits as the biggest one needs. This is used for `delta`,
+//   where the values are all close to each other.
+// - DeltaOfDelta stores the first value and the first difference, then how much each difference
+//   changed, zigzag encoded and bit packed the same way. This is used for `start`, where the
+//   values are always going up.
+//
+// A block where the packed values would need more than 64 bits is stored plain instead.
+//
+// Block layout, all little endian:
+//
+// | tag (u8) | count (u32) | Plain: count u128 values
+//                          | FrameOfReference: width (u8), reference (u128), words
+//                          | DeltaOfDelta: width (u8), first (u128), first delta (u128), words
+//
+// The words are the packed values as u64s with one extra zero word at the end, so unpacking can
+// always read two words at once without checking for the end.
+
+const TAG_PLAIN: u8 = 0;
+const TAG_FRAME_OF_REFERENCE: u8 = 1;
+const TAG_DELTA_OF_DELTA: u8 = 2;
+
+/// How a column stores its values
+#[derive(Serialize, Deserialize, Debug, Clone, Copy, PartialEq, Eq)]
+pub enum Encoding {
+    /// Fixed size values in pages, read and written through the bufferpool
+    Plain,
+    FrameOfReference,
+    DeltaOfDelta,
+}
+
+#[inline]
+fn zigzag(v: i128) -> u128 {
+    ((v << 1) ^ (v >> 127)) as u128
+}
+
+#[inline]
+fn unzigzag(v: u128) -> i128 {
+    ((v >> 1) as i128) ^ -((v & 1) as i128)
+}
+
+/// The number of bits needed to store `v`
+#[inline]
+fn bit_width(v: u128) -> u32 {
+    128 - v.leading_zeros()
+}
+
+/// Pack each value into `width` bits
+fn pack(values: &[u64], width: u32, out: &mut Vec<u8>) {
+    let word_count = (values.len() * width as usize).div_ceil(64) + 1;
+    let mut words = vec![0u64; word_count];
+
+    if width > 0 {
+        for (i, &v) in values.iter().enumerate() {
+            let bit = i * width as usize;
+            let word = bit / 64;
+            let shift = bit % 64;
+
+            words[word] |= v << shift;
+            if shift > 0 && shift + width as usize > 64 {
+                words[word + 1] |= v >> (64 - shift);
+            }
+        }
+    }
+
+    for w in words {
+        out.extend_from_slice(&w.to_le_bytes());
+    }
+}
+
+/// Unpack `count` values of `width` bits from `bytes` into `out`
+///
+/// Every value is read the same way with no branches, so this loop can be vectorized.
+fn unpack(bytes: &[u8], count: usize, width: u32, out: &mut Vec<u64>) {
+    out.clear();
+
+    // Every value is zero, and there might not be two words to read
+    if width == 0 {
+        out.resize(count, 0);
+        return;
+    }
+
+    out.reserve(count);
+
+    let words: Vec<u64> = bytes
+        .chunks_exact(8)
+        .map(|c| u64::from_le_bytes(c.try_into().unwrap()))
+        .collect();
+
+    let mask = if width == 64 {
+        u64::MAX
+    } else {
+        (1u64 << width) - 1
+    };
+
+    for i in 0..count {
+        let bit = i * width as usize;
+        let word = bit / 64;
+        let shift = bit % 64;
+
+        let both = words[word] as u128 | ((words[word + 1] as u128) << 64);
+        out.push((both >> shift) as u64 & mask);
+    }
+}
+
+fn read_u128(bytes: &[u8], at: usize) -> u128 {
+    u128::from_le_bytes(bytes[at..at + 16].try_into().unwrap())
+}
+
+fn encode_plain(values: &[u128], out: &mut Vec<u8>) {
+    out.push(TAG_PLAIN);
+    out.extend_from_slice(&(values.len() as u32).to_le_bytes());
+
+    for v in values {
+        out.extend_from_slice(&v.to_le_bytes());
+    }
+}
+
+fn encode_frame_of_reference(values: &[u128], out: &mut Vec<u8>) {
+    let reference = values.iter().copied().min().unwrap_or(0);
+    let offsets: Vec<u128> = values.iter().map(|v| v - reference).collect();
+    let width = offsets.iter().map(|&v| bit_width(v)).max().unwrap_or(0);
+
+    if width > 64 {
+        return encode_plain(values, out);
+    }
+
+    out.push(TAG_FRAME_OF_REFERENCE);
+    out.extend_from_slice(&(values.len() as u32).to_le_bytes());
+    out.push(width as u8);
+    out.extend_from_slice(&reference.to_le_bytes());
+
+    let packed: Vec<u64> = offsets.iter().map(|&v| v as u64).collect();
+    pack(&packed, width, out);
+}
+
+fn encode_delta_of_delta(values: &[u128], out: &mut Vec<u8>) {
+    let first = values.first().copied().unwrap_or(0);
+    let first_delta = if values.len() > 1 {
+        values[1].wrapping_sub(values[0]) as i128
+    } else {
+        0
+    };
+
+    let mut changes = Vec::with_capacity(values.len().saturating_sub(2));
+    let mut prev_delta = first_delta;
+
+    for pair in values.windows(2).skip(1) {
+        let delta = pair[1].wrapping_sub(pair[0]) as i128;
+        changes.push(zigzag(delta.wrapping_sub(prev_delta)));
+        prev_delta = delta;
+    }
+
+    let width = changes.iter().map(|&v| bit_width(v)).max().unwrap_or(0);
+
+    if width > 64 {
+        return encode_plain(values, out);
+    }
+
+    out.push(TAG_DELTA_OF_DELTA);
+    out.extend_from_slice(&(values.len() as u32).to_le_bytes());
+    out.push(width as u8);
+    out.extend_from_slice(&first.to_le_bytes());
+    out.extend_from_slice(&zigzag(first_delta).to_le_bytes());
+
+    let packed: Vec<u64> = changes.iter().map(|&v| v as u64).collect();
+    pack(&packed, width, out);
+}
+
+/// Encode a block of values
+pub fn encode_block(encoding: Encoding, values: &[u128]) -> Vec<u8> {
+    let mut out = vec![];
+
+    match encoding {
+        Encoding::Plain => encode_plain(values, &mut out),
+        Encoding::FrameOfReference => encode_frame_of_reference(values, &mut out),
+        Encoding::DeltaOfDelta => encode_delta_of_delta(values, &mut out),
+    }
+
+    out
+}
+
+/// Decode a block made by `encode_block` into `out`
+pub fn decode_block(bytes: &[u8], out: &mut Vec<u128>) {
+    out.clear();
+
+    let tag = bytes[0];
+    let count = u32::from_le_bytes(bytes[1..5].try_into().unwrap()) as usize;
+    out.reserve(count);
+
+    match tag {
+        TAG_FRAME_OF_REFERENCE => {
+            let width = bytes[5] as u32;
+            let reference = read_u128(bytes, 6);
+
+            let mut packed = vec![];
+            unpack(&bytes[22..], count, width, &mut packed);
+
+            out.extend(packed.iter().map(|&v| reference + v as u128));
+        }
+        TAG_DELTA_OF_DELTA => {
+            let width = bytes[5] as u32;
+            let first = read_u128(bytes, 6);
+            let first_delta = unzigzag(read_u128(bytes, 22));
+
+            let mut packed = vec![];
+            unpack(&bytes[38..], count.saturating_sub(2), width, &mut packed);
+
+            if count > 0 {
+                out.push(first);
+            }
+
+            if count > 1 {
+                let mut value = first.wrapping_add(first_delta as u128);
+                let mut delta = first_delta;
+                out.push(value);
+
+                for &change in &packed {
+                    delta = delta.wrapping_add(unzigzag(change as u128));
+                    value = value.wrapping_add(delta as u128);
+                    out.push(value);
+                }
+            }
+        }
+        _ => {
+            out.extend((0..count).map(|i| read_u128(bytes, 5 + i * 16)));
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn round_trip(encoding: Encoding, values: &[u128]) -> Vec<u8> {
+        let bytes = encode_block(encoding, values);
+
+        let mut decoded = vec![];
+        decode_block(&bytes, &mut decoded);
+        assert_eq!(decoded, values);
+
+        bytes
+    }
+
+    #[test]
+    fn zigzag_test() {
+        for v in [0i128, 1, -1, 2, -2, i128::MAX, i128::MIN] {
+            assert_eq!(unzigzag(zigzag(v)), v);
+        }
+
+        assert_eq!(zigzag(0), 0);
+        assert_eq!(zigzag(-1), 1);
+        assert_eq!(zigzag(1), 2);
+    }
+
+    #[test]
+    fn pack_and_unpack_test() {
+        for width in [0, 1, 7, 31, 63, 64] {
+            let mask = if width == 64 {
+                u64::MAX
+            } else {
+                (1u64 << width) - 1
+            };
+            let values: Vec<u64> = (0..100u64)
+                .map(|i| i.wrapping_mul(0x9E37_79B9_7F4A_7C15) & mask)
+                .collect();
+
+            let mut bytes = vec![];
+            pack(&values, width, &mut bytes);
+
+            let mut out = vec![];
+            unpack(&bytes, values.len(), width, &mut out);
+            assert_eq!(out, values);
+        }
+    }
+
+    #[test]
+    fn frame_of_reference_test() {
+        let values: Vec<u128> = (0..1024).map(|i| 1_000_000 + (i * 37) % 5000).collect();
+        let bytes = round_trip(Encoding::FrameOfReference, &values);
+
+        // 13 bits per value instead of 128
+        assert!(bytes.len() < values.len() * 2);
+    }
+
+    #[test]
+    fn delta_of_delta_test() {
+        // Start times that go up by about the same amount each time
+        let mut values = vec![];
+        let mut t: u128 = 1_700_000_000_000_000_000;
+        for i in 0..1024 {
+            t += 1000 + (i % 7);
+            values.push(t);
+        }
+
+        let bytes = round_trip(Encoding::DeltaOfDelta, &values);
+        assert!(bytes.len() < values.len());
+    }
+
+    #[test]
+    fn delta_of_delta_out_of_order_test() {
+        // Starts from different threads do not always go up
+        let values: Vec<u128> = vec![500, 300, 900, 100, 100, u64::MAX as u128, 0];
+        round_trip(Encoding::DeltaOfDelta, &values);
+    }
+
+    #[test]
+    fn small_blocks_test() {
+        for encoding in [
+            Encoding::Plain,
+            Encoding::FrameOfReference,
+            Encoding::DeltaOfDelta,
+        ] {
+            round_trip(encoding, &[]);
+            round_trip(encoding, &[42]);
+            round_trip(encoding, &[42, 7]);
+            round_trip(encoding, &[5, 5, 5]);
+        }
+    }
+
+    #[test]
+    fn wide_values_fall_back_to_plain_test() {
+        let values = vec![0, 1 << 100, 0, 1 << 100];
+
+        let bytes = round_trip(Encoding::FrameOfReference, &values);
+        assert_eq!(bytes[0], TAG_PLAIN);
+
+        let bytes = round_trip(Encoding::DeltaOfDelta, &values);
+        assert_eq!(bytes[0], TAG_PLAIN);
+    }
+}
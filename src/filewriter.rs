@@ -2,7 +2,7 @@
 use super::constants::DATA_DIRECTORY;
 use serde::{Deserialize, Serialize};
 use serde_json;
-use std::fs::{metadata, read_dir, read_to_string, File};
+use std::fs::{metadata, read_dir, read_to_string, rename, File};
 use std::io::{BufReader, BufWriter, Write};
 
 pub trait WriterStrategy<T: Serialize + for<'de> Deserialize<'de>> {
@@ -13,11 +13,22 @@ pub trait WriterStrategy<T: Serialize + for<'de> Deserialize<'de>> {
 pub struct BinaryFileWriter {}
 impl<T: Serialize + for<'de> Deserialize<'de>> WriterStrategy<T> for BinaryFileWriter {
     /// Write a binary file
+    ///
+    /// The file is written next to `path`, synced and then renamed over it, so a reader in
+    /// another process sees either the old file or the new one and never half of it.
     #[inline(always)]
     fn write_file(&self, path: &str, object: &T) {
         let obj_bytes: Vec<u8> = bincode::serialize(&object).expect("Should serialize.");
-        let mut file = BufWriter::new(File::create(path).expect("Should open file."));
-        file.write_all(&obj_bytes).expect("Should write.");
+        let tmp = format!("{}.tmp", path);
+        {
+            let mut file = BufWriter::new(File::create(&tmp).expect("Should open file."));
+            file.write_all(&obj_bytes).expect("Should write.");
+            file.flush().expect("Should write.");
+
+            // On disk before the rename, so a crash never leaves an empty file in its place
+            file.get_ref().sync_all().expect("Should sync.");
+        }
+        rename(&tmp, path).expect("Should replace file.");
     }
     /// Read a binary file
     #[inline(always)]
@@ -1,14 +1,109 @@
+use super::postings::{PostingIter, PostingList};
 use super::row::RID;
 use super::row::{FieldType, Row};
+use super::sketch::Sketch;
+use log::{info, warn};
+use serde::{Deserialize, Serialize};
 use std::collections::BTreeMap;
+use std::fs::{self, File};
+use std::io::{BufReader, BufWriter, Write};
+use std::path::Path;
+
+// The stats of a key are kept up to date as rows are added, so asking for them does not read any
+// rows. The variance uses Welford's method, which keeps the mean and the sum of squared distances
+// from the mean (m2) instead of the sum of squares, so it does not lose precision when the deltas
+// are large and close together.
+//
+// The row IDs of each key are a compressed posting list, see `postings.rs`, and are read with an
+// iterator instead of being copied out.
+
+/// Running statistics of the `delta` of every row under one key
+#[derive(Debug, Clone, Serialize, Deserialize, PartialEq)]
+pub struct Stats {
+    pub count: u64,
+    pub sum: u128,
+    pub min: u128,
+    pub max: u128,
+    pub mean: f64,
+    m2: f64,
+}
 
-#[derive(Debug)]
-pub struct IndexValue {
-    ids: Vec<RID>,
+impl Stats {
+    pub fn new() -> Self {
+        Stats {
+            count: 0,
+            sum: 0,
+            min: u128::MAX,
+            max: 0,
+            mean: 0.0,
+            m2: 0.0,
+        }
+    }
+
+    pub fn add(&mut self, value: u128) {
+        self.count += 1;
+        self.sum += value;
+        self.min = self.min.min(value);
+        self.max = self.max.max(value);
+
+        let v = value as f64;
+        let diff = v - self.mean;
+        self.mean += diff / self.count as f64;
+        self.m2 += diff * (v - self.mean);
+    }
+
+    /// Combine with the stats of other rows, as if they had all been added to this one
+    pub fn merge(&mut self, other: &Stats) {
+        if other.count == 0 {
+            return;
+        }
+
+        if self.count == 0 {
+            *self = other.clone();
+            return;
+        }
+
+        let n = self.count as f64;
+        let m = other.count as f64;
+        let diff = other.mean - self.mean;
+
+        self.mean += diff * m / (n + m);
+        self.m2 += other.m2 + diff * diff * n * m / (n + m);
+        self.count += other.count;
+        self.sum += other.sum;
+        self.min = self.min.min(other.min);
+        self.max = self.max.max(other.max);
+    }
+
+    /// The sample variance, which is zero until there are two values
+    pub fn variance(&self) -> f64 {
+        if self.count < 2 {
+            return 0.0;
+        }
+
+        self.m2 / (self.count - 1) as f64
+    }
+
+    pub fn std_dev(&self) -> f64 {
+        self.variance().sqrt()
+    }
+
+    /// How far the mean is likely to be from the true mean
+    pub fn std_error(&self) -> f64 {
+        if self.count == 0 {
+            return 0.0;
+        }
+
+        self.std_dev() / (self.count as f64).sqrt()
+    }
+}
 
-    // We can actually add a value to the average without storing the total value
-    // new_avg = ((old_avg + (current_index + 1)) + new_value) / (current_index + 2)
-    pub average: Option<f64>,
+#[derive(Debug, Serialize, Deserialize)]
+pub struct IndexValue {
+    ids: PostingList,
+    pub stats: Stats,
+    /// For percentiles of the deltas
+    pub sketch: Sketch,
 }
 
 /// The Index structure
@@ -16,16 +111,40 @@ pub struct IndexValue {
 /// Use this to create an index on any column of a Row to achieve O(log n)
 /// lookup for any key.
 ///
-/// Index { index: {String("Foo"): [1, 2]} }
+/// Index { index: {Code(0): [1, 2]} }, where the IDs are kept in a PostingList
 #[derive(Debug)]
 pub struct Index {
     pub index: BTreeMap<FieldType, IndexValue>,
+    /// One more than the largest RID that has been added, so the rows from here on are not indexed
+    pub rows: usize,
+}
+
+/// Changed whenever what is stored for each key changes, so an older index gets built again
+const INDEX_VERSION: u32 = 4;
+
+/// What gets written to disk when the index is saved
+///
+/// The map is stored as a list so that it does not need keys that serialize as strings.
+#[derive(Deserialize)]
+struct IndexCheckpoint {
+    version: u32,
+    rows: usize,
+    entries: Vec<(FieldType, IndexValue)>,
+}
+
+/// The same as IndexCheckpoint, but borrowing from the index so saving does not copy it
+#[derive(Serialize)]
+struct IndexCheckpointRef<'a> {
+    version: u32,
+    rows: usize,
+    entries: Vec<(&'a FieldType, &'a IndexValue)>,
 }
 
 impl Index {
     pub fn new() -> Self {
         return Index {
             index: BTreeMap::new(),
+            rows: 0,
         };
     }
 
@@ -33,19 +152,19 @@ impl Index {
     /// use kronicler::index::*;
     /// use kronicler::row::FieldType;
     /// use kronicler::row::Row;
-    /// use kronicler::row::create_function_name;
     ///
-    /// let name_bytes = create_function_name("Jake");
+    /// // The code of "Jake" in the name dictionary
+    /// let name_code = 0;
     ///
     /// let mut index = Index::new();
     /// let row1 = Row::new(0, vec![
-    ///     FieldType::Name(name_bytes),
+    ///     FieldType::Code(name_code),
     ///     FieldType::Epoch(10),
     ///     FieldType::Epoch(20),
     ///     FieldType::Epoch(10),
     /// ]);
     /// let row2 = Row::new(1, vec![
-    ///     FieldType::Name(name_bytes),
+    ///     FieldType::Code(name_code),
     ///     FieldType::Epoch(10),
     ///     FieldType::Epoch(20),
     ///     FieldType::Epoch(10),
@@ -55,58 +174,143 @@ impl Index {
     /// index.insert(row2, 0);
     ///
     /// let results = index.get(
-    ///     FieldType::Name(name_bytes),
+    ///     FieldType::Code(name_code),
     /// );
     ///
     /// assert_eq!(results.unwrap().len(), 2);
     /// ```
     pub fn insert(&mut self, row: Row, index_on_col: usize) {
         let key = row.fields[index_on_col].clone();
-        let index_value = self.index.get_mut(&key);
-
-        if let Some(found_index) = index_value {
-            // Update average
-            let n = found_index.ids.len();
-            if let Some(avg) = found_index.average {
-                let new_avg = ((avg * n as f64) + row.get_delta() as f64) / (n as f64 + 1.0);
-                found_index.average = Some(new_avg);
+        self.insert_value(key, row.id, row.get_delta());
+    }
+
+    /// Add the row `id` with `delta` under `key`, without needing the whole row
+    pub fn insert_value(&mut self, key: FieldType, id: RID, delta: u128) {
+        let index_value = self.index.entry(key).or_insert_with(|| IndexValue {
+            ids: PostingList::new(),
+            stats: Stats::new(),
+            sketch: Sketch::new(),
+        });
+
+        index_value.stats.add(delta);
+        index_value.sketch.add(delta);
+        index_value.ids.push(id);
+
+        self.rows = self.rows.max(id + 1);
+    }
+
+    /// Add everything from `other`, which has to only have rows after the ones in this index
+    ///
+    /// This is used to put together indexes that were built on separate threads.
+    pub fn merge(&mut self, other: Index) {
+        for (key, value) in other.index {
+            match self.index.get_mut(&key) {
+                Some(found_index) => {
+                    found_index.stats.merge(&value.stats);
+                    found_index.sketch.merge(&value.sketch);
+                    found_index.ids.extend(value.ids.iter());
+                }
+                None => {
+                    self.index.insert(key, value);
+                }
             }
+        }
 
-            // Push new value
-            found_index.ids.push(row.id);
-        } else {
-            self.index.insert(
-                key,
-                IndexValue {
-                    ids: vec![row.id],
-                    average: Some(row.get_delta() as f64),
-                },
-            );
+        self.rows = self.rows.max(other.rows);
+    }
+
+    /// Drop the IDs before `first_row`, after retention removed those rows
+    ///
+    /// The stats and sketches still count them, so they cover every row ever captured.
+    pub fn trim(&mut self, first_row: RID) {
+        for value in self.index.values_mut() {
+            value.ids.trim(first_row);
         }
     }
 
-    // `get` now returns the RID instead of the Row
+    /// Write the index to `path`
+    ///
+    /// It is written to a temporary file first, synced and then moved over the old one, so a
+    /// crash while saving leaves the last checkpoint in place.
+    pub fn save(&self, path: &Path) {
+        let checkpoint = IndexCheckpointRef {
+            version: INDEX_VERSION,
+            rows: self.rows,
+            entries: self.index.iter().collect(),
+        };
+
+        let tmp = path.with_extension("tmp");
+        {
+            let mut file = BufWriter::new(File::create(&tmp).expect("Should create index file."));
+            bincode::serialize_into(&mut file, &checkpoint).expect("Should serialize index.");
+            file.flush().expect("Should write index.");
+
+            // Synced before the rename, so a crash never leaves a partial file in its place
+            file.get_ref().sync_all().expect("Should sync index.");
+        }
+
+        fs::rename(&tmp, path).expect("Should replace index file.");
+        info!("Saved index of {} rows to {:?}", self.rows, path);
+    }
+
+    /// Read an index written by `save`, or None if there is not one that can be read
+    pub fn load(path: &Path) -> Option<Index> {
+        let file = File::open(path).ok()?;
+
+        match bincode::deserialize_from::<_, IndexCheckpoint>(BufReader::new(file)) {
+            Ok(checkpoint) if checkpoint.version != INDEX_VERSION => {
+                warn!(
+                    "Index at {:?} is version {}, not {}",
+                    path, checkpoint.version, INDEX_VERSION
+                );
+                None
+            }
+            Ok(checkpoint) => Some(Index {
+                index: checkpoint.entries.into_iter().collect(),
+                rows: checkpoint.rows,
+            }),
+            Err(e) => {
+                warn!("Could not read index at {:?}: {}", path, e);
+                None
+            }
+        }
+    }
+
+    // `get` now returns the RIDs instead of the Rows
     // This separates the concerns better because an index
     // should not worry about how to read rows, even just by
     // implementing code from elsewhere.
-    pub fn get(&self, key: FieldType) -> Option<Vec<RID>> {
-        let ids_node = self.index.get(&key);
+    pub fn get(&self, key: FieldType) -> Option<&PostingList> {
+        self.index.get(&key).map(|v| &v.ids)
+    }
 
-        if let Some(ids_vec) = ids_node {
-            return Some(ids_vec.ids.to_vec());
-        }
+    /// Go through the IDs under `key` in the order they were added, without copying them
+    pub fn ids(&self, key: &FieldType) -> PostingIter<'_> {
+        self.index
+            .get(key)
+            .map_or(PostingList::empty(), |v| &v.ids)
+            .iter()
+    }
 
-        None
+    /// Go through the IDs under `key` from the first one that is at least `since`
+    pub fn ids_from(&self, key: &FieldType, since: RID) -> PostingIter<'_> {
+        self.index
+            .get(key)
+            .map_or(PostingList::empty(), |v| &v.ids)
+            .iter_from(since)
     }
 
+    // The average is kept up to date on insert, so this is O(1) instead of reading every row
     pub fn get_average(&self, key: FieldType) -> Option<f64> {
-        let ids_node = self.index.get(&key);
+        self.get_stats(key).map(|s| s.mean)
+    }
 
-        if let Some(ids_vec) = ids_node {
-            return ids_vec.average;
-        }
+    pub fn get_stats(&self, key: FieldType) -> Option<&Stats> {
+        self.index.get(&key).map(|v| &v.stats)
+    }
 
-        None
+    pub fn get_sketch(&self, key: FieldType) -> Option<&Sketch> {
+        self.index.get(&key).map(|v| &v.sketch)
     }
 }
 
@@ -114,19 +318,17 @@ impl Index {
 mod tests {
     use super::*;
 
-    use crate::row::create_function_name;
-
     #[test]
     fn basic_insert_test() {
         let mut rows = Vec::new();
         let mut index = Index::new();
 
-        let name_bytes = create_function_name("Jake");
+        let name_code = 0;
 
         let row_1 = Row::new(
             0,
             vec![
-                FieldType::Name(name_bytes),
+                FieldType::Code(name_code),
                 FieldType::Epoch(10),
                 FieldType::Epoch(20),
                 FieldType::Epoch(10),
@@ -136,21 +338,21 @@ mod tests {
 
         index.insert(row_1, 0);
 
-        let fetched_rows = index.get(FieldType::Name(name_bytes));
+        let fetched_rows = index.get(FieldType::Code(name_code));
 
-        assert_eq!(fetched_rows.unwrap()[0], 0);
+        assert_eq!(fetched_rows.unwrap().iter().next(), Some(0));
     }
 
     #[test]
     fn duplicate_insert_test() {
         let mut index = Index::new();
 
-        let name_bytes = create_function_name("Foo");
+        let name_code = 0;
 
         let row_2 = Row::new(
             1,
             vec![
-                FieldType::Name(name_bytes),
+                FieldType::Code(name_code),
                 FieldType::Epoch(10),
                 FieldType::Epoch(20),
                 FieldType::Epoch(10),
@@ -159,7 +361,7 @@ mod tests {
         let row_3 = Row::new(
             2,
             vec![
-                FieldType::Name(name_bytes),
+                FieldType::Code(name_code),
                 FieldType::Epoch(11),
                 FieldType::Epoch(21),
                 FieldType::Epoch(10),
@@ -168,8 +370,8 @@ mod tests {
         index.insert(row_2, 0);
         index.insert(row_3, 0);
 
-        let fetched_rows_opt_2 = index.get(FieldType::Name(name_bytes));
-        let fetched_rows_2 = fetched_rows_opt_2.unwrap();
+        let fetched_rows_opt_2 = index.get(FieldType::Code(name_code));
+        let fetched_rows_2: Vec<RID> = fetched_rows_opt_2.unwrap().iter().collect();
 
         println!("{:?}", index);
 
@@ -181,9 +383,9 @@ mod tests {
     fn get_nonexistent_key_test() {
         let index = Index::new();
 
-        let name_bytes = create_function_name("NonExistent");
+        let name_code = 0;
 
-        let result = index.get(FieldType::Name(name_bytes));
+        let result = index.get(FieldType::Code(name_code));
         assert!(result.is_none());
     }
 
@@ -191,12 +393,12 @@ mod tests {
     fn index_on_epoch_column_test() {
         let mut index = Index::new();
 
-        let name_bytes = create_function_name("Test");
+        let name_code = 0;
 
         let row_1 = Row::new(
             0,
             vec![
-                FieldType::Name(name_bytes),
+                FieldType::Code(name_code),
                 FieldType::Epoch(100),
                 FieldType::Epoch(200),
                 FieldType::Epoch(100),
@@ -205,7 +407,7 @@ mod tests {
         let row_2 = Row::new(
             1,
             vec![
-                FieldType::Name(name_bytes),
+                FieldType::Code(name_code),
                 FieldType::Epoch(100),
                 FieldType::Epoch(300),
                 FieldType::Epoch(200),
@@ -224,12 +426,12 @@ mod tests {
     fn average_calculation_single_row_test() {
         let mut index = Index::new();
 
-        let name_bytes = create_function_name("Jake");
+        let name_code = 0;
 
         let row = Row::new(
             0,
             vec![
-                FieldType::Name(name_bytes),
+                FieldType::Code(name_code),
                 FieldType::Epoch(10),
                 FieldType::Epoch(20),
                 FieldType::Epoch(10),
@@ -238,7 +440,7 @@ mod tests {
 
         index.insert(row, 0);
 
-        let avg = index.get_average(FieldType::Name(name_bytes));
+        let avg = index.get_average(FieldType::Code(name_code));
         assert!(avg.is_some());
         assert_eq!(avg.unwrap(), 10.0);
     }
@@ -247,12 +449,12 @@ mod tests {
     fn average_calculation_multiple_rows_test() {
         let mut index = Index::new();
 
-        let name_bytes = create_function_name("Test");
+        let name_code = 0;
 
         let row_1 = Row::new(
             0,
             vec![
-                FieldType::Name(name_bytes),
+                FieldType::Code(name_code),
                 FieldType::Epoch(10),
                 FieldType::Epoch(20),
                 FieldType::Epoch(10),
@@ -261,7 +463,7 @@ mod tests {
         let row_2 = Row::new(
             1,
             vec![
-                FieldType::Name(name_bytes),
+                FieldType::Code(name_code),
                 FieldType::Epoch(10),
                 FieldType::Epoch(30),
                 FieldType::Epoch(20),
@@ -270,7 +472,7 @@ mod tests {
         let row_3 = Row::new(
             2,
             vec![
-                FieldType::Name(name_bytes),
+                FieldType::Code(name_code),
                 FieldType::Epoch(10),
                 FieldType::Epoch(40),
                 FieldType::Epoch(30),
@@ -281,7 +483,7 @@ mod tests {
         index.insert(row_2, 0);
         index.insert(row_3, 0);
 
-        let avg = index.get_average(FieldType::Name(name_bytes));
+        let avg = index.get_average(FieldType::Code(name_code));
         assert!(avg.is_some());
         // Deltas are: 10, 20, 30. Average = 20.0
         assert_eq!(avg.unwrap(), 20.0);
@@ -291,9 +493,9 @@ mod tests {
     fn average_nonexistent_key_test() {
         let index = Index::new();
 
-        let name_bytes = create_function_name("Missing");
+        let name_code = 0;
 
-        let avg = index.get_average(FieldType::Name(name_bytes));
+        let avg = index.get_average(FieldType::Code(name_code));
         assert!(avg.is_none());
     }
 
@@ -301,13 +503,13 @@ mod tests {
     fn multiple_keys_test() {
         let mut index = Index::new();
 
-        let name_bytes_1 = create_function_name("Alice");
-        let name_bytes_2 = create_function_name("Bob");
+        let name_code_1 = 0;
+        let name_code_2 = 1;
 
         let row_1 = Row::new(
             0,
             vec![
-                FieldType::Name(name_bytes_1),
+                FieldType::Code(name_code_1),
                 FieldType::Epoch(10),
                 FieldType::Epoch(20),
                 FieldType::Epoch(10),
@@ -316,7 +518,7 @@ mod tests {
         let row_2 = Row::new(
             1,
             vec![
-                FieldType::Name(name_bytes_2),
+                FieldType::Code(name_code_2),
                 FieldType::Epoch(15),
                 FieldType::Epoch(30),
                 FieldType::Epoch(15),
@@ -325,7 +527,7 @@ mod tests {
         let row_3 = Row::new(
             2,
             vec![
-                FieldType::Name(name_bytes_1),
+                FieldType::Code(name_code_1),
                 FieldType::Epoch(20),
                 FieldType::Epoch(40),
                 FieldType::Epoch(20),
@@ -336,8 +538,8 @@ mod tests {
         index.insert(row_2, 0);
         index.insert(row_3, 0);
 
-        let alice_rows = index.get(FieldType::Name(name_bytes_1));
-        let bob_rows = index.get(FieldType::Name(name_bytes_2));
+        let alice_rows = index.get(FieldType::Code(name_code_1));
+        let bob_rows = index.get(FieldType::Code(name_code_2));
 
         assert_eq!(alice_rows.unwrap().len(), 2);
         assert_eq!(bob_rows.unwrap().len(), 1);
@@ -353,14 +555,14 @@ mod tests {
     fn large_batch_insert_test() {
         let mut index = Index::new();
 
-        let name_bytes = create_function_name("Batch");
+        let name_code = 0;
 
         // Insert 100 rows with the same key
         for i in 0..100 {
             let row = Row::new(
                 i,
                 vec![
-                    FieldType::Name(name_bytes),
+                    FieldType::Code(name_code),
                     FieldType::Epoch(i as u128 * 10),
                     FieldType::Epoch(i as u128 * 20),
                     FieldType::Epoch(i as u128 * 10),
@@ -369,7 +571,7 @@ mod tests {
             index.insert(row, 0);
         }
 
-        let fetched_rows = index.get(FieldType::Name(name_bytes));
+        let fetched_rows = index.get(FieldType::Code(name_code));
         assert_eq!(fetched_rows.unwrap().len(), 100);
     }
 
@@ -377,13 +579,13 @@ mod tests {
     fn index_preserves_insertion_order_test() {
         let mut index = Index::new();
 
-        let name_bytes = create_function_name("Order");
+        let name_code = 0;
 
         for i in 0..5 {
             let row = Row::new(
                 i,
                 vec![
-                    FieldType::Name(name_bytes),
+                    FieldType::Code(name_code),
                     FieldType::Epoch(100),
                     FieldType::Epoch(200),
                     FieldType::Epoch(100),
@@ -392,9 +594,129 @@ mod tests {
             index.insert(row, 0);
         }
 
-        let fetched_rows = index.get(FieldType::Name(name_bytes)).unwrap();
+        let fetched_rows: Vec<RID> = index.ids(&FieldType::Code(name_code)).collect();
         for i in 0..5 {
             assert_eq!(fetched_rows[i], i as RID);
         }
     }
+
+    fn index_of(ids: std::ops::Range<usize>) -> Index {
+        let mut index = Index::new();
+        for id in ids {
+            index.insert_value(FieldType::Code((id % 3) as u32), id, id as u128);
+        }
+        index
+    }
+
+    #[test]
+    fn trim_test() {
+        let mut index = index_of(0..30);
+        index.trim(10);
+
+        assert_eq!(
+            index.ids(&FieldType::Code(0)).collect::<Vec<_>>(),
+            [12, 15, 18, 21, 24, 27]
+        );
+        assert_eq!(index.ids(&FieldType::Code(1)).next(), Some(10));
+        assert_eq!(index.ids_from(&FieldType::Code(1), 20).next(), Some(22));
+        assert_eq!(index.ids(&FieldType::Code(7)).next(), None);
+
+        // The stats still count the rows that were dropped
+        assert_eq!(index.get_stats(FieldType::Code(0)).unwrap().count, 10);
+    }
+
+    #[test]
+    fn merge_matches_single_index_test() {
+        let whole = index_of(0..100);
+
+        let mut merged = index_of(0..40);
+        merged.merge(index_of(40..100));
+
+        assert_eq!(merged.rows, 100);
+        for code in 0..3 {
+            let key = FieldType::Code(code);
+            assert_eq!(merged.get(key.clone()), whole.get(key.clone()));
+
+            let a = merged.get_stats(key.clone()).unwrap();
+            let b = whole.get_stats(key.clone()).unwrap();
+            assert_eq!(
+                (a.count, a.sum, a.min, a.max),
+                (b.count, b.sum, b.min, b.max)
+            );
+            assert!((a.mean - b.mean).abs() < 1e-9);
+            assert!((a.variance() - b.variance()).abs() < 1e-6);
+
+            assert_eq!(merged.get_sketch(key.clone()), whole.get_sketch(key));
+        }
+    }
+
+    #[test]
+    fn stats_test() {
+        let mut index = Index::new();
+        let key = FieldType::Code(0);
+
+        for (id, delta) in [2u128, 4, 4, 4, 5, 5, 7, 9].into_iter().enumerate() {
+            index.insert_value(key.clone(), id, delta);
+        }
+
+        let stats = index.get_stats(key).unwrap();
+        assert_eq!(stats.count, 8);
+        assert_eq!(stats.sum, 40);
+        assert_eq!(stats.min, 2);
+        assert_eq!(stats.max, 9);
+        assert_eq!(stats.mean, 5.0);
+
+        // Sum of squared distances from the mean is 32
+        assert!((stats.variance() - 32.0 / 7.0).abs() < 1e-9);
+        assert!((stats.std_error() - (32.0f64 / 7.0).sqrt() / 8f64.sqrt()).abs() < 1e-9);
+    }
+
+    #[test]
+    fn stats_large_values_test() {
+        // Deltas far from zero and close together, where a sum of squares would lose the variance
+        let mut stats = Stats::new();
+        for v in [
+            1_000_000_000_004u128,
+            1_000_000_000_007,
+            1_000_000_000_013,
+            1_000_000_000_016,
+        ] {
+            stats.add(v);
+        }
+
+        assert!((stats.variance() - 30.0).abs() < 1e-6);
+
+        let mut single = Stats::new();
+        single.add(5);
+        assert_eq!(single.variance(), 0.0);
+        assert_eq!(Stats::new().std_error(), 0.0);
+    }
+
+    #[test]
+    fn save_and_load_test() {
+        let dir = Path::new("./").join(crate::constants::DATA_DIRECTORY);
+        let _ = fs::create_dir_all(&dir);
+        let path = dir.join("index-test.data");
+
+        let index = index_of(0..50);
+        index.save(&path);
+
+        let loaded = Index::load(&path).expect("Should load index.");
+        assert_eq!(loaded.rows, 50);
+        assert_eq!(
+            loaded.get(FieldType::Code(1)),
+            index.get(FieldType::Code(1))
+        );
+        assert_eq!(
+            loaded.get_average(FieldType::Code(2)),
+            index.get_average(FieldType::Code(2))
+        );
+
+        // A file that is not an index is treated as missing
+        fs::write(&path, b"not an index").unwrap();
+        assert!(Index::load(&path).is_none());
+
+        let _ = fs::remove_file(&path);
+        assert!(Index::load(&path).is_none());
+    }
 }
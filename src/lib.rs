@@ -1,18 +1,30 @@
-use database::Database;
+use database::{Database, Scan};
 use pyo3::prelude::*;
 use row::Row;
 
 pub mod bufferpool;
 pub mod capture;
+pub mod cluster;
 pub mod column;
 pub mod constants;
 pub mod database;
+pub mod dictionary;
+pub mod encoding;
 pub mod filewriter;
 pub mod index;
 pub mod metadata;
 pub mod page;
+pub mod postings;
 pub mod queue;
+pub mod retention;
+pub mod rollup;
 pub mod row;
+pub mod sealed;
+pub mod segment;
+pub mod shard;
+pub mod sketch;
+pub mod wal;
+pub mod watermark;
 
 /// Setup env logging
 ///
@@ -33,6 +45,7 @@ fn kronicler(m: &Bound<'_, PyModule>) -> PyResult<()> {
 
     m.add_class::<Database>()?;
     m.add_class::<Row>()?;
+    m.add_class::<Scan>()?;
     m.add_function(wrap_pyfunction!(database::database_init, m)?)?;
     Ok(())
 }
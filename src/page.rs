@@ -1,51 +1,69 @@
-use super::constants::{DATA_DIRECTORY, PAGE_SIZE};
+use super::constants::PAGE_SIZE;
 use super::row::FieldType;
+use super::segment::ColumnSegments;
 use log::info;
-use std::fs::File;
-use std::io::prelude::*;
-use std::path::{Path, PathBuf};
 
 pub type PageID = usize;
 
 #[derive(Debug)]
 pub struct Page {
     pid: PageID,
-    data: Option<[u8; PAGE_SIZE]>,
+    data: Option<Vec<u8>>,
+    // How many bytes the page holds, PAGE_SIZE or a larger extent size
+    capacity: usize,
     index: usize,
     // Either 16 or 64
     field_type_size: usize,
     column_index: usize,
+    // Set when the in-memory data differs from what is on disk
+    dirty: bool,
 }
 
 impl Page {
-    pub fn open(&mut self) {
-        let path = self.get_page_path();
-
-        if !path.exists() {
-            self.write_page();
-        }
-
-        let data = self.read_page();
+    /// Load the page from the segment files of its column
+    pub fn open(&mut self, segments: &mut ColumnSegments) {
+        let data = self.read_page(segments);
 
         self.data = Some(data);
 
-        info!("Wrote page data.");
+        info!("Opened page {} of column {}.", self.pid, self.column_index);
     }
 
     pub fn new(pid: PageID, column_index: usize, field_type_size: usize) -> Self {
+        Page::with_capacity(pid, column_index, field_type_size, PAGE_SIZE)
+    }
+
+    /// Make a page that holds `capacity` bytes instead of PAGE_SIZE
+    ///
+    /// Larger pages are used as extents, so a sequential scan needs fewer, bigger reads.
+    pub fn with_capacity(
+        pid: PageID,
+        column_index: usize,
+        field_type_size: usize,
+        capacity: usize,
+    ) -> Self {
         Page {
             pid,
             data: None,
+            capacity,
             index: 0,
             field_type_size,
             column_index,
+            dirty: false,
         }
     }
 
-    pub fn get_page_path(&self) -> PathBuf {
-        Path::new("./")
-            .join(DATA_DIRECTORY)
-            .join(format!("page_{}_{}.data", self.column_index, self.pid))
+    /// Where the page starts in the segment files of its column
+    pub fn offset(&self) -> u64 {
+        (self.pid * self.capacity) as u64
+    }
+
+    pub fn pid(&self) -> PageID {
+        self.pid
+    }
+
+    pub fn column_index(&self) -> usize {
+        self.column_index
     }
 
     /// Write a whole page to disk
@@ -66,28 +84,15 @@ impl Page {
     /// ```
     ///
     /// Write functions are for writing a Page from disk and not changing any state
-    pub fn write_page(&self) {
-        let filename = self.get_page_path();
-
-        // TODO: It should not create a new file each time right?
-        let file = File::create(&filename);
-
-        match file {
-            Ok(mut fp) => {
-                // This is the fastest way to do this
-                // I do not know all of the conditions that are needed to make this not break
-                // TODO: Prove that this works always
-                if let Some(d) = self.data {
-                    let bytes: [u8; PAGE_SIZE] = unsafe { std::mem::transmute(d) };
-
-                    info!("Writing data to {:?}.", filename);
-                    // TODO: Use this result
-                    fp.write_all(&bytes).expect("Should be able to write.");
-                }
-            }
-            Err(..) => {
-                println!("Error: Cannot open database file.");
-            }
+    pub fn write_page(&self, segments: &mut ColumnSegments) {
+        if let Some(d) = &self.data {
+            info!(
+                "Writing page {} of column {} at {}.",
+                self.pid,
+                self.column_index,
+                self.offset()
+            );
+            segments.write(self.offset(), d);
         }
     }
 
@@ -111,33 +116,23 @@ impl Page {
     /// ```
     ///
     /// Read functions are for pulling a Page from disk and does not mutate the state of the Page
-    pub fn read_page(&self) -> [u8; PAGE_SIZE] {
-        let filename = self.get_page_path();
+    pub fn read_page(&self, segments: &mut ColumnSegments) -> Vec<u8> {
+        let mut buf = vec![0u8; self.capacity];
 
-        info!("Trying to open {:?}", filename);
-        let mut file = File::open(filename).expect("Should open file.");
-        let mut buf: [u8; PAGE_SIZE] = [0; PAGE_SIZE];
-
-        let _ = file.read(&mut buf[..]).expect("Should read.");
-
-        // TODO: Make sure this works as expected always
-        // TODO: Maybe this is not needed if input and output is the same type
-        // This changed later, so maybe I can remove this now
-        let values: [u8; PAGE_SIZE] = unsafe { std::mem::transmute(buf) };
-        return values;
+        // A page that was never written reads as zeros
+        segments.read(self.offset(), &mut buf);
+        return buf;
     }
 
     /// Set functions are for changing internal state of a Page
     pub fn set_value(&mut self, index: usize, value: FieldType) {
         if let Some(d) = &mut self.data {
             match value {
-                FieldType::Name(a) => {
-                    let mut i = 0;
-
-                    for v in a {
-                        d[index + i] = v;
-                        i += 1;
-                    }
+                FieldType::Name(_) => {
+                    unreachable!("Names are kept in the name dictionary, pages store their code")
+                }
+                FieldType::Code(c) => {
+                    d[index..index + 4].copy_from_slice(&c.to_le_bytes());
                 }
                 FieldType::Epoch(a) => {
                     let mut i = 0;
@@ -153,40 +148,38 @@ impl Page {
         }
 
         self.index += self.field_type_size;
+        self.dirty = true;
     }
 
     /// Set functions are for changing internal state of a Page
-    pub fn set_all_values(&mut self, input: [u8; PAGE_SIZE]) {
-        self.data = Some(input);
+    pub fn set_all_values<T: Into<Vec<u8>>>(&mut self, input: T) {
+        let mut data = input.into();
+        data.resize(self.capacity, 0);
+        self.data = Some(data);
+        self.dirty = true;
     }
 
-    /// Get functions are for getting internal state of a Page
-    pub fn get_value(&self, index: usize) -> Option<FieldType> {
-        if let Some(d) = self.data {
-            let mut vals = [0u8; 64];
-
-            for i in 0..self.field_type_size {
-                vals[i] = d[index + i];
-            }
-
-            // TODO: Don't hardcode sizes of data like this
-            if self.field_type_size == 16 {
-                let mut b: [u8; 16] = [0; 16];
+    /// Set functions are for changing internal state of a Page
+    ///
+    /// Call this after the page has been written so it is not flushed again
+    pub fn mark_clean(&mut self) {
+        self.dirty = false;
+    }
 
-                let mut i = 0;
-                for v in &vals[0..16] {
-                    b[i] = *v;
-                    i += 1;
-                }
+    /// Get functions are for getting internal state of a Page
+    pub fn bytes(&self) -> Option<&[u8]> {
+        self.data.as_deref()
+    }
 
-                let a: u128 = unsafe { std::mem::transmute(b) };
-                return Some(FieldType::Epoch(a));
-            }
+    /// Get functions are for getting internal state of a Page
+    pub fn is_dirty(&self) -> bool {
+        self.dirty
+    }
 
-            // TODO: Don't hardcode sizes of data like this
-            if self.field_type_size == 64 {
-                return Some(FieldType::Name(vals));
-            }
+    /// Get functions are for getting internal state of a Page
+    pub fn get_value(&self, index: usize) -> Option<FieldType> {
+        if let Some(d) = &self.data {
+            return decode_value(&d[index..], self.field_type_size);
         }
 
         None
@@ -197,29 +190,53 @@ impl Page {
     }
 
     pub fn capacity(&self) -> usize {
-        PAGE_SIZE
+        self.capacity
+    }
+}
+
+/// Read the value at the start of `bytes`
+///
+/// This is used both for pages in the bufferpool and for bytes read straight from a segment.
+pub fn decode_value(bytes: &[u8], field_type_size: usize) -> Option<FieldType> {
+    // TODO: Don't hardcode sizes of data like this
+    if field_type_size == 16 {
+        let mut b: [u8; 16] = [0; 16];
+        b.copy_from_slice(&bytes[0..16]);
+
+        return Some(FieldType::Epoch(u128::from_le_bytes(b)));
+    }
+
+    // TODO: Don't hardcode sizes of data like this
+    if field_type_size == 4 {
+        let mut b: [u8; 4] = [0; 4];
+        b.copy_from_slice(&bytes[0..4]);
+
+        return Some(FieldType::Code(u32::from_le_bytes(b)));
     }
+
+    None
 }
 
 #[cfg(test)]
 mod tests {
     use super::*;
+    use crate::constants::DATA_DIRECTORY;
     use std::fs;
+    use std::path::Path;
 
-    use crate::row::create_function_name;
-
-    fn cleanup_test_page(page: &Page) {
-        let path = page.get_page_path();
-        if path.exists() {
-            let _ = fs::remove_file(path);
-        }
+    // Use column indices that the database itself does not use
+    fn cleanup_test_segments(column_index: usize) {
+        let _ = fs::remove_file(ColumnSegments::get_segment_path(column_index, 0));
     }
 
-    fn ensure_data_directory() {
+    fn test_segments(column_index: usize) -> ColumnSegments {
         let path = Path::new("./").join(DATA_DIRECTORY);
         if !path.exists() {
             let _ = fs::create_dir_all(path);
         }
+
+        cleanup_test_segments(column_index);
+        ColumnSegments::new(column_index)
     }
 
     #[test]
@@ -234,30 +251,31 @@ mod tests {
     }
 
     #[test]
-    fn test_page_path_generation() {
+    fn test_page_offset() {
         let page = Page::new(5, 3, 16);
-        let path = page.get_page_path();
+        assert_eq!(page.offset(), 5 * PAGE_SIZE as u64);
 
-        assert!(path.to_string_lossy().contains("page_3_5.data"));
+        let extent = Page::with_capacity(5, 3, 16, 64 * 1024);
+        assert_eq!(extent.offset(), 5 * 64 * 1024);
     }
 
     #[test]
-    fn test_open_creates_file_if_not_exists() {
-        ensure_data_directory();
-        let mut page = Page::new(100, 0, 16);
+    fn test_open_unwritten_page_reads_zeros() {
+        let mut segments = test_segments(3000);
+        let mut page = Page::new(100, 3000, 16);
 
-        page.open();
+        page.open(&mut segments);
 
-        assert!(page.get_page_path().exists());
         assert!(page.data.is_some());
+        assert_eq!(page.get_value(0), Some(FieldType::Epoch(0)));
 
-        cleanup_test_page(&page);
+        cleanup_test_segments(3000);
     }
 
     #[test]
     fn test_set_and_get_epoch_value() {
         let mut page = Page::new(0, 0, 16);
-        page.data = Some([0u8; PAGE_SIZE]);
+        page.data = Some(vec![0u8; PAGE_SIZE]);
 
         let epoch_value = FieldType::Epoch(12345);
         page.set_value(0, epoch_value);
@@ -273,31 +291,26 @@ mod tests {
     }
 
     #[test]
-    fn test_set_and_get_name_value() {
-        let mut page = Page::new(0, 0, 64);
-        page.data = Some([0u8; PAGE_SIZE]);
-
-        let mut name_bytes = [0u8; 64];
-        let name_str = "TestName";
-        let bytes = name_str.as_bytes();
-        name_bytes[..bytes.len()].copy_from_slice(bytes);
+    fn test_set_and_get_code_value() {
+        let mut page = Page::new(0, 0, 4);
+        page.data = Some(vec![0u8; PAGE_SIZE]);
 
-        page.set_value(0, FieldType::Name(name_bytes));
+        page.set_value(0, FieldType::Code(42));
 
         let retrieved = page.get_value(0);
         assert!(retrieved.is_some());
 
-        if let Some(FieldType::Name(val)) = retrieved {
-            assert_eq!(&val[..bytes.len()], bytes);
+        if let Some(FieldType::Code(val)) = retrieved {
+            assert_eq!(val, 42);
         } else {
-            panic!("Expected Name value");
+            panic!("Expected Code value");
         }
     }
 
     #[test]
     fn test_multiple_epoch_values() {
         let mut page = Page::new(0, 0, 16);
-        page.data = Some([0u8; PAGE_SIZE]);
+        page.data = Some(vec![0u8; PAGE_SIZE]);
 
         // Set multiple epoch values
         page.set_value(0, FieldType::Epoch(100));
@@ -323,7 +336,7 @@ mod tests {
         page.set_all_values(test_data);
 
         assert!(page.data.is_some());
-        if let Some(data) = page.data {
+        if let Some(data) = &page.data {
             for i in 0..100 {
                 assert_eq!(data[i], (i % 256) as u8);
             }
@@ -333,7 +346,7 @@ mod tests {
     #[test]
     fn test_page_size_tracking() {
         let mut page = Page::new(0, 0, 16);
-        page.data = Some([0u8; PAGE_SIZE]);
+        page.data = Some(vec![0u8; PAGE_SIZE]);
 
         assert_eq!(page.size(), 0);
 
@@ -344,6 +357,20 @@ mod tests {
         assert_eq!(page.size(), 32);
     }
 
+    #[test]
+    fn test_set_value_marks_page_dirty() {
+        let mut page = Page::new(0, 0, 16);
+        page.data = Some(vec![0u8; PAGE_SIZE]);
+
+        assert!(!page.is_dirty());
+
+        page.set_value(0, FieldType::Epoch(100));
+        assert!(page.is_dirty());
+
+        page.mark_clean();
+        assert!(!page.is_dirty());
+    }
+
     #[test]
     fn test_page_capacity() {
         let page = Page::new(0, 0, 16);
@@ -352,8 +379,8 @@ mod tests {
 
     #[test]
     fn test_write_and_read_page() {
-        ensure_data_directory();
-        let mut page = Page::new(200, 1, 16);
+        let mut segments = test_segments(3001);
+        let mut page = Page::new(200, 3001, 16);
         let mut test_data = [0u8; PAGE_SIZE];
 
         // Create a pattern to verify
@@ -362,13 +389,13 @@ mod tests {
         }
 
         page.set_all_values(test_data);
-        page.write_page();
+        page.write_page(&mut segments);
 
         // Create a new page and read from disk
-        let mut page2 = Page::new(200, 1, 16);
-        page2.open();
+        let mut page2 = Page::new(200, 3001, 16);
+        page2.open(&mut ColumnSegments::new(3001));
 
-        if let Some(read_data) = page2.data {
+        if let Some(read_data) = &page2.data {
             for i in 0..1000 {
                 assert_eq!(read_data[i], ((i * 7) % 256) as u8);
             }
@@ -376,7 +403,29 @@ mod tests {
             panic!("Expected data to be loaded");
         }
 
-        cleanup_test_page(&page);
+        cleanup_test_segments(3001);
+    }
+
+    #[test]
+    fn test_extent_page_persistence() {
+        let mut segments = test_segments(3005);
+        let extent_size = 64 * 1024;
+        let mut page = Page::with_capacity(700, 3005, 16, extent_size);
+        page.open(&mut segments);
+
+        assert_eq!(page.capacity(), extent_size);
+
+        // Write past the first 4KB of the extent
+        let last = extent_size - 16;
+        page.set_value(last, FieldType::Epoch(4242));
+        page.write_page(&mut segments);
+
+        let mut page2 = Page::with_capacity(700, 3005, 16, extent_size);
+        page2.open(&mut ColumnSegments::new(3005));
+
+        assert_eq!(page2.get_value(last), Some(FieldType::Epoch(4242)));
+
+        cleanup_test_segments(3005);
     }
 
     #[test]
@@ -388,9 +437,9 @@ mod tests {
 
     #[test]
     fn test_epoch_value_persistence() {
-        ensure_data_directory();
-        let mut page = Page::new(300, 2, 16);
-        page.data = Some([0u8; PAGE_SIZE]);
+        let mut segments = test_segments(3002);
+        let mut page = Page::new(300, 3002, 16);
+        page.data = Some(vec![0u8; PAGE_SIZE]);
 
         // Set multiple epoch values
         let values = vec![12345u128, 67890, 11111, 22222, 33333];
@@ -398,11 +447,11 @@ mod tests {
             page.set_value(i * 16, FieldType::Epoch(val));
         }
 
-        page.write_page();
+        page.write_page(&mut segments);
 
         // Read back from disk
-        let mut page2 = Page::new(300, 2, 16);
-        page2.open();
+        let mut page2 = Page::new(300, 3002, 16);
+        page2.open(&mut ColumnSegments::new(3002));
 
         // Verify all values
         for (i, &expected) in values.iter().enumerate() {
@@ -413,69 +462,68 @@ mod tests {
             }
         }
 
-        cleanup_test_page(&page);
+        cleanup_test_segments(3002);
     }
 
     #[test]
-    fn test_name_value_persistence() {
-        ensure_data_directory();
-        let mut page = Page::new(400, 3, 64);
-        page.data = Some([0u8; PAGE_SIZE]);
+    fn test_code_value_persistence() {
+        let mut segments = test_segments(3003);
+        let mut page = Page::new(400, 3003, 4);
+        page.data = Some(vec![0u8; PAGE_SIZE]);
 
-        let names = vec!["Alice", "Bob", "Charlie", "Diana"];
+        let codes = vec![0u32, 1, 2, u32::MAX];
 
-        for (i, &name) in names.iter().enumerate() {
-            let name_bytes = create_function_name(name);
-            page.set_value(i * 64, FieldType::Name(name_bytes));
+        for (i, &code) in codes.iter().enumerate() {
+            page.set_value(i * 4, FieldType::Code(code));
         }
 
-        page.write_page();
+        page.write_page(&mut segments);
 
         // Read back from disk
-        let mut page2 = Page::new(400, 3, 64);
-        page2.open();
-
-        // Verify all names
-        for (i, &expected_name) in names.iter().enumerate() {
-            if let Some(FieldType::Name(val)) = page2.get_value(i * 64) {
-                let expected_bytes = expected_name.as_bytes();
-                assert_eq!(&val[..expected_bytes.len()], expected_bytes);
+        let mut page2 = Page::new(400, 3003, 4);
+        page2.open(&mut ColumnSegments::new(3003));
+
+        // Verify all codes
+        for (i, &expected_code) in codes.iter().enumerate() {
+            if let Some(FieldType::Code(val)) = page2.get_value(i * 4) {
+                assert_eq!(val, expected_code);
             } else {
-                panic!("Expected Name value at index {}", i);
+                panic!("Expected Code value at index {}", i);
             }
         }
 
-        cleanup_test_page(&page);
+        cleanup_test_segments(3003);
     }
 
     #[test]
     fn test_different_column_indices() {
-        ensure_data_directory();
-        let mut page1 = Page::new(500, 0, 16);
-        let mut page2 = Page::new(500, 1, 16);
+        let mut segments1 = test_segments(3006);
+        let mut segments2 = test_segments(3007);
+        let mut page1 = Page::new(500, 3006, 16);
+        let mut page2 = Page::new(500, 3007, 16);
 
-        page1.data = Some([1u8; PAGE_SIZE]);
-        page2.data = Some([2u8; PAGE_SIZE]);
+        page1.data = Some(vec![1u8; PAGE_SIZE]);
+        page2.data = Some(vec![2u8; PAGE_SIZE]);
 
-        page1.write_page();
-        page2.write_page();
+        page1.write_page(&mut segments1);
+        page2.write_page(&mut segments2);
 
         // Verify different files were created
-        let path1 = page1.get_page_path();
-        let path2 = page2.get_page_path();
+        let path1 = ColumnSegments::get_segment_path(3006, 0);
+        let path2 = ColumnSegments::get_segment_path(3007, 0);
 
         assert_ne!(path1, path2);
         assert!(path1.exists());
         assert!(path2.exists());
 
-        cleanup_test_page(&page1);
-        cleanup_test_page(&page2);
+        cleanup_test_segments(3006);
+        cleanup_test_segments(3007);
     }
 
     #[test]
     fn test_large_epoch_values() {
         let mut page = Page::new(0, 0, 16);
-        page.data = Some([0u8; PAGE_SIZE]);
+        page.data = Some(vec![0u8; PAGE_SIZE]);
 
         let max_value = u128::MAX;
         page.set_value(0, FieldType::Epoch(max_value));
@@ -488,24 +536,18 @@ mod tests {
     }
 
     #[test]
-    fn test_empty_name_value() {
-        let mut page = Page::new(0, 0, 64);
-        page.data = Some([0u8; PAGE_SIZE]);
-
-        let name_bytes = [0u8; 64];
-        page.set_value(0, FieldType::Name(name_bytes));
+    #[should_panic]
+    fn test_name_value_is_not_stored_in_page() {
+        let mut page = Page::new(0, 0, 4);
+        page.data = Some(vec![0u8; PAGE_SIZE]);
 
-        if let Some(FieldType::Name(val)) = page.get_value(0) {
-            assert_eq!(val, name_bytes);
-        } else {
-            panic!("Expected Name value");
-        }
+        page.set_value(0, FieldType::Name("name".to_string()));
     }
 
     #[test]
     fn test_sequential_writes() {
         let mut page = Page::new(0, 0, 16);
-        page.data = Some([0u8; PAGE_SIZE]);
+        page.data = Some(vec![0u8; PAGE_SIZE]);
 
         let initial_size = page.size();
 
@@ -520,16 +562,16 @@ mod tests {
 
     #[test]
     fn test_page_reopen() {
-        ensure_data_directory();
-        let mut page = Page::new(600, 4, 16);
-        page.data = Some([0u8; PAGE_SIZE]);
+        let mut segments = test_segments(3004);
+        let mut page = Page::new(600, 3004, 16);
+        page.data = Some(vec![0u8; PAGE_SIZE]);
 
         page.set_value(0, FieldType::Epoch(999));
-        page.write_page();
+        page.write_page(&mut segments);
 
         // Open the same page again
-        let mut page2 = Page::new(600, 4, 16);
-        page2.open();
+        let mut page2 = Page::new(600, 3004, 16);
+        page2.open(&mut segments);
 
         if let Some(FieldType::Epoch(val)) = page2.get_value(0) {
             assert_eq!(val, 999);
@@ -537,6 +579,6 @@ mod tests {
             panic!("Expected Epoch value");
         }
 
-        cleanup_test_page(&page);
+        cleanup_test_segments(3004);
     }
 }
@@ -0,0 +1,346 @@
+use super::constants::POSTING_CHUNK_IDS;
+use super::row::RID;
+use serde::{Deserialize, Serialize};
+
+// The row IDs of one key of the name index are kept as a compressed posting list.
+//
+// IDs are only ever added in order, so instead of 8 bytes for every ID the list keeps the gap
+// from the ID before it as a LEB128 varint: 7 bits per byte, with the top bit set on every byte
+// but the last. A function that is called often has small gaps, which take one or two bytes.
+//
+// The IDs are split into chunks of POSTING_CHUNK_IDS. Each chunk keeps its first ID as it is,
+// where the gaps of the rest of it start and how many IDs come before it. Finding the first ID
+// from some row on is then a binary search over the chunks and decoding at most one chunk, and
+// dropping the IDs at the start only has to encode one chunk again.
+
+/// Add `value` to `out` as a varint
+fn write_varint(out: &mut Vec<u8>, mut value: u64) {
+    while value >= 0x80 {
+        out.push(value as u8 | 0x80);
+        value >>= 7;
+    }
+    out.push(value as u8);
+}
+
+/// Read a varint from the start of `bytes`, returning it and how many bytes it took
+fn read_varint(bytes: &[u8]) -> (u64, usize) {
+    let mut value = 0;
+
+    for (i, b) in bytes.iter().enumerate() {
+        value |= ((b & 0x7f) as u64) << (7 * i);
+
+        if b & 0x80 == 0 {
+            return (value, i + 1);
+        }
+    }
+
+    (value, bytes.len())
+}
+
+#[derive(Serialize, Deserialize, Debug, Clone, Copy)]
+struct Chunk {
+    /// The first ID in the chunk
+    first: RID,
+    /// Where the gaps of the rest of the chunk start
+    offset: usize,
+    /// How many IDs are in the chunks before this one
+    before: usize,
+}
+
+/// The row IDs under one key, in the order they were added
+#[derive(Serialize, Deserialize, Debug, Clone, Default)]
+pub struct PostingList {
+    chunks: Vec<Chunk>,
+    gaps: Vec<u8>,
+    len: usize,
+    /// The last ID that was added
+    last: RID,
+}
+
+/// An empty list, for keys that are not in the index
+static EMPTY: PostingList = PostingList::new();
+
+impl PostingList {
+    pub const fn new() -> Self {
+        PostingList {
+            chunks: Vec::new(),
+            gaps: Vec::new(),
+            len: 0,
+            last: 0,
+        }
+    }
+
+    /// An empty list that lives for as long as it is needed
+    pub fn empty() -> &'static PostingList {
+        &EMPTY
+    }
+
+    pub fn len(&self) -> usize {
+        self.len
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.len == 0
+    }
+
+    /// How many bytes the IDs take
+    pub fn size(&self) -> usize {
+        self.gaps.len() + self.chunks.len() * std::mem::size_of::<Chunk>()
+    }
+
+    /// Add `id`, which has to come after every ID already in the list
+    pub fn push(&mut self, id: RID) {
+        assert!(
+            self.len == 0 || id >= self.last,
+            "Posting list IDs have to go up"
+        );
+        let in_last = self.chunks.last().map_or(0, |c| self.len - c.before);
+
+        if in_last == 0 || in_last == POSTING_CHUNK_IDS {
+            self.chunks.push(Chunk {
+                first: id,
+                offset: self.gaps.len(),
+                before: self.len,
+            });
+        } else {
+            write_varint(&mut self.gaps, (id - self.last) as u64);
+        }
+
+        self.last = id;
+        self.len += 1;
+    }
+
+    /// How many IDs are in chunk number `chunk`
+    fn chunk_len(&self, chunk: usize) -> usize {
+        let end = self.chunks.get(chunk + 1).map_or(self.len, |c| c.before);
+        end - self.chunks[chunk].before
+    }
+
+    /// Go through the IDs from the start of chunk number `chunk`
+    fn iter_chunk(&self, chunk: usize) -> PostingIter<'_> {
+        PostingIter {
+            list: self,
+            chunk,
+            offset: 0,
+            left: 0,
+            current: 0,
+            remaining: self.len - self.chunks.get(chunk).map_or(self.len, |c| c.before),
+        }
+    }
+
+    /// Go through every ID in order
+    pub fn iter(&self) -> PostingIter<'_> {
+        self.iter_chunk(0)
+    }
+
+    /// Go through the IDs from the first one that is at least `since`
+    pub fn iter_from(&self, since: RID) -> PostingIter<'_> {
+        // Every chunk before the last one that starts before `since` only has smaller IDs
+        let chunk = self
+            .chunks
+            .partition_point(|c| c.first < since)
+            .saturating_sub(1);
+
+        let mut iter = self.iter_chunk(chunk);
+        loop {
+            let before = iter.clone();
+
+            match iter.next() {
+                Some(id) if id < since => continue,
+                _ => return before,
+            }
+        }
+    }
+
+    /// Drop the IDs before `first_row`
+    pub fn trim(&mut self, first_row: RID) {
+        let chunk = self.chunks.partition_point(|c| c.first < first_row);
+        if chunk == 0 {
+            return;
+        }
+
+        // Only the chunk `first_row` might be in is encoded again, the ones after it are kept
+        let kept: Vec<RID> = self
+            .iter_chunk(chunk - 1)
+            .take(self.chunk_len(chunk - 1))
+            .filter(|id| *id >= first_row)
+            .collect();
+
+        let mut trimmed = PostingList::new();
+        for id in kept {
+            trimmed.push(id);
+        }
+
+        if let Some(next) = self.chunks.get(chunk) {
+            let dropped = next.before - trimmed.len;
+            let cut = next.offset - trimmed.gaps.len();
+
+            trimmed.gaps.extend_from_slice(&self.gaps[next.offset..]);
+            trimmed
+                .chunks
+                .extend(self.chunks[chunk..].iter().map(|c| Chunk {
+                    first: c.first,
+                    offset: c.offset - cut,
+                    before: c.before - dropped,
+                }));
+            trimmed.len = self.len - dropped;
+        }
+
+        trimmed.last = self.last;
+        *self = trimmed;
+    }
+}
+
+impl Extend<RID> for PostingList {
+    fn extend<I: IntoIterator<Item = RID>>(&mut self, ids: I) {
+        for id in ids {
+            self.push(id);
+        }
+    }
+}
+
+/// Two lists are the same if they have the same IDs, however they are split into chunks
+impl PartialEq for PostingList {
+    fn eq(&self, other: &Self) -> bool {
+        self.len == other.len && self.iter().eq(other.iter())
+    }
+}
+
+impl<'a> IntoIterator for &'a PostingList {
+    type Item = RID;
+    type IntoIter = PostingIter<'a>;
+
+    fn into_iter(self) -> PostingIter<'a> {
+        self.iter()
+    }
+}
+
+/// Iterator over the IDs of a posting list, decoding them as it goes
+#[derive(Clone)]
+pub struct PostingIter<'a> {
+    list: &'a PostingList,
+    /// The next chunk to start
+    chunk: usize,
+    /// Where the next gap in the current chunk is
+    offset: usize,
+    /// How many IDs of the current chunk are left
+    left: usize,
+    current: RID,
+    remaining: usize,
+}
+
+impl Iterator for PostingIter<'_> {
+    type Item = RID;
+
+    fn next(&mut self) -> Option<RID> {
+        if self.left == 0 {
+            let chunk = self.list.chunks.get(self.chunk)?;
+
+            self.left = self.list.chunk_len(self.chunk) - 1;
+            self.chunk += 1;
+            self.offset = chunk.offset;
+            self.current = chunk.first;
+        } else {
+            let (gap, len) = read_varint(&self.list.gaps[self.offset..]);
+
+            self.left -= 1;
+            self.offset += len;
+            self.current += gap as RID;
+        }
+
+        self.remaining -= 1;
+        Some(self.current)
+    }
+
+    fn size_hint(&self) -> (usize, Option<usize>) {
+        (self.remaining, Some(self.remaining))
+    }
+}
+
+impl ExactSizeIterator for PostingIter<'_> {}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn list_of(ids: &[RID]) -> PostingList {
+        let mut list = PostingList::new();
+        list.extend(ids.iter().copied());
+        list
+    }
+
+    #[test]
+    fn varint_test() {
+        for value in [0u64, 1, 127, 128, 300, 1 << 40, u64::MAX] {
+            let mut bytes = vec![];
+            write_varint(&mut bytes, value);
+            assert_eq!(read_varint(&bytes), (value, bytes.len()));
+        }
+
+        let mut bytes = vec![];
+        write_varint(&mut bytes, 127);
+        write_varint(&mut bytes, 128);
+        assert_eq!(bytes.len(), 3);
+    }
+
+    #[test]
+    fn push_and_iter_test() {
+        let ids: Vec<RID> = (0..1000).map(|i| i * 3 + (i % 7) * 1000).collect();
+        let mut sorted = ids.clone();
+        sorted.sort();
+
+        let list = list_of(&sorted);
+        assert_eq!(list.len(), 1000);
+        assert_eq!(list.iter().len(), 1000);
+        assert_eq!(list.iter().collect::<Vec<_>>(), sorted);
+
+        // Much smaller than 8 bytes an ID
+        assert!(list.size() < 1000 * 3);
+
+        assert!(PostingList::empty().is_empty());
+        assert_eq!(PostingList::empty().iter().next(), None);
+    }
+
+    #[test]
+    fn iter_from_test() {
+        let ids: Vec<RID> = (0..500).map(|i| i * 2).collect();
+        let list = list_of(&ids);
+
+        assert_eq!(list.iter_from(0).next(), Some(0));
+        assert_eq!(list.iter_from(301).next(), Some(302));
+        assert_eq!(
+            list.iter_from(302).take(3).collect::<Vec<_>>(),
+            [302, 304, 306]
+        );
+        assert_eq!(list.iter_from(301).len(), 500 - 151);
+
+        // The first ID of a chunk, and past the end
+        let first_of_second = ids[POSTING_CHUNK_IDS];
+        assert_eq!(
+            list.iter_from(first_of_second).next(),
+            Some(first_of_second)
+        );
+        assert_eq!(list.iter_from(998).collect::<Vec<_>>(), [998]);
+        assert_eq!(list.iter_from(999).next(), None);
+    }
+
+    #[test]
+    fn trim_test() {
+        let ids: Vec<RID> = (0..600).map(|i| i * 5).collect();
+
+        for first_row in [0, 3, 640, 641, 1500, 2995, 3000] {
+            let mut list = list_of(&ids);
+            list.trim(first_row);
+
+            let kept: Vec<RID> = ids.iter().copied().filter(|id| *id >= first_row).collect();
+            assert_eq!(list.iter().collect::<Vec<_>>(), kept);
+            assert_eq!(list.len(), kept.len());
+            assert_eq!(list, list_of(&kept));
+
+            // Adding after a trim carries on from the last ID
+            list.push(5000);
+            list.push(5001);
+            assert_eq!(list.iter_from(4000).collect::<Vec<_>>(), [5000, 5001]);
+        }
+    }
+}
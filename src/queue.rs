@@ -1,53 +1,265 @@
 use super::capture::Capture;
+use super::constants::{QUEUE_CAPACITY, QUEUE_FULL_WAIT};
 use super::row::Epoch;
-use log::info;
+use log::{info, warn};
 use pyo3::prelude::*;
-use std::collections::VecDeque;
-use std::sync::{Arc, RwLock};
+use std::cell::UnsafeCell;
+use std::mem::MaybeUninit;
+use std::sync::atomic::{AtomicU64, AtomicUsize, Ordering};
+use std::thread;
+use std::time::{Duration, Instant};
+
+// The capture queue is a bounded ring buffer that does not use locks.
+//
+// Every slot has a sequence number that says whose turn it is to use it. A producer claims the
+// slot at `tail` by moving `tail` forward with a compare and swap, writes the value, and then
+// sets the sequence to tell the consumer it is ready. The consumer does the same from `head`,
+// and sets the sequence so producers can use the slot again on the next lap around the ring.
+//
+// So adding a capture is a few atomic operations, and it never waits for the consumer unless
+// the ring is completely full. Then it waits at most QUEUE_FULL_WAIT, since the consumer might
+// not be running at all.
+//
+// Based on Dmitry Vyukov's bounded MPMC queue.
+
+struct Slot<T> {
+    sequence: AtomicUsize,
+    value: UnsafeCell<MaybeUninit<T>>,
+}
+
+/// A bounded lock-free queue for many producers and a consumer
+pub struct RingBuffer<T> {
+    slots: Box<[Slot<T>]>,
+    mask: usize,
+    head: AtomicUsize,
+    tail: AtomicUsize,
+}
+
+// Values are only ever read by the thread that claimed their slot
+unsafe impl<T: Send> Send for RingBuffer<T> {}
+unsafe impl<T: Send> Sync for RingBuffer<T> {}
+
+impl<T> RingBuffer<T> {
+    /// Make a ring that holds at least `capacity` values, rounded up to a power of two
+    pub fn with_capacity(capacity: usize) -> Self {
+        let capacity = capacity.max(2).next_power_of_two();
+
+        let slots = (0..capacity)
+            .map(|i| Slot {
+                sequence: AtomicUsize::new(i),
+                value: UnsafeCell::new(MaybeUninit::uninit()),
+            })
+            .collect();
+
+        RingBuffer {
+            slots,
+            mask: capacity - 1,
+            head: AtomicUsize::new(0),
+            tail: AtomicUsize::new(0),
+        }
+    }
+
+    /// Add a value, or give it back if the ring is full
+    pub fn push(&self, value: T) -> Result<(), T> {
+        let mut pos = self.tail.load(Ordering::Relaxed);
+
+        loop {
+            let slot = &self.slots[pos & self.mask];
+            let sequence = slot.sequence.load(Ordering::Acquire);
+            let diff = sequence as isize - pos as isize;
+
+            if diff == 0 {
+                // The slot is free on this lap, try to claim it
+                match self.tail.compare_exchange_weak(
+                    pos,
+                    pos + 1,
+                    Ordering::Relaxed,
+                    Ordering::Relaxed,
+                ) {
+                    Ok(_) => {
+                        unsafe { (*slot.value.get()).write(value) };
+                        slot.sequence.store(pos + 1, Ordering::Release);
+                        return Ok(());
+                    }
+                    Err(current) => pos = current,
+                }
+            } else if diff < 0 {
+                // The consumer has not taken the value from the last lap yet
+                return Err(value);
+            } else {
+                pos = self.tail.load(Ordering::Relaxed);
+            }
+        }
+    }
+
+    /// Take the oldest value out
+    pub fn pop(&self) -> Option<T> {
+        let mut pos = self.head.load(Ordering::Relaxed);
+
+        loop {
+            let slot = &self.slots[pos & self.mask];
+            let sequence = slot.sequence.load(Ordering::Acquire);
+            let diff = sequence as isize - (pos + 1) as isize;
+
+            if diff == 0 {
+                match self.head.compare_exchange_weak(
+                    pos,
+                    pos + 1,
+                    Ordering::Relaxed,
+                    Ordering::Relaxed,
+                ) {
+                    Ok(_) => {
+                        let value = unsafe { (*slot.value.get()).assume_init_read() };
+                        // Hand the slot back to the producers for the next lap
+                        slot.sequence.store(pos + self.mask + 1, Ordering::Release);
+                        return Some(value);
+                    }
+                    Err(current) => pos = current,
+                }
+            } else if diff < 0 {
+                // Nothing has been written to this slot yet
+                return None;
+            } else {
+                pos = self.head.load(Ordering::Relaxed);
+            }
+        }
+    }
+
+    /// Move up to `max` values into `out`, returning how many were moved
+    pub fn pop_batch(&self, max: usize, out: &mut Vec<T>) -> usize {
+        let mut count = 0;
+
+        while count < max {
+            match self.pop() {
+                Some(value) => {
+                    out.push(value);
+                    count += 1;
+                }
+                None => break,
+            }
+        }
+
+        count
+    }
+
+    /// About how many values are in the ring, it can change while it is read
+    pub fn len(&self) -> usize {
+        let tail = self.tail.load(Ordering::Acquire);
+        let head = self.head.load(Ordering::Acquire);
+
+        tail.saturating_sub(head)
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.len() == 0
+    }
+
+    pub fn capacity(&self) -> usize {
+        self.mask + 1
+    }
+}
+
+impl<T> Drop for RingBuffer<T> {
+    fn drop(&mut self) {
+        while self.pop().is_some() {}
+    }
+}
 
 #[pyclass]
 pub struct KQueue {
-    pub queue: Arc<RwLock<VecDeque<Capture>>>,
+    pub queue: RingBuffer<Capture>,
+    dropped: AtomicU64,
 }
 
 // Internal Rust methods
-impl KQueue {}
+impl KQueue {
+    pub fn with_capacity(capacity: usize) -> Self {
+        KQueue {
+            queue: RingBuffer::with_capacity(capacity),
+            dropped: AtomicU64::new(0),
+        }
+    }
+
+    /// Add a capture, waiting for the consumer to make room if the ring is full, or give it back
+    /// if the consumer did not take anything out for `wait`
+    pub fn push_within(&self, capture: Capture, wait: Duration) -> Result<(), Capture> {
+        info!("Added {:?} to log", &capture);
+
+        let mut head = self.queue.head.load(Ordering::Relaxed);
+        let mut deadline = Instant::now() + wait;
+        let mut pending = capture;
+        let mut warned = false;
+
+        while let Err(c) = self.queue.push(pending) {
+            // The consumer is running as long as it keeps taking captures out, however slowly
+            let current = self.queue.head.load(Ordering::Relaxed);
+            if current != head {
+                head = current;
+                deadline = Instant::now() + wait;
+            } else if Instant::now() >= deadline {
+                return Err(c);
+            }
+
+            if !warned {
+                warn!("Capture queue is full, waiting for the consumer");
+                warned = true;
+            }
+
+            pending = c;
+            thread::yield_now();
+        }
+
+        Ok(())
+    }
+
+    pub fn len(&self) -> usize {
+        self.queue.len()
+    }
+
+    /// Move up to `max` captures into `out`, oldest first
+    pub fn pop_batch(&self, max: usize, out: &mut Vec<Capture>) -> usize {
+        self.queue.pop_batch(max, out)
+    }
+}
 
 #[pymethods]
 impl KQueue {
+    /// Add a capture to be consumed later
+    ///
+    /// If nothing is taken out of the full ring for QUEUE_FULL_WAIT, nothing is consuming it, and
+    /// the capture is dropped instead of holding up the caller for good.
     pub fn capture(&self, name: String, args: Vec<PyObject>, start: Epoch, end: Epoch) {
-        let c = Capture {
-            name,
-            args,
-            start,
-            end,
-            delta: end - start,
-        };
-
-        info!("Added {:?} to log", &c);
-
-        // Concurrently add the capture to the queue to be consumed later
-        {
-            let mut q = self.queue.write().unwrap();
-            q.push_back(c);
+        let c = Capture::new(name, args, start, end);
+        let wait = Duration::from_millis(QUEUE_FULL_WAIT);
+
+        if let Err(c) = self.push_within(c, wait) {
+            let dropped = self.dropped.fetch_add(1, Ordering::Relaxed) + 1;
+            warn!(
+                "Capture queue is still full, dropped {} ({} captures so far)",
+                c.name, dropped
+            );
         }
     }
 
+    /// How many captures were dropped because the queue was full
+    pub fn dropped(&self) -> u64 {
+        self.dropped.load(Ordering::Relaxed)
+    }
+
     #[new]
     pub fn new() -> Self {
-        KQueue {
-            queue: Arc::new(RwLock::new(VecDeque::new())),
-        }
+        KQueue::with_capacity(QUEUE_CAPACITY)
     }
 
     pub fn empty(&self) -> bool {
-        self.queue.read().unwrap().is_empty()
+        self.queue.is_empty()
     }
 }
 
 #[cfg(test)]
 mod tests {
     use super::*;
+    use std::sync::Arc;
     use std::time::{SystemTime, UNIX_EPOCH};
 
     #[test]
@@ -70,13 +282,18 @@ mod tests {
         assert!(!lfq.empty());
     }
 
+    fn drain(queue: &KQueue) -> Vec<Capture> {
+        let mut out = vec![];
+        queue.pop_batch(usize::MAX, &mut out);
+        out
+    }
+
     #[test]
     fn queue_starts_empty() {
         let queue = KQueue::new();
         assert!(queue.empty());
 
-        let q = queue.queue.read().unwrap();
-        assert_eq!(q.len(), 0);
+        assert_eq!(queue.len(), 0);
     }
 
     #[test]
@@ -90,8 +307,8 @@ mod tests {
         queue.capture("second".to_string(), vec![], t2, t2 + 200);
         queue.capture("third".to_string(), vec![], t3, t3 + 150);
 
-        let q = queue.queue.read().unwrap();
-        assert_eq!(q.len(), 3);
+        assert_eq!(queue.len(), 3);
+        let q = drain(&queue);
 
         // Verify captures are in order
         assert_eq!(q[0].name, "first");
@@ -111,7 +328,7 @@ mod tests {
 
         queue.capture("test_function".to_string(), vec![], start, end);
 
-        let q = queue.queue.read().unwrap();
+        let q = drain(&queue);
         let capture = &q[0];
 
         assert_eq!(capture.start, start);
@@ -143,9 +360,11 @@ mod tests {
         }
 
         // Verify all captures were added
-        let q = queue.queue.read().unwrap();
-        assert_eq!(q.len(), 10);
+        assert_eq!(queue.len(), 10);
         assert!(!queue.empty());
+
+        let q = drain(&queue);
+        assert_eq!(q.len(), 10);
     }
 
     #[test]
@@ -157,7 +376,7 @@ mod tests {
 
         queue.capture(name.clone(), vec![], start, end);
 
-        let q = queue.queue.read().unwrap();
+        let q = drain(&queue);
         let capture = &q[0];
 
         assert_eq!(capture.name, name);
@@ -165,4 +384,97 @@ mod tests {
         assert_eq!(capture.end, end);
         assert_eq!(capture.args.len(), 0);
     }
+
+    #[test]
+    fn ring_wraps_around() {
+        let ring = RingBuffer::with_capacity(4);
+        assert_eq!(ring.capacity(), 4);
+
+        // Go around the ring a few times
+        for lap in 0..3 {
+            for i in 0..4 {
+                assert!(ring.push(lap * 10 + i).is_ok());
+            }
+
+            // It is full now, so the value is handed back
+            assert_eq!(ring.push(99), Err(99));
+
+            for i in 0..4 {
+                assert_eq!(ring.pop(), Some(lap * 10 + i));
+            }
+
+            assert_eq!(ring.pop(), None);
+        }
+    }
+
+    #[test]
+    fn pop_batch_takes_at_most_max() {
+        let ring = RingBuffer::with_capacity(16);
+
+        for i in 0..10 {
+            ring.push(i).unwrap();
+        }
+
+        let mut out = vec![];
+        assert_eq!(ring.pop_batch(4, &mut out), 4);
+        assert_eq!(out, vec![0, 1, 2, 3]);
+
+        assert_eq!(ring.pop_batch(100, &mut out), 6);
+        assert_eq!(out.len(), 10);
+        assert!(ring.is_empty());
+    }
+
+    #[test]
+    fn full_queue_waits_for_consumer() {
+        use std::thread;
+
+        let queue = Arc::new(KQueue::with_capacity(8));
+        let producers: Vec<_> = (0..4)
+            .map(|t| {
+                let q = Arc::clone(&queue);
+                thread::spawn(move || {
+                    for i in 0..100 {
+                        q.capture(format!("{}_{}", t, i), vec![], 0, i as u128);
+                    }
+                })
+            })
+            .collect();
+
+        // Consume while the producers are blocked on the small ring
+        let mut seen = vec![];
+        while seen.len() < 400 {
+            queue.pop_batch(3, &mut seen);
+        }
+
+        for p in producers {
+            p.join().unwrap();
+        }
+
+        assert_eq!(seen.len(), 400);
+        assert!(queue.empty());
+    }
+
+    #[test]
+    fn full_queue_drops_without_consumer() {
+        let queue = KQueue::with_capacity(4);
+
+        for i in 0..4 {
+            queue.capture(format!("kept_{}", i), vec![], 0, i);
+        }
+        assert_eq!(queue.dropped(), 0);
+
+        // Nothing consumes the ring, so these give up instead of waiting forever
+        queue.capture("dropped_0".to_string(), vec![], 0, 1);
+        queue.capture("dropped_1".to_string(), vec![], 0, 1);
+        assert_eq!(queue.dropped(), 2);
+
+        let q = drain(&queue);
+        assert_eq!(q.len(), 4);
+        assert_eq!(q[3].name, "kept_3");
+
+        // There is room again once it is consumed
+        queue.capture("after".to_string(), vec![], 0, 1);
+        assert_eq!(queue.dropped(), 2);
+        assert_eq!(queue.len(), 1);
+    }
 }
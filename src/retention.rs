@@ -0,0 +1,136 @@
+use super::filewriter::{build_binary_writer, Writer};
+use super::rollup::Granularity;
+use serde::{Deserialize, Serialize};
+use std::fs;
+use std::path::{Path, PathBuf};
+
+// Retention keeps the data directory from growing forever.
+//
+// Rows are kept for `raw_days` and the per minute rollups for `minute_days`. The hour and day
+// rollups, and the stats and sketches in the name index, are small and are kept for good, so the
+// history of each function is still there after its rows are gone.
+//
+// Rows are only ever dropped from the start of a shard, a whole encoded block at a time. A block
+// is dropped once every `start` in it and in every block before it is older than `raw_days`,
+// which the zone maps of the start column tell without reading any rows. The first row that is
+// kept is saved to `retention.data` before anything is deleted, and everything that reads rows
+// starts from there. Row IDs do not change, the rows before it are just gone.
+//
+// Once no row in a segment file is kept, the file is deleted. Segments are 64MB, so disk space is
+// given back a segment at a time.
+
+/// How many days of each kind of data to keep, None keeps it forever
+#[derive(Debug, Clone, Copy, Default, PartialEq, Eq)]
+pub struct Retention {
+    /// How long rows are kept
+    pub raw_days: Option<u64>,
+    /// How long the per minute rollups are kept
+    pub minute_days: Option<u64>,
+}
+
+/// What gets written to `retention.data`
+#[derive(Serialize, Deserialize, Debug)]
+struct RetentionCheckpoint {
+    first_row: usize,
+}
+
+/// The time `days` before `now`, in nanoseconds since the epoch
+fn days_before(now: u128, days: u64) -> u128 {
+    now.saturating_sub(days as u128 * Granularity::Day.nanos())
+}
+
+impl Retention {
+    pub fn validate(&self) -> Result<(), String> {
+        for (name, days) in [
+            ("retention_days", self.raw_days),
+            ("minute_retention_days", self.minute_days),
+        ] {
+            if days == Some(0) {
+                return Err(format!("{} must be at least 1", name));
+            }
+        }
+
+        Ok(())
+    }
+
+    /// Check if anything is ever dropped
+    pub fn is_set(&self) -> bool {
+        self.raw_days.is_some() || self.minute_days.is_some()
+    }
+
+    /// The time rows that started before are dropped, if they ever are
+    pub fn raw_cutoff(&self, now: u128) -> Option<u128> {
+        self.raw_days.map(|days| days_before(now, days))
+    }
+
+    /// The time per minute rollups before are dropped, if they ever are
+    pub fn minute_cutoff(&self, now: u128) -> Option<u128> {
+        self.minute_days.map(|days| days_before(now, days))
+    }
+
+    /// Get the path of the retention file of the shard in `dir`
+    pub fn get_path(dir: &Path) -> PathBuf {
+        dir.join("retention.data")
+    }
+
+    /// Read the first row the shard in `dir` still has, which is 0 if nothing was ever dropped
+    pub fn read_first_row(dir: &Path) -> usize {
+        fs::read(Retention::get_path(dir))
+            .ok()
+            .and_then(|bytes| bincode::deserialize::<RetentionCheckpoint>(&bytes).ok())
+            .map_or(0, |c| c.first_row)
+    }
+
+    /// Save the first row the shard in `dir` keeps, before the rows ahead of it are deleted
+    pub fn write_first_row(dir: &Path, first_row: usize) {
+        let writer: Writer<RetentionCheckpoint> = build_binary_writer();
+        let path = Retention::get_path(dir);
+
+        writer.write_file(&path.to_string_lossy(), &RetentionCheckpoint { first_row });
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use crate::constants::DATA_DIRECTORY;
+
+    #[test]
+    fn validate_test() {
+        assert!(Retention::default().validate().is_ok());
+        assert!(!Retention::default().is_set());
+
+        let zero = Retention {
+            raw_days: Some(0),
+            ..Retention::default()
+        };
+        assert!(zero.validate().is_err());
+    }
+
+    #[test]
+    fn cutoff_test() {
+        let day = Granularity::Day.nanos();
+        let retention = Retention {
+            raw_days: Some(7),
+            minute_days: None,
+        };
+
+        assert_eq!(retention.raw_cutoff(10 * day), Some(3 * day));
+        assert_eq!(retention.raw_cutoff(day), Some(0));
+        assert_eq!(retention.minute_cutoff(10 * day), None);
+    }
+
+    #[test]
+    fn first_row_test() {
+        let dir = Path::new("./").join(DATA_DIRECTORY).join("retention-test");
+        let _ = fs::remove_dir_all(&dir);
+        fs::create_dir_all(&dir).unwrap();
+
+        assert_eq!(Retention::read_first_row(&dir), 0);
+
+        Retention::write_first_row(&dir, 4096);
+        assert_eq!(Retention::read_first_row(&dir), 4096);
+
+        let _ = fs::remove_dir_all(&dir);
+    }
+}
@@ -0,0 +1,351 @@
+use log::{info, warn};
+use serde::{Deserialize, Serialize};
+use std::collections::BTreeMap;
+use std::fs::{self, File};
+use std::io::{BufReader, BufWriter, Write};
+use std::path::Path;
+
+// Rollups are the count, sum, min and max of the deltas of each function over each minute, hour
+// and day, by the `start` of the row. They are kept up to date as rows are written, so a chart
+// over 60 days reads at most 60 points per function for days, 1440 for hours, instead of every
+// row.
+//
+// Each granularity has its own table, ordered by name code and then by bucket, so a query for one
+// function over a time range is a single range of the table.
+
+/// How long each bucket of a rollup is
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
+pub enum Granularity {
+    Minute,
+    Hour,
+    Day,
+}
+
+impl Granularity {
+    pub const ALL: [Granularity; 3] = [Granularity::Minute, Granularity::Hour, Granularity::Day];
+
+    /// The length of a bucket in nanoseconds
+    pub fn nanos(&self) -> u128 {
+        let minute = 60 * 1_000_000_000;
+
+        match self {
+            Granularity::Minute => minute,
+            Granularity::Hour => 60 * minute,
+            Granularity::Day => 24 * 60 * minute,
+        }
+    }
+
+    /// Get the granularity called `name`, which is "minute", "hour" or "day"
+    pub fn from_name(name: &str) -> Option<Granularity> {
+        match name {
+            "minute" => Some(Granularity::Minute),
+            "hour" => Some(Granularity::Hour),
+            "day" => Some(Granularity::Day),
+            _ => None,
+        }
+    }
+
+    fn table(&self) -> usize {
+        match self {
+            Granularity::Minute => 0,
+            Granularity::Hour => 1,
+            Granularity::Day => 2,
+        }
+    }
+
+    fn bucket(&self, time: u128) -> u64 {
+        (time / self.nanos()) as u64
+    }
+}
+
+/// The deltas of one function in one bucket
+#[derive(Debug, Clone, Copy, PartialEq, Eq, Serialize, Deserialize)]
+pub struct RollupPoint {
+    pub count: u64,
+    pub sum: u128,
+    pub min: u128,
+    pub max: u128,
+}
+
+impl RollupPoint {
+    fn new() -> Self {
+        RollupPoint {
+            count: 0,
+            sum: 0,
+            min: u128::MAX,
+            max: 0,
+        }
+    }
+
+    fn add(&mut self, delta: u128) {
+        self.count += 1;
+        self.sum += delta;
+        self.min = self.min.min(delta);
+        self.max = self.max.max(delta);
+    }
+
+    pub fn merge(&mut self, other: &RollupPoint) {
+        self.count += other.count;
+        self.sum += other.sum;
+        self.min = self.min.min(other.min);
+        self.max = self.max.max(other.max);
+    }
+}
+
+type RollupTable = BTreeMap<(u32, u64), RollupPoint>;
+
+/// Changed whenever the rollup file changes, so an older one gets built again
+const ROLLUP_VERSION: u32 = 1;
+
+/// What gets written to disk when the rollups are saved, with each table stored as a list
+#[derive(Deserialize)]
+struct RollupCheckpoint {
+    version: u32,
+    rows: usize,
+    tables: Vec<Vec<((u32, u64), RollupPoint)>>,
+}
+
+/// The same as RollupCheckpoint, but borrowing from the rollups so saving does not copy them
+#[derive(Serialize)]
+struct RollupCheckpointRef<'a> {
+    version: u32,
+    rows: usize,
+    tables: Vec<Vec<(&'a (u32, u64), &'a RollupPoint)>>,
+}
+
+/// Per function rollups of the deltas by minute, hour and day
+#[derive(Debug)]
+pub struct Rollups {
+    tables: [RollupTable; 3],
+    /// One more than the largest RID that has been added, like `Index::rows`
+    pub rows: usize,
+}
+
+impl Rollups {
+    pub fn new() -> Self {
+        Rollups {
+            tables: [BTreeMap::new(), BTreeMap::new(), BTreeMap::new()],
+            rows: 0,
+        }
+    }
+
+    /// Add the row `id` of the function with `code`, which started at `start` and took `delta`
+    pub fn insert(&mut self, code: u32, id: usize, start: u128, delta: u128) {
+        for granularity in Granularity::ALL {
+            let key = (code, granularity.bucket(start));
+
+            self.tables[granularity.table()]
+                .entry(key)
+                .or_insert_with(RollupPoint::new)
+                .add(delta);
+        }
+
+        self.rows = self.rows.max(id + 1);
+    }
+
+    /// Add everything from `other`, like `Index::merge`
+    pub fn merge(&mut self, other: Rollups) {
+        for (table, other_table) in self.tables.iter_mut().zip(other.tables) {
+            for (key, point) in other_table {
+                table
+                    .entry(key)
+                    .or_insert_with(RollupPoint::new)
+                    .merge(&point);
+            }
+        }
+
+        self.rows = self.rows.max(other.rows);
+    }
+
+    /// Drop the `granularity` buckets of every function that end before `before`, returning how
+    /// many were dropped
+    pub fn trim(&mut self, granularity: Granularity, before: u128) -> usize {
+        let first = granularity.bucket(before);
+        let table = &mut self.tables[granularity.table()];
+        let count = table.len();
+
+        table.retain(|&(_, bucket), _| bucket >= first);
+        count - table.len()
+    }
+
+    /// Get the buckets of the function with `code` that overlap `start` up to `end`, as the
+    /// time each bucket starts at and its point, in order
+    pub fn query(
+        &self,
+        code: u32,
+        granularity: Granularity,
+        start: u128,
+        end: u128,
+    ) -> Vec<(u128, RollupPoint)> {
+        if end <= start {
+            return vec![];
+        }
+
+        let first = (code, granularity.bucket(start));
+        let last = (code, granularity.bucket(end - 1));
+
+        self.tables[granularity.table()]
+            .range(first..=last)
+            .map(|(&(_, bucket), point)| (bucket as u128 * granularity.nanos(), *point))
+            .collect()
+    }
+
+    /// Write the rollups to `path`, the same way as `Index::save`
+    pub fn save(&self, path: &Path) {
+        let checkpoint = RollupCheckpointRef {
+            version: ROLLUP_VERSION,
+            rows: self.rows,
+            tables: self.tables.iter().map(|t| t.iter().collect()).collect(),
+        };
+
+        let tmp = path.with_extension("tmp");
+        {
+            let mut file = BufWriter::new(File::create(&tmp).expect("Should create rollup file."));
+            bincode::serialize_into(&mut file, &checkpoint).expect("Should serialize rollups.");
+            file.flush().expect("Should write rollups.");
+
+            // Synced before the rename, so a crash never leaves a partial file in its place
+            file.get_ref().sync_all().expect("Should sync rollups.");
+        }
+
+        fs::rename(&tmp, path).expect("Should replace rollup file.");
+        info!("Saved rollups of {} rows to {:?}", self.rows, path);
+    }
+
+    /// Read rollups written by `save`, or None if there are none that can be read
+    pub fn load(path: &Path) -> Option<Rollups> {
+        let file = File::open(path).ok()?;
+
+        match bincode::deserialize_from::<_, RollupCheckpoint>(BufReader::new(file)) {
+            Ok(checkpoint)
+                if checkpoint.version != ROLLUP_VERSION
+                    || checkpoint.tables.len() != Granularity::ALL.len() =>
+            {
+                warn!("Rollups at {:?} are not version {}", path, ROLLUP_VERSION);
+                None
+            }
+            Ok(checkpoint) => {
+                let mut rollups = Rollups::new();
+                rollups.rows = checkpoint.rows;
+
+                for (table, entries) in rollups.tables.iter_mut().zip(checkpoint.tables) {
+                    *table = entries.into_iter().collect();
+                }
+
+                Some(rollups)
+            }
+            Err(e) => {
+                warn!("Could not read rollups at {:?}: {}", path, e);
+                None
+            }
+        }
+    }
+
+    /// Get the largest name code in any rollup
+    pub fn max_code(&self) -> Option<u32> {
+        self.tables
+            .iter()
+            .filter_map(|t| t.keys().next_back().map(|(code, _)| *code))
+            .max()
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    const MINUTE: u128 = 60 * 1_000_000_000;
+
+    fn rollups_of(ids: std::ops::Range<usize>) -> Rollups {
+        let mut rollups = Rollups::new();
+        for id in ids {
+            // One row every 10 seconds, alternating between two functions
+            rollups.insert((id % 2) as u32, id, id as u128 * 10_000_000_000, id as u128);
+        }
+        rollups
+    }
+
+    #[test]
+    fn granularity_test() {
+        assert_eq!(Granularity::from_name("hour"), Some(Granularity::Hour));
+        assert_eq!(Granularity::from_name("week"), None);
+        assert_eq!(Granularity::Day.nanos(), 24 * 60 * MINUTE);
+    }
+
+    #[test]
+    fn query_test() {
+        let rollups = rollups_of(0..360);
+
+        // Rows 0, 2 and 4 of function 0 are in the first minute
+        let minutes = rollups.query(0, Granularity::Minute, 0, 60 * MINUTE);
+        assert_eq!(minutes.len(), 60);
+        assert_eq!(
+            minutes[0],
+            (
+                0,
+                RollupPoint {
+                    count: 3,
+                    sum: 6,
+                    min: 0,
+                    max: 4
+                }
+            )
+        );
+        assert_eq!(minutes[1].0, MINUTE);
+
+        // A range that starts part way into a bucket still gets that bucket
+        let part = rollups.query(1, Granularity::Minute, MINUTE + 1, 3 * MINUTE);
+        assert_eq!(
+            part.iter().map(|p| p.0).collect::<Vec<_>>(),
+            [MINUTE, 2 * MINUTE]
+        );
+
+        let hours = rollups.query(1, Granularity::Hour, 0, u128::MAX);
+        assert_eq!(hours.len(), 1);
+        assert_eq!(hours[0].1.count, 180);
+        assert_eq!(hours[0].1.max, 359);
+
+        assert!(rollups.query(7, Granularity::Day, 0, u128::MAX).is_empty());
+        assert!(rollups.query(0, Granularity::Day, 10, 10).is_empty());
+    }
+
+    #[test]
+    fn trim_test() {
+        let mut rollups = rollups_of(0..360);
+        rollups.trim(Granularity::Minute, 30 * MINUTE + 1);
+
+        // The minute that has the cutoff in it is kept
+        let minutes = rollups.query(0, Granularity::Minute, 0, u128::MAX);
+        assert_eq!(minutes.len(), 30);
+        assert_eq!(minutes[0].0, 30 * MINUTE);
+
+        // Only the minutes were trimmed
+        let hours = rollups.query(0, Granularity::Hour, 0, u128::MAX);
+        assert_eq!(hours[0].1.count, 180);
+    }
+
+    #[test]
+    fn merge_and_save_test() {
+        let whole = rollups_of(0..500);
+
+        let mut merged = rollups_of(0..123);
+        merged.merge(rollups_of(123..500));
+        assert_eq!(merged.tables, whole.tables);
+        assert_eq!(merged.rows, 500);
+
+        let dir = Path::new("./").join(crate::constants::DATA_DIRECTORY);
+        let _ = fs::create_dir_all(&dir);
+        let path = dir.join("rollup-test.data");
+
+        whole.save(&path);
+        let loaded = Rollups::load(&path).expect("Should load rollups.");
+        assert_eq!(loaded.tables, whole.tables);
+        assert_eq!(loaded.rows, 500);
+        assert_eq!(loaded.max_code(), Some(1));
+
+        fs::write(&path, b"not rollups").unwrap();
+        assert!(Rollups::load(&path).is_none());
+
+        let _ = fs::remove_file(&path);
+    }
+}
@@ -1,6 +1,5 @@
 use pyo3::prelude::*;
 use serde::{Deserialize, Serialize};
-use serde_big_array::BigArray;
 
 pub type RID = usize;
 pub type Epoch = u128;
@@ -8,80 +7,55 @@ pub type Epoch = u128;
 #[pyclass]
 #[derive(Debug, Eq, Clone, PartialEq, Ord, PartialOrd, Serialize, Deserialize)]
 pub enum FieldType {
-    #[serde(with = "BigArray")]
-    Name([u8; 64]),
+    Name(String),
     Epoch(Epoch),
+    // The name column stores the code of each name in the name dictionary instead of the name
+    Code(u32),
 }
 
 #[pymethods]
 impl FieldType {
     fn __repr__(&self) -> String {
         match self {
-            FieldType::Name(arr) => {
-                let name = arr
-                    .iter()
-                    .take_while(|&&c| c != 0)
-                    .map(|&c| c as char)
-                    .collect::<String>();
-
-                format!("FieldType::Name(\"{}\")", name)
-            }
+            FieldType::Name(name) => format!("FieldType::Name(\"{}\")", name),
             FieldType::Epoch(e) => format!("FieldType::Epoch({})", e),
+            FieldType::Code(c) => format!("FieldType::Code({})", c),
         }
     }
 
     fn __str__(&self) -> String {
         match self {
-            FieldType::Name(arr) => arr
-                .iter()
-                .take_while(|&&c| c != 0)
-                .map(|&c| c as char)
-                .collect::<String>(),
-
+            FieldType::Name(name) => name.clone(),
             FieldType::Epoch(e) => e.to_string(),
+            FieldType::Code(c) => c.to_string(),
         }
     }
 }
 
-pub fn create_function_name(s: &str) -> [u8; 64] {
-    let mut arr = [0u8; 64];
-    let bytes = s.as_bytes();
-    let len = bytes.len().min(64);
-    arr[..len].copy_from_slice(&bytes[..len]);
-    arr
-}
-
 impl FieldType {
     // TODO: Use to_string trait
     pub fn to_string(&self) -> String {
         match self {
-            FieldType::Name(a) => {
-                let mut name_vec = vec![];
-
-                for i in 0..64 {
-                    let c = a[i];
-
-                    if c == 0 {
-                        break;
-                    }
-
-                    name_vec.push(c);
-                }
-
-                return std::str::from_utf8(&name_vec)
-                    .expect("Find string.")
-                    .to_string();
+            FieldType::Name(name) => {
+                return name.clone();
             }
             FieldType::Epoch(a) => {
                 return a.to_string();
             }
+            FieldType::Code(c) => {
+                return c.to_string();
+            }
         }
     }
 
+    /// The number of bytes the value takes up
+    ///
+    /// Names can be any length, so only Epoch and Code are stored in pages.
     pub fn get_size(&self) -> usize {
         match self {
-            FieldType::Name(_) => 64,
+            FieldType::Name(name) => name.len(),
             FieldType::Epoch(_) => 16,
+            FieldType::Code(_) => 4,
         }
     }
 }
@@ -132,14 +106,12 @@ impl Row {
         let mut epoch_count = 0;
         for field in &self.fields {
             match field {
-                FieldType::Name(arr) => {
-                    let name: String = arr
-                        .iter()
-                        .take_while(|&&c| c != 0)
-                        .map(|&c| c as char)
-                        .collect();
+                FieldType::Name(name) => {
                     list.append(name).unwrap();
                 }
+                FieldType::Code(c) => {
+                    list.append(*c).unwrap();
+                }
                 FieldType::Epoch(e) => {
                     epoch_count += 1;
                     if epoch_count != 2 {
@@ -176,37 +148,33 @@ mod tests {
 
     #[test]
     fn fieldtype_name_to_string() {
-        let name = FieldType::Name(create_function_name("test_function"));
+        let name = FieldType::Name("test_function".to_string());
         assert_eq!(name.to_string(), "test_function");
     }
 
     #[test]
-    fn fieldtype_name_to_string_with_nulls() {
-        let mut arr = [0u8; 64];
-        arr[0] = b't';
-        arr[1] = b'e';
-        arr[2] = b's';
-        arr[3] = b't';
-        // Rest are zeros
-        let name = FieldType::Name(arr);
-        assert_eq!(name.to_string(), "test");
+    fn fieldtype_code_to_string() {
+        let code = FieldType::Code(7);
+        assert_eq!(code.to_string(), "7");
+        assert_eq!(code.__repr__(), "FieldType::Code(7)");
     }
 
     #[test]
     fn fieldtype_name_get_size() {
-        let name = FieldType::Name(create_function_name("any_name"));
-        assert_eq!(name.get_size(), 64);
+        let name = FieldType::Name("any_name".to_string());
+        assert_eq!(name.get_size(), 8);
+        assert_eq!(FieldType::Code(0).get_size(), 4);
     }
 
     #[test]
     fn fieldtype_name_str() {
-        let name = FieldType::Name(create_function_name("my_function"));
+        let name = FieldType::Name("my_function".to_string());
         assert_eq!(name.__str__(), "my_function");
     }
 
     #[test]
     fn fieldtype_name_repr() {
-        let name = FieldType::Name(create_function_name("my_function"));
+        let name = FieldType::Name("my_function".to_string());
         assert_eq!(name.__repr__(), "FieldType::Name(\"my_function\")");
     }
 
@@ -264,7 +232,7 @@ mod tests {
     #[test]
     fn row_new() {
         let fields = vec![
-            FieldType::Name(create_function_name("test")),
+            FieldType::Name("test".to_string()),
             FieldType::Epoch(1),
             FieldType::Epoch(2),
             FieldType::Epoch(1),
@@ -280,7 +248,7 @@ mod tests {
         let row = Row {
             id: 1,
             fields: vec![
-                FieldType::Name(create_function_name("func")),
+                FieldType::Name("func".to_string()),
                 FieldType::Epoch(1000),
                 FieldType::Epoch(2000),
                 FieldType::Epoch(1000), // delta
@@ -313,7 +281,7 @@ mod tests {
         let r = Row {
             id: 500,
             fields: vec![
-                FieldType::Name(create_function_name("my_function")),
+                FieldType::Name("my_function".to_string()),
                 FieldType::Epoch(1000),
                 FieldType::Epoch(2000),
                 FieldType::Epoch(1000),
@@ -331,7 +299,7 @@ mod tests {
         let r = Row {
             id: 42,
             fields: vec![
-                FieldType::Name(create_function_name("test")),
+                FieldType::Name("test".to_string()),
                 FieldType::Epoch(100),
                 FieldType::Epoch(200),
                 FieldType::Epoch(100),
@@ -349,7 +317,7 @@ mod tests {
         let r = Row {
             id: 42,
             fields: vec![
-                FieldType::Name(create_function_name("test")),
+                FieldType::Name("test".to_string()),
                 FieldType::Epoch(100),
                 FieldType::Epoch(200),
                 FieldType::Epoch(100),
@@ -391,17 +359,15 @@ mod tests {
 
     #[test]
     fn fieldtype_empty_name() {
-        let name = FieldType::Name([0u8; 64]);
+        let name = FieldType::Name(String::new());
         assert_eq!(name.to_string(), "");
     }
 
     #[test]
-    fn fieldtype_max_length_name() {
-        let arr = [b'a'; 64];
-        let name = FieldType::Name(arr);
-        let result = name.to_string();
-        assert_eq!(result.len(), 64);
-        assert_eq!(result, "a".repeat(64));
+    fn fieldtype_long_name_is_not_truncated() {
+        let long = format!("package.module.Class.{}", "a".repeat(200));
+        let name = FieldType::Name(long.clone());
+        assert_eq!(name.to_string(), long);
     }
 
     #[test]
@@ -0,0 +1,276 @@
+use super::constants::{SEALED_COMPRESSION_LEVEL, SEALED_FRAME_SIZE};
+use log::{info, warn};
+use memmap2::Mmap;
+use serde::{Deserialize, Serialize};
+use std::fs::{self, File};
+use std::io::Write;
+use std::path::{Path, PathBuf};
+use std::sync::{Arc, Mutex};
+
+// Full segments are compacted into sealed segments compressed with zstd.
+//
+// A segment is never written again once its column has moved on to the next one, so it can be
+// replaced with a smaller file that is only ever read. The bytes of the segment are split into
+// frames of SEALED_FRAME_SIZE bytes, and each frame is compressed on its own, so reading a page
+// only decompresses the frame it is in. The last frame that was decompressed is kept, so reading
+// a sealed segment from start to end decompresses each frame once.
+//
+// The file is the frames one after another, then the footer and then the length of the footer as
+// a little endian u64. The footer has the rows of the column that are in the segment, the
+// smallest and largest value in them, how many bytes the segment had and where each frame is.
+//
+// The sealed segment is written next to its path, synced, renamed into place and its directory
+// synced, and only then is the segment it replaces deleted. A crash in between leaves both, and
+// the sealed one is used.
+
+/// Sync the directory `path` is in, so the files renamed into it are there after a power loss
+pub fn sync_dir(path: &Path) {
+    // Directories can not be opened as files to sync them on Windows, and renames are kept there
+    #[cfg(unix)]
+    if let Some(dir) = path.parent() {
+        let dir = if dir.as_os_str().is_empty() {
+            Path::new(".")
+        } else {
+            dir
+        };
+
+        File::open(dir)
+            .and_then(|dir| dir.sync_all())
+            .expect("Should sync directory.");
+    }
+}
+
+/// Where one compressed frame is in a sealed segment
+#[derive(Serialize, Deserialize, Debug, Clone, Copy, PartialEq)]
+pub struct FrameEntry {
+    pub offset: u64,
+    pub len: usize,
+}
+
+/// The end of a sealed segment, which says what is in it
+#[derive(Serialize, Deserialize, Debug, Clone, PartialEq)]
+pub struct SealedFooter {
+    /// The first row of the column in the segment
+    pub first_row: usize,
+    /// How many rows of the column are in the segment
+    pub rows: usize,
+    /// The smallest value in those rows
+    pub min: u128,
+    /// The largest value in those rows
+    pub max: u128,
+    /// How many bytes the segment had before it was compressed
+    pub len: u64,
+    pub frames: Vec<FrameEntry>,
+}
+
+impl SealedFooter {
+    pub fn new(first_row: usize, rows: usize, min: u128, max: u128) -> Self {
+        SealedFooter {
+            first_row,
+            rows,
+            min,
+            max,
+            len: 0,
+            frames: vec![],
+        }
+    }
+}
+
+/// A compressed segment that is only ever read
+pub struct SealedSegment {
+    footer: SealedFooter,
+    mmap: Mmap,
+    // The number and bytes of the last frame that was decompressed, shared by the readers
+    decoded: Mutex<Option<(usize, Arc<Vec<u8>>)>>,
+}
+
+impl SealedSegment {
+    pub fn get_path(dir: &Path, column_index: usize, segment: usize) -> PathBuf {
+        dir.join(format!("segment_{}_{}.sealed", column_index, segment))
+    }
+
+    /// Compress the bytes of a segment into a sealed segment at `path`, returning how many bytes
+    /// it took
+    ///
+    /// The `len` and `frames` of the footer are filled in here.
+    pub fn write(path: &Path, bytes: &[u8], mut footer: SealedFooter) -> u64 {
+        let mut out = vec![];
+
+        for frame in bytes.chunks(SEALED_FRAME_SIZE) {
+            let compressed = zstd::bulk::compress(frame, SEALED_COMPRESSION_LEVEL)
+                .expect("Should compress frame.");
+
+            footer.frames.push(FrameEntry {
+                offset: out.len() as u64,
+                len: compressed.len(),
+            });
+            out.extend_from_slice(&compressed);
+        }
+
+        footer.len = bytes.len() as u64;
+
+        let footer_bytes = bincode::serialize(&footer).expect("Should serialize.");
+        out.extend_from_slice(&footer_bytes);
+        out.extend_from_slice(&(footer_bytes.len() as u64).to_le_bytes());
+
+        let tmp = path.with_extension("sealed.tmp");
+        {
+            let mut file = File::create(&tmp).expect("Should create sealed segment.");
+            file.write_all(&out).expect("Should write sealed segment.");
+            file.sync_all().expect("Should sync sealed segment.");
+        }
+        fs::rename(&tmp, path).expect("Should replace sealed segment.");
+
+        // The rename is synced before the segment it replaces is deleted, so a power loss never
+        // leaves neither of them
+        sync_dir(path);
+
+        info!(
+            "Sealed {:?} from {} bytes into {} bytes",
+            path,
+            bytes.len(),
+            out.len()
+        );
+
+        out.len() as u64
+    }
+
+    /// Open the sealed segment at `path`, or None if there is none or it can not be read
+    pub fn open(path: &Path) -> Option<Self> {
+        let file = File::open(path).ok()?;
+        let mmap = unsafe { Mmap::map(&file) }.ok()?;
+
+        let footer = SealedSegment::read_footer(&mmap);
+        if footer.is_none() {
+            warn!("Sealed segment {:?} has no footer", path);
+        }
+
+        Some(SealedSegment {
+            footer: footer?,
+            mmap,
+            decoded: Mutex::new(None),
+        })
+    }
+
+    fn read_footer(bytes: &[u8]) -> Option<SealedFooter> {
+        let end = bytes.len().checked_sub(8)?;
+        let len = u64::from_le_bytes(bytes[end..].try_into().unwrap()) as usize;
+        let start = end.checked_sub(len)?;
+
+        bincode::deserialize(&bytes[start..end]).ok()
+    }
+
+    pub fn footer(&self) -> &SealedFooter {
+        &self.footer
+    }
+
+    /// Get the bytes of frame number `frame`, decompressing it if it is not the last one used
+    fn frame(&self, frame: usize) -> Arc<Vec<u8>> {
+        if let Some((f, bytes)) = &*self.decoded.lock().unwrap() {
+            if *f == frame {
+                return bytes.clone();
+            }
+        }
+
+        // The frame is decompressed without holding the cache, so other readers are not held up
+        let entry = self.footer.frames[frame];
+        let compressed = &self.mmap[entry.offset as usize..entry.offset as usize + entry.len];
+        let bytes = Arc::new(
+            zstd::bulk::decompress(compressed, SEALED_FRAME_SIZE)
+                .expect("Should decompress frame."),
+        );
+
+        *self.decoded.lock().unwrap() = Some((frame, bytes.clone()));
+        bytes
+    }
+
+    /// Call `f` with `len` bytes starting at `start`
+    ///
+    /// Returns None without calling `f` if part of the range was past the end of the segment.
+    pub fn with_slice<R>(&self, start: usize, len: usize, f: impl FnOnce(&[u8]) -> R) -> Option<R> {
+        if (start + len) as u64 > self.footer.len {
+            return None;
+        }
+
+        let frame = start / SEALED_FRAME_SIZE;
+        let local = start % SEALED_FRAME_SIZE;
+
+        // A range in one frame is used from it as it is, anything else is copied together
+        if local + len <= SEALED_FRAME_SIZE {
+            let bytes = self.frame(frame);
+            return Some(f(&bytes[local..local + len]));
+        }
+
+        let mut buf = vec![0u8; len];
+        self.read(start, &mut buf);
+        Some(f(&buf))
+    }
+
+    /// Copy the bytes starting at `start` into `buf`, reading past the end of the segment as
+    /// zeros
+    pub fn read(&self, start: usize, buf: &mut [u8]) {
+        let end = (self.footer.len as usize).min(start + buf.len());
+        let mut at = start;
+
+        while at < end {
+            let frame = at / SEALED_FRAME_SIZE;
+            let local = at % SEALED_FRAME_SIZE;
+            let bytes = self.frame(frame);
+
+            let count = (end - at).min(bytes.len() - local);
+            buf[at - start..at - start + count].copy_from_slice(&bytes[local..local + count]);
+            at += count;
+        }
+
+        buf[end.max(start) - start..].fill(0);
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use crate::constants::DATA_DIRECTORY;
+
+    #[test]
+    fn write_and_read_test() {
+        let dir = Path::new("./").join(DATA_DIRECTORY);
+        let _ = fs::create_dir_all(&dir);
+        let path = SealedSegment::get_path(&dir, 2010, 0);
+
+        // Two and a half frames that compress well
+        let bytes: Vec<u8> = (0..SEALED_FRAME_SIZE * 5 / 2)
+            .map(|i| (i / 4096) as u8)
+            .collect();
+
+        let size = SealedSegment::write(&path, &bytes, SealedFooter::new(10, 20, 3, 7));
+        assert!(size < bytes.len() as u64 / 10);
+
+        let sealed = SealedSegment::open(&path).unwrap();
+        let footer = sealed.footer();
+        assert_eq!((footer.first_row, footer.rows), (10, 20));
+        assert_eq!((footer.min, footer.max), (3, 7));
+        assert_eq!(footer.len, bytes.len() as u64);
+        assert_eq!(footer.frames.len(), 3);
+
+        assert_eq!(
+            sealed.with_slice(8192, 4, |b| b.to_vec()),
+            Some(bytes[8192..8196].to_vec())
+        );
+
+        // A range across two frames
+        let across = SEALED_FRAME_SIZE - 2;
+        assert_eq!(
+            sealed.with_slice(across, 4, |b| b.to_vec()),
+            Some(bytes[across..across + 4].to_vec())
+        );
+        assert_eq!(sealed.with_slice(bytes.len() - 2, 4, |b| b.to_vec()), None);
+
+        // Past the end reads as zeros
+        let mut buf = [9u8; 4];
+        sealed.read(bytes.len() - 2, &mut buf);
+        assert_eq!(buf[..2], bytes[bytes.len() - 2..]);
+        assert_eq!(buf[2..], [0, 0]);
+
+        let _ = fs::remove_file(&path);
+    }
+}
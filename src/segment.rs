@@ -0,0 +1,743 @@
+use super::constants::{DATA_DIRECTORY, SEGMENT_SIZE};
+use super::sealed::{SealedFooter, SealedSegment};
+use log::{info, warn};
+use memmap2::Mmap;
+use std::fs::{self, File, OpenOptions};
+use std::io::ErrorKind;
+use std::io::{Seek, SeekFrom, Write};
+use std::path::{Path, PathBuf};
+use std::sync::atomic::{AtomicBool, AtomicUsize, Ordering};
+use std::sync::{Arc, RwLock};
+
+// I had planned to test many different hashmap implementations
+type BHashMap<K, V> = std::collections::HashMap<K, V>;
+
+// Each column is stored as a few large files instead of one file per page.
+//
+// The bytes of a column are laid out one page after another, so a page of `capacity` bytes with
+// ID `pid` starts at byte `pid * capacity`. That byte range is split into segment files of
+// SEGMENT_SIZE bytes named `segment_{column}_{n}.data`. Pages are filled in order, so a column
+// only ever grows at the end of its last segment. Once a segment is full it is never written
+// again.
+//
+// Reads go through a memory map of the segment, so loading a page is a copy from an offset
+// instead of an open, read and close of a file. The map is dropped after a write and made again
+// on the next read, so it always covers the whole file.
+//
+// Reading only needs a shared reference, so many readers can use the segments at once. The map
+// is shared with an Arc, so a reader that is still using an old map is not affected when a write
+// drops it. Writes still come from one writer at a time, the one holding the bufferpool for
+// writing.
+//
+// A reader in another process opens the segments read only, and a segment the writer has not
+// made yet is just empty. Its map is not dropped by the writes, so a read past the end of the map
+// maps the file again if it has grown since, and a refresh of the reader drops all of its maps
+// to see the pages the writer wrote over.
+//
+// Retention deletes the segments at the start of a column once none of their rows are kept. The
+// segments before `first_segment` are never opened again, so a read of them gets zeros instead
+// of making an empty file. When the column is opened, `first_segment` is the first segment that
+// is on disk and `next_seal` is the one after the last sealed segment. A file is only made for a
+// write, and never for a segment before either of them, so a segment that was deleted or sealed
+// is never made again as an empty file.
+//
+// Full segments are compacted into sealed segments, see `sealed.rs`. A sealed segment is used
+// instead of the segment file from then on, and is decompressed a frame at a time as it is read.
+// Sealing takes the maps of the full segments in `begin_seal`, and they are compressed without
+// holding anything, since nothing writes to them again. Each sealed segment is then put in place
+// of its file with `install_sealed`, and `end_seal` lets the next sealing start.
+
+/// One segment file of a column with its memory map
+pub struct SegmentFile {
+    file: File,
+    mmap: RwLock<Option<Arc<Mmap>>>,
+}
+
+impl SegmentFile {
+    pub fn open(path: &Path) -> Self {
+        let file = OpenOptions::new()
+            .read(true)
+            .write(true)
+            .create(true)
+            .truncate(false)
+            .open(path)
+            .expect("Should open segment file.");
+
+        SegmentFile {
+            file,
+            mmap: RwLock::new(None),
+        }
+    }
+
+    /// Open a segment without creating it, or None if it does not exist yet
+    pub fn open_read_only(path: &Path) -> Option<Self> {
+        let file = File::open(path).ok()?;
+
+        Some(SegmentFile {
+            file,
+            mmap: RwLock::new(None),
+        })
+    }
+
+    /// Get the map of the bytes of the segment that are on disk, mapping the file if needed
+    ///
+    /// Returns None if the file is empty.
+    pub fn map(&self) -> Option<Arc<Mmap>> {
+        if let Some(m) = self.mmap.read().unwrap().as_ref() {
+            return Some(m.clone());
+        }
+
+        let mut mmap = self.mmap.write().unwrap();
+
+        // Another reader might have mapped it while this one waited
+        if mmap.is_none() {
+            let len = self.file.metadata().map(|m| m.len()).unwrap_or(0);
+
+            // An empty file cannot be mapped
+            if len > 0 {
+                match unsafe { Mmap::map(&self.file) } {
+                    Ok(m) => *mmap = Some(Arc::new(m)),
+                    Err(e) => warn!("Could not map segment: {}", e),
+                }
+            }
+        }
+
+        mmap.clone()
+    }
+
+    /// Get a map that covers the first `end` bytes if the file has that many
+    ///
+    /// The file is only mapped again if another process made it longer than the current map.
+    pub fn map_covering(&self, end: usize) -> Option<Arc<Mmap>> {
+        let map = self.map();
+
+        if map.as_ref().is_some_and(|m| m.len() >= end) {
+            return map;
+        }
+
+        let len = self.file.metadata().map(|m| m.len()).unwrap_or(0) as usize;
+        if len <= map.as_ref().map_or(0, |m| m.len()) {
+            return map;
+        }
+
+        *self.mmap.write().unwrap() = None;
+        self.map()
+    }
+
+    /// Drop the map so the next read maps the file again
+    pub fn unmap(&self) {
+        *self.mmap.write().unwrap() = None;
+    }
+
+    /// Make sure everything written to the segment is on disk
+    pub fn sync(&self) {
+        self.file.sync_data().expect("Should sync segment.");
+    }
+
+    pub fn write(&self, offset: u64, data: &[u8]) {
+        // The map might not cover the bytes written past its end, so map it again next read
+        *self.mmap.write().unwrap() = None;
+
+        let mut file = &self.file;
+        file.seek(SeekFrom::Start(offset))
+            .expect("Should seek in segment.");
+        file.write_all(data).expect("Should be able to write.");
+    }
+}
+
+/// A segment of a column, either still a plain file or already sealed
+enum Stored {
+    File(Arc<SegmentFile>),
+    Sealed(Arc<SealedSegment>),
+}
+
+/// All of the segment files of one column
+pub struct ColumnSegments {
+    // The directory of the shard the column is in
+    dir: PathBuf,
+    column_index: usize,
+    segments: RwLock<BHashMap<usize, Arc<SegmentFile>>>,
+    sealed: RwLock<BHashMap<usize, Arc<SealedSegment>>>,
+    // Opened by a reader, so files are never made or written
+    read_only: bool,
+    // The segments before this one were deleted
+    first_segment: usize,
+    // Every segment before this one has been sealed
+    next_seal: AtomicUsize,
+    // Set while sealing, so segments are sealed by one thread at a time
+    sealing: AtomicBool,
+}
+
+impl ColumnSegments {
+    pub fn new(column_index: usize) -> Self {
+        ColumnSegments::open(&Path::new("./").join(DATA_DIRECTORY), column_index, false)
+    }
+
+    /// Use the segments of a column in `dir`, only reading them if `read_only` is set because
+    /// another process writes them
+    pub fn open(dir: &Path, column_index: usize, read_only: bool) -> Self {
+        let (files, sealed) = ColumnSegments::list(dir, column_index);
+
+        // Retention deletes segments from the start, so the first one on disk is the first kept
+        let first_segment = files.iter().chain(&sealed).min().copied().unwrap_or(0);
+
+        // Segments are sealed in order, so every one before the last sealed one is sealed too
+        let next_seal = sealed.iter().max().map_or(0, |s| s + 1).max(first_segment);
+
+        ColumnSegments {
+            dir: dir.to_path_buf(),
+            column_index,
+            segments: RwLock::new(BHashMap::new()),
+            sealed: RwLock::new(BHashMap::new()),
+            read_only,
+            first_segment,
+            next_seal: AtomicUsize::new(next_seal),
+            sealing: AtomicBool::new(false),
+        }
+    }
+
+    /// Get the numbers of the segment files and of the sealed segments of a column in `dir`
+    fn list(dir: &Path, column_index: usize) -> (Vec<usize>, Vec<usize>) {
+        let prefix = format!("segment_{}_", column_index);
+        let mut files = vec![];
+        let mut sealed = vec![];
+
+        for entry in fs::read_dir(dir).into_iter().flatten().flatten() {
+            let name = entry.file_name();
+            let Some(rest) = name.to_str().and_then(|n| n.strip_prefix(&prefix)) else {
+                continue;
+            };
+
+            if let Some(Ok(n)) = rest.strip_suffix(".data").map(str::parse) {
+                files.push(n);
+            } else if let Some(Ok(n)) = rest.strip_suffix(".sealed").map(str::parse) {
+                sealed.push(n);
+            }
+        }
+
+        (files, sealed)
+    }
+
+    pub fn get_segment_path(column_index: usize, segment: usize) -> PathBuf {
+        ColumnSegments::get_segment_path_in(
+            &Path::new("./").join(DATA_DIRECTORY),
+            column_index,
+            segment,
+        )
+    }
+
+    pub fn get_segment_path_in(dir: &Path, column_index: usize, segment: usize) -> PathBuf {
+        dir.join(format!("segment_{}_{}.data", column_index, segment))
+    }
+
+    /// Get a segment, opening it if needed
+    ///
+    /// The file is only made if `create` is set and the segment was never deleted or sealed.
+    /// Returns None if the file does not exist and is not made, or if the segment was deleted.
+    fn stored(&self, segment: usize, create: bool) -> Option<Stored> {
+        if segment < self.first_segment {
+            return None;
+        }
+
+        if let Some(sealed) = self.sealed.read().unwrap().get(&segment) {
+            return Some(Stored::Sealed(sealed.clone()));
+        }
+
+        if let Some(file) = self.segments.read().unwrap().get(&segment) {
+            return Some(Stored::File(file.clone()));
+        }
+
+        let path = ColumnSegments::get_segment_path_in(&self.dir, self.column_index, segment);
+        let mut segments = self.segments.write().unwrap();
+
+        // Another reader might have opened it while this one waited
+        if let Some(file) = segments.get(&segment) {
+            return Some(Stored::File(file.clone()));
+        }
+
+        if let Some(sealed) = self.open_sealed(segment) {
+            return Some(Stored::Sealed(sealed));
+        }
+
+        info!("Opening segment {:?}", path);
+        let file = if self.read_only {
+            // The writer might have sealed it and deleted the file since the last look
+            match SegmentFile::open_read_only(&path) {
+                Some(file) => file,
+                None => return self.open_sealed(segment).map(Stored::Sealed),
+            }
+        } else if path.exists() {
+            SegmentFile::open(&path)
+        } else if create && segment >= self.next_seal.load(Ordering::SeqCst) {
+            SegmentFile::open(&path)
+        } else {
+            return None;
+        };
+
+        let file = Arc::new(file);
+        segments.insert(segment, file.clone());
+        Some(Stored::File(file))
+    }
+
+    /// Open the sealed segment that replaced `segment`, if there is one
+    fn open_sealed(&self, segment: usize) -> Option<Arc<SealedSegment>> {
+        let path = SealedSegment::get_path(&self.dir, self.column_index, segment);
+        let sealed = Arc::new(SealedSegment::open(&path)?);
+
+        info!("Opened sealed segment {:?}", path);
+        self.sealed
+            .write()
+            .unwrap()
+            .entry(segment)
+            .or_insert(sealed.clone());
+
+        // A crash right after sealing leaves the file it replaced
+        if !self.read_only {
+            self.remove_file(segment);
+        }
+
+        Some(sealed)
+    }
+
+    /// Delete the file of a segment if it is there, returning if it was
+    fn remove_file(&self, segment: usize) -> bool {
+        let path = ColumnSegments::get_segment_path_in(&self.dir, self.column_index, segment);
+
+        match fs::remove_file(&path) {
+            Ok(()) => {
+                info!("Removed segment {:?}", path);
+                true
+            }
+            Err(e) if e.kind() == ErrorKind::NotFound => false,
+            Err(e) => {
+                warn!("Could not remove segment {:?}: {}", path, e);
+                false
+            }
+        }
+    }
+
+    /// Split a byte offset in the column into the segment number and the offset in that segment
+    fn locate(offset: u64) -> (usize, u64) {
+        let segment_size = SEGMENT_SIZE as u64;
+        ((offset / segment_size) as usize, offset % segment_size)
+    }
+
+    /// Call `f` with `len` bytes starting at `offset` straight from the memory map
+    ///
+    /// Returns None without calling `f` if part of the range has not been written to disk yet.
+    pub fn with_slice<R>(&self, offset: u64, len: usize, f: impl FnOnce(&[u8]) -> R) -> Option<R> {
+        let (segment, local) = ColumnSegments::locate(offset);
+        let start = local as usize;
+
+        let file = match self.stored(segment, false)? {
+            Stored::File(file) => file,
+            Stored::Sealed(sealed) => return sealed.with_slice(start, len, f),
+        };
+
+        let map = file.map_covering(start + len)?;
+
+        if start + len <= map.len() {
+            return Some(f(&map[start..start + len]));
+        }
+
+        None
+    }
+
+    /// Copy the bytes starting at `offset` into `buf`
+    ///
+    /// Anything that has not been written to disk yet is read as zeros.
+    pub fn read(&self, offset: u64, buf: &mut [u8]) {
+        let (segment, local) = ColumnSegments::locate(offset);
+        let start = local as usize;
+
+        let map = match self.stored(segment, false) {
+            Some(Stored::File(file)) => file.map_covering(start + buf.len()),
+            Some(Stored::Sealed(sealed)) => return sealed.read(start, buf),
+            None => None,
+        };
+        let bytes: &[u8] = map.as_deref().map_or(&[], |m| &m[..]);
+
+        if start < bytes.len() {
+            let end = bytes.len().min(start + buf.len());
+            let count = end - start;
+
+            buf[..count].copy_from_slice(&bytes[start..end]);
+            buf[count..].fill(0);
+        } else {
+            buf.fill(0);
+        }
+    }
+
+    /// Map every segment again on its next read, to see pages another process wrote over
+    pub fn unmap(&self) {
+        for file in self.segments.read().unwrap().values() {
+            file.unmap();
+        }
+    }
+
+    /// Make sure everything written to the open segments is on disk
+    pub fn sync(&self) {
+        if self.read_only {
+            return;
+        }
+
+        for file in self.segments.read().unwrap().values() {
+            file.sync();
+        }
+    }
+
+    /// Delete every segment file before the one with byte `offset` in it, returning how many
+    /// were deleted
+    ///
+    /// A file that can not be deleted yet, like one another process has mapped on Windows, is
+    /// tried again the next time.
+    pub fn remove_before(&mut self, offset: u64) -> usize {
+        assert!(!self.read_only, "Read only segments can not be removed");
+
+        let (last, _) = ColumnSegments::locate(offset);
+        let mut removed = 0;
+
+        for segment in 0..last {
+            self.segments.write().unwrap().remove(&segment);
+            self.sealed.write().unwrap().remove(&segment);
+
+            if self.remove_file(segment) {
+                removed += 1;
+            }
+
+            let path = SealedSegment::get_path(&self.dir, self.column_index, segment);
+            match fs::remove_file(&path) {
+                Ok(()) => {
+                    info!("Removed sealed segment {:?}", path);
+                    removed += 1;
+                }
+                Err(e) if e.kind() == ErrorKind::NotFound => {}
+                Err(e) => warn!("Could not remove sealed segment {:?}: {}", path, e),
+            }
+        }
+
+        self.first_segment = self.first_segment.max(last);
+        self.next_seal.fetch_max(last, Ordering::SeqCst);
+        removed
+    }
+
+    pub fn write(&self, offset: u64, data: &[u8]) {
+        assert!(!self.read_only, "Read only segments can not be written");
+
+        let (segment, local) = ColumnSegments::locate(offset);
+
+        match self.stored(segment, true) {
+            Some(Stored::File(file)) => file.write(local, data),
+            Some(Stored::Sealed(_)) => panic!("Sealed segments can not be written"),
+            None => panic!("Should open segment."),
+        }
+    }
+
+    /// The first segment that might not be sealed yet
+    pub fn next_seal(&self) -> usize {
+        self.next_seal.load(Ordering::SeqCst)
+    }
+
+    /// Start sealing the segments before `end` that are not sealed yet, getting the number and the
+    /// map of each one
+    ///
+    /// Returns None if another thread is sealing. Nothing can be written to these segments again.
+    pub fn begin_seal(&self, end: usize) -> Option<Vec<(usize, Option<Arc<Mmap>>)>> {
+        assert!(!self.read_only, "Read only segments can not be sealed");
+
+        if self.sealing.swap(true, Ordering::SeqCst) {
+            return None;
+        }
+
+        let maps = (self.next_seal()..end)
+            .filter_map(|segment| match self.stored(segment, false) {
+                Some(Stored::File(file)) => Some((segment, file.map())),
+                _ => None,
+            })
+            .collect();
+
+        Some(maps)
+    }
+
+    /// Use the sealed segment written for `segment` instead of its file and delete the file,
+    /// returning false if retention deleted the segment while it was being sealed
+    pub fn install_sealed(&self, segment: usize) -> bool {
+        let path = SealedSegment::get_path(&self.dir, self.column_index, segment);
+
+        if segment < self.first_segment {
+            let _ = fs::remove_file(&path);
+            return false;
+        }
+
+        let replacement = SealedSegment::open(&path).expect("Should open sealed segment.");
+        self.sealed
+            .write()
+            .unwrap()
+            .insert(segment, Arc::new(replacement));
+        self.segments.write().unwrap().remove(&segment);
+
+        // The sealed segment and its directory entry are synced, so the file can go
+        self.remove_file(segment);
+        true
+    }
+
+    /// Finish sealing, with every segment before `end` sealed
+    pub fn end_seal(&self, end: usize) {
+        self.next_seal.fetch_max(end, Ordering::SeqCst);
+        self.sealing.store(false, Ordering::SeqCst);
+    }
+
+    /// Seal every segment before `end` that is not sealed yet, returning how many were sealed
+    ///
+    /// `footer` gets the number and the bytes of each segment and says which rows are in it.
+    pub fn seal_before(&self, end: usize, footer: impl Fn(usize, &[u8]) -> SealedFooter) -> usize {
+        let Some(maps) = self.begin_seal(end) else {
+            return 0;
+        };
+        let mut sealed = 0;
+
+        for (segment, map) in maps {
+            let bytes: &[u8] = map.as_deref().map_or(&[], |m| &m[..]);
+
+            let path = SealedSegment::get_path(&self.dir, self.column_index, segment);
+            SealedSegment::write(&path, bytes, footer(segment, bytes));
+
+            if self.install_sealed(segment) {
+                sealed += 1;
+            }
+        }
+
+        self.end_seal(end);
+        sealed
+    }
+
+    /// Get the footer of a sealed segment, or None if it is not sealed
+    pub fn sealed_footer(&self, segment: usize) -> Option<SealedFooter> {
+        match self.stored(segment, false)? {
+            Stored::Sealed(sealed) => Some(sealed.footer().clone()),
+            Stored::File(_) => None,
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use std::fs;
+
+    fn cleanup_segments(column_index: usize) {
+        let dir = Path::new("./").join(DATA_DIRECTORY);
+
+        for segment in 0..3 {
+            let _ = fs::remove_file(ColumnSegments::get_segment_path(column_index, segment));
+            let _ = fs::remove_file(SealedSegment::get_path(&dir, column_index, segment));
+        }
+    }
+
+    fn ensure_data_directory() {
+        let path = Path::new("./").join(DATA_DIRECTORY);
+        if !path.exists() {
+            let _ = fs::create_dir_all(path);
+        }
+    }
+
+    #[test]
+    fn segment_path_test() {
+        let path = ColumnSegments::get_segment_path(3, 5);
+        assert!(path.to_string_lossy().contains("segment_3_5.data"));
+    }
+
+    #[test]
+    fn write_and_read_test() {
+        ensure_data_directory();
+        let column_index = 2000;
+        cleanup_segments(column_index);
+
+        let segments = ColumnSegments::new(column_index);
+
+        segments.write(0, &[1, 2, 3, 4]);
+        segments.write(4, &[5, 6]);
+
+        let mut buf = [9u8; 8];
+        segments.read(0, &mut buf);
+
+        // Bytes past the end of the file are zeros
+        assert_eq!(buf, [1, 2, 3, 4, 5, 6, 0, 0]);
+
+        assert_eq!(
+            segments.with_slice(2, 4, |b| b.to_vec()),
+            Some(vec![3, 4, 5, 6])
+        );
+        assert_eq!(segments.with_slice(2, 8, |b| b.to_vec()), None);
+
+        cleanup_segments(column_index);
+    }
+
+    #[test]
+    fn rolls_over_to_next_segment_test() {
+        ensure_data_directory();
+        let column_index = 2001;
+        cleanup_segments(column_index);
+
+        let segments = ColumnSegments::new(column_index);
+
+        let offset = SEGMENT_SIZE as u64;
+        segments.write(offset, &[7, 7]);
+
+        assert!(ColumnSegments::get_segment_path(column_index, 1).exists());
+
+        let mut buf = [0u8; 2];
+        segments.read(offset, &mut buf);
+        assert_eq!(buf, [7, 7]);
+
+        cleanup_segments(column_index);
+    }
+
+    #[test]
+    fn read_sees_data_from_previous_handle_test() {
+        ensure_data_directory();
+        let column_index = 2002;
+        cleanup_segments(column_index);
+
+        {
+            let segments = ColumnSegments::new(column_index);
+            segments.write(16, &[42; 16]);
+        }
+
+        let segments = ColumnSegments::new(column_index);
+        let mut buf = [0u8; 16];
+        segments.read(16, &mut buf);
+        assert_eq!(buf, [42; 16]);
+
+        cleanup_segments(column_index);
+    }
+
+    #[test]
+    fn remove_before_test() {
+        ensure_data_directory();
+        let column_index = 2004;
+        cleanup_segments(column_index);
+
+        let mut segments = ColumnSegments::new(column_index);
+        let segment_size = SEGMENT_SIZE as u64;
+
+        segments.write(0, &[1]);
+        segments.write(segment_size, &[2]);
+        segments.write(2 * segment_size + 8, &[3]);
+
+        // Only whole segments before the one the offset is in are removed
+        assert_eq!(segments.remove_before(segment_size + 8), 1);
+        assert!(!ColumnSegments::get_segment_path(column_index, 0).exists());
+        assert!(ColumnSegments::get_segment_path(column_index, 1).exists());
+
+        assert_eq!(segments.remove_before(2 * segment_size + 8), 1);
+        assert_eq!(segments.remove_before(2 * segment_size), 0);
+
+        // A removed segment reads as zeros and is not made again
+        let mut buf = [9u8; 1];
+        segments.read(0, &mut buf);
+        assert_eq!(buf, [0]);
+        assert!(!ColumnSegments::get_segment_path(column_index, 0).exists());
+
+        segments.read(2 * segment_size + 8, &mut buf);
+        assert_eq!(buf, [3]);
+
+        // After a restart the deleted segments are not sealed or made again either
+        let reopened = ColumnSegments::new(column_index);
+        assert_eq!(reopened.next_seal(), 2);
+        assert_eq!(reopened.seal_before(2, |_, _| unreachable!()), 0);
+        reopened.read(segment_size, &mut buf);
+        assert_eq!(buf, [0]);
+        assert!(!ColumnSegments::get_segment_path(column_index, 0).exists());
+        assert!(!ColumnSegments::get_segment_path(column_index, 1).exists());
+
+        cleanup_segments(column_index);
+    }
+
+    #[test]
+    fn seal_before_test() {
+        ensure_data_directory();
+        let column_index = 2005;
+        cleanup_segments(column_index);
+
+        let dir = Path::new("./").join(DATA_DIRECTORY);
+        let segments = ColumnSegments::new(column_index);
+        let segment_size = SEGMENT_SIZE as u64;
+
+        segments.write(16, &[42; 16]);
+        segments.write(segment_size, &[7]);
+
+        // A reader that opened the segment before it was sealed
+        let reader = ColumnSegments::open(&dir, column_index, true);
+        assert_eq!(reader.with_slice(16, 2, |b| b.to_vec()), Some(vec![42, 42]));
+
+        let sealed = segments.seal_before(1, |segment, bytes| {
+            assert_eq!(segment, 0);
+            assert_eq!(bytes.len(), 32);
+            SealedFooter::new(0, 2, 0, 42)
+        });
+        assert_eq!(sealed, 1);
+        assert_eq!(segments.next_seal(), 1);
+
+        assert!(!ColumnSegments::get_segment_path(column_index, 0).exists());
+        assert!(SealedSegment::get_path(&dir, column_index, 0).exists());
+        assert_eq!(segments.sealed_footer(0).unwrap().max, 42);
+        assert_eq!(segments.sealed_footer(1), None);
+
+        // Reads are the same as before, with zeros past what was written
+        let mut buf = [9u8; 40];
+        segments.read(0, &mut buf);
+        assert_eq!(buf[..16], [0; 16]);
+        assert_eq!(buf[16..32], [42; 16]);
+        assert_eq!(buf[32..], [0; 8]);
+        assert_eq!(
+            segments.with_slice(16, 2, |b| b.to_vec()),
+            Some(vec![42, 42])
+        );
+        assert_eq!(reader.with_slice(16, 2, |b| b.to_vec()), Some(vec![42, 42]));
+
+        // Sealing again does nothing
+        assert_eq!(segments.seal_before(1, |_, _| unreachable!()), 0);
+
+        // A new handle and a new reader use the sealed segment
+        let reopened = ColumnSegments::new(column_index);
+        assert_eq!(reopened.next_seal(), 1);
+        assert_eq!(reopened.with_slice(16, 1, |b| b[0]), Some(42));
+        assert_eq!(reopened.seal_before(1, |_, _| unreachable!()), 0);
+
+        let reader = ColumnSegments::open(&dir, column_index, true);
+        assert_eq!(reader.with_slice(segment_size, 1, |b| b[0]), Some(7));
+        assert_eq!(reader.with_slice(31, 1, |b| b[0]), Some(42));
+
+        cleanup_segments(column_index);
+    }
+
+    #[test]
+    fn read_only_sees_later_writes_test() {
+        ensure_data_directory();
+        let column_index = 2003;
+        cleanup_segments(column_index);
+
+        let dir = Path::new("./").join(DATA_DIRECTORY);
+        let reader = ColumnSegments::open(&dir, column_index, true);
+
+        // Nothing is made for a segment that was never written
+        let mut buf = [9u8; 4];
+        reader.read(0, &mut buf);
+        assert_eq!(buf, [0; 4]);
+        assert!(!ColumnSegments::get_segment_path(column_index, 0).exists());
+
+        let writer = ColumnSegments::new(column_index);
+        writer.write(0, &[1, 2]);
+        assert_eq!(reader.with_slice(0, 2, |b| b.to_vec()), Some(vec![1, 2]));
+
+        // The reader's map is older than this write, so it is mapped again
+        writer.write(2, &[3, 4]);
+        assert_eq!(
+            reader.with_slice(0, 4, |b| b.to_vec()),
+            Some(vec![1, 2, 3, 4])
+        );
+
+        cleanup_segments(column_index);
+    }
+}
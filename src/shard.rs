@@ -0,0 +1,112 @@
+use super::constants::DATA_DIRECTORY;
+use log::info;
+use std::fs::{self, File, OpenOptions, TryLockError};
+use std::path::{Path, PathBuf};
+
+// Every process that writes gets its own shard of the data directory, with its own columns, name
+// dictionary, index and watermark, so worker processes of the same app never write the same
+// files.
+//
+// Shard 0 is the data directory itself, so a single process keeps the layout it always had.
+// Shard n is `shard-{n}` inside of it.
+//
+// A writer takes the first shard whose `writer.lock` it can lock. The OS lets go of the lock when
+// the process ends, even if it crashes, so the next process to start takes that shard over and
+// keeps adding to it. 16 workers use shards 0 to 15, and a restart does not make new ones.
+//
+// The shard number is also in the row IDs, see SHARD_ROW_BITS, so a row has the same ID for the
+// writer and for any reader.
+
+/// Get the directory of shard `number`
+pub fn get_shard_dir(number: usize) -> PathBuf {
+    let root = Path::new("./").join(DATA_DIRECTORY);
+
+    match number {
+        0 => root,
+        n => root.join(format!("shard-{}", n)),
+    }
+}
+
+/// Take the first shard that no other writer has, returning its number and the lock on it
+///
+/// The shard is only kept while the returned file is open.
+pub fn claim_shard() -> (usize, File) {
+    let mut number = 0;
+
+    loop {
+        let dir = get_shard_dir(number);
+        fs::create_dir_all(&dir).expect("Should create shard directory.");
+
+        let lock = OpenOptions::new()
+            .write(true)
+            .create(true)
+            .truncate(false)
+            .open(dir.join("writer.lock"))
+            .expect("Should open shard lock.");
+
+        match lock.try_lock() {
+            Ok(()) => {
+                info!("Writing to shard {} at {:?}", number, dir);
+                return (number, lock);
+            }
+            Err(TryLockError::WouldBlock) => number += 1,
+            Err(TryLockError::Error(e)) => panic!("Could not lock shard {}: {}", number, e),
+        }
+    }
+}
+
+/// Get the numbers of every shard that exists, in order
+///
+/// Shard 0 is always there, it is empty if nothing has been written yet.
+pub fn list_shards() -> Vec<usize> {
+    let mut shards = vec![0];
+
+    if let Ok(entries) = fs::read_dir(get_shard_dir(0)) {
+        for entry in entries.flatten() {
+            let name = entry.file_name();
+            let number = name
+                .to_str()
+                .and_then(|n| n.strip_prefix("shard-"))
+                .and_then(|n| n.parse::<usize>().ok());
+
+            if let Some(n) = number.filter(|n| *n > 0) {
+                if entry.path().is_dir() {
+                    shards.push(n);
+                }
+            }
+        }
+    }
+
+    shards.sort_unstable();
+    shards
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn shard_dir_test() {
+        assert!(get_shard_dir(0).ends_with(DATA_DIRECTORY));
+        assert!(get_shard_dir(3).ends_with(format!("{}/shard-3", DATA_DIRECTORY)));
+    }
+
+    #[test]
+    fn claimed_shard_is_not_claimed_again_test() {
+        let (first, first_lock) = claim_shard();
+        let (second, second_lock) = claim_shard();
+
+        assert_ne!(first, second);
+        assert!(list_shards().contains(&first));
+        assert!(list_shards().contains(&second));
+
+        // Once a writer is done its shard can be taken again
+        let path = get_shard_dir(second).join("writer.lock");
+        assert!(File::open(&path).unwrap().try_lock().is_err());
+
+        drop(second_lock);
+        assert!(File::open(&path).unwrap().try_lock().is_ok());
+
+        drop(first_lock);
+    }
+}
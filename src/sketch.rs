@@ -0,0 +1,251 @@
+use super::constants::{SKETCH_MAX_BUCKETS, SKETCH_RELATIVE_ACCURACY};
+use serde::{Deserialize, Serialize};
+
+// A quantile sketch of the deltas of one function, so percentiles do not need every row.
+//
+// This works like DDSketch. Values are counted in buckets whose bounds grow by a factor of
+// gamma = (1 + a) / (1 - a), where `a` is SKETCH_RELATIVE_ACCURACY. Bucket `k` holds the values
+// in (gamma^(k-1), gamma^k], and a percentile is answered with the middle of its bucket, so it is
+// never more than `a` away from the real value relative to it. Zero can not go in a bucket, so
+// zeros are counted on their own.
+//
+// The counts are kept in a Vec starting at the bucket `offset`, since the deltas of a function
+// are usually in a small range. Two sketches are merged by adding up their buckets, which gives
+// the same sketch as adding all of the values to one.
+
+/// Mergeable quantile sketch with a bounded relative error
+#[derive(Debug, Clone, Serialize, Deserialize, PartialEq)]
+pub struct Sketch {
+    count: u64,
+    zero_count: u64,
+    /// The bucket of `counts[0]`
+    offset: i32,
+    counts: Vec<u64>,
+}
+
+fn ln_gamma() -> f64 {
+    let a = SKETCH_RELATIVE_ACCURACY;
+    ((1.0 + a) / (1.0 - a)).ln()
+}
+
+impl Sketch {
+    pub fn new() -> Self {
+        Sketch {
+            count: 0,
+            zero_count: 0,
+            offset: 0,
+            counts: vec![],
+        }
+    }
+
+    pub fn count(&self) -> u64 {
+        self.count
+    }
+
+    /// The bucket that `value` goes in
+    fn key(value: u128) -> i32 {
+        ((value as f64).ln() / ln_gamma()).ceil() as i32
+    }
+
+    /// The value that stands for everything in bucket `key`
+    fn value(key: i32) -> f64 {
+        let gamma = ln_gamma().exp();
+        2.0 * gamma.powi(key) / (gamma + 1.0)
+    }
+
+    /// Make room for buckets `from` to `to` in `counts`
+    fn grow(&mut self, from: i32, to: i32) {
+        if self.counts.is_empty() {
+            self.offset = from;
+            self.counts = vec![0; (to - from + 1) as usize];
+            return;
+        }
+
+        if from < self.offset {
+            let extra = (self.offset - from) as usize;
+            self.counts.splice(0..0, std::iter::repeat(0).take(extra));
+            self.offset = from;
+        }
+
+        let last = self.offset + self.counts.len() as i32 - 1;
+        if to > last {
+            self.counts
+                .resize(self.counts.len() + (to - last) as usize, 0);
+        }
+    }
+
+    /// Merge the smallest buckets together until there are at most SKETCH_MAX_BUCKETS
+    ///
+    /// This only makes the low percentiles less accurate, which are the ones that matter least.
+    fn collapse(&mut self) {
+        if self.counts.len() <= SKETCH_MAX_BUCKETS {
+            return;
+        }
+
+        let extra = self.counts.len() - SKETCH_MAX_BUCKETS;
+        let merged: u64 = self.counts[..=extra].iter().sum();
+
+        self.counts.drain(..extra);
+        self.counts[0] = merged;
+        self.offset += extra as i32;
+    }
+
+    pub fn add(&mut self, value: u128) {
+        self.count += 1;
+
+        if value == 0 {
+            self.zero_count += 1;
+            return;
+        }
+
+        let key = Sketch::key(value);
+        self.grow(key, key);
+        self.counts[(key - self.offset) as usize] += 1;
+
+        self.collapse();
+    }
+
+    /// Add all of the values counted in `other`
+    pub fn merge(&mut self, other: &Sketch) {
+        self.count += other.count;
+        self.zero_count += other.zero_count;
+
+        if other.counts.is_empty() {
+            return;
+        }
+
+        let last = other.offset + other.counts.len() as i32 - 1;
+        self.grow(other.offset, last);
+
+        let start = (other.offset - self.offset) as usize;
+        for (i, c) in other.counts.iter().enumerate() {
+            self.counts[start + i] += c;
+        }
+
+        self.collapse();
+    }
+
+    /// Get the value that a fraction `q` of the values are at or below, from 0.0 to 1.0
+    ///
+    /// Returns None if nothing has been added.
+    pub fn quantile(&self, q: f64) -> Option<f64> {
+        if self.count == 0 {
+            return None;
+        }
+
+        let rank = (q.clamp(0.0, 1.0) * (self.count - 1) as f64).floor() as u64;
+
+        if rank < self.zero_count {
+            return Some(0.0);
+        }
+
+        let mut seen = self.zero_count;
+        for (i, c) in self.counts.iter().enumerate() {
+            seen += c;
+
+            if seen > rank {
+                return Some(Sketch::value(self.offset + i as i32));
+            }
+        }
+
+        // Only reached if the counts do not add up, use the largest bucket
+        Some(Sketch::value(self.offset + self.counts.len() as i32 - 1))
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn exact(sorted: &[u128], q: f64) -> f64 {
+        sorted[(q * (sorted.len() - 1) as f64).floor() as usize] as f64
+    }
+
+    fn assert_close(estimate: f64, real: f64) {
+        let error = (estimate - real).abs() / real;
+        assert!(
+            error <= SKETCH_RELATIVE_ACCURACY + 1e-9,
+            "{} is not within {} of {}",
+            estimate,
+            SKETCH_RELATIVE_ACCURACY,
+            real
+        );
+    }
+
+    #[test]
+    fn quantile_test() {
+        let mut sketch = Sketch::new();
+        let mut values = vec![];
+
+        // Spread out over a few orders of magnitude, with a long tail
+        for i in 1..=10_000u128 {
+            let v = 1000 + (i * i * 7919) % 5_000_000;
+            sketch.add(v);
+            values.push(v);
+        }
+
+        values.sort();
+
+        for q in [0.0, 0.01, 0.25, 0.5, 0.9, 0.95, 0.99, 0.999, 1.0] {
+            assert_close(sketch.quantile(q).unwrap(), exact(&values, q));
+        }
+    }
+
+    #[test]
+    fn empty_and_zero_test() {
+        let mut sketch = Sketch::new();
+        assert_eq!(sketch.quantile(0.5), None);
+
+        sketch.add(0);
+        sketch.add(0);
+        sketch.add(100);
+
+        assert_eq!(sketch.count(), 3);
+        assert_eq!(sketch.quantile(0.5), Some(0.0));
+        assert_close(sketch.quantile(1.0).unwrap(), 100.0);
+    }
+
+    #[test]
+    fn merge_matches_single_sketch_test() {
+        let mut whole = Sketch::new();
+        let mut small = Sketch::new();
+        let mut large = Sketch::new();
+
+        for i in 0..1000u128 {
+            let v = i * 37 + 5;
+            whole.add(v);
+
+            if v < 20_000 {
+                small.add(v);
+            } else {
+                large.add(v);
+            }
+        }
+
+        // The smaller values are in buckets before any of the ones in `large`
+        large.merge(&small);
+        assert_eq!(large, whole);
+
+        let mut empty = Sketch::new();
+        empty.merge(&whole);
+        assert_eq!(empty, whole);
+    }
+
+    #[test]
+    fn collapse_keeps_count_test() {
+        let mut sketch = Sketch::new();
+
+        // Values from 1 up to 2^100 need more buckets than are kept
+        for shift in 0..100 {
+            for _ in 0..10 {
+                sketch.add(1u128 << shift);
+            }
+        }
+
+        assert!(sketch.counts.len() <= SKETCH_MAX_BUCKETS);
+        assert_eq!(sketch.counts.iter().sum::<u64>(), sketch.count());
+
+        // The high percentiles are still accurate
+        assert_close(sketch.quantile(1.0).unwrap(), (1u128 << 99) as f64);
+    }
+}
@@ -0,0 +1,404 @@
+use log::{info, warn};
+use std::fs::{self, File, OpenOptions};
+use std::io::{Seek, SeekFrom, Write};
+use std::path::{Path, PathBuf};
+use std::time::{Duration, Instant};
+
+// Captures are written to the write-ahead log before anything else.
+//
+// Writing a group of captures appends one record per new name and one per row to `wal.data` with
+// a single write, and the log is synced to disk at most every `sync_interval` milliseconds, so
+// many groups share one fsync. If no group comes after one that was not synced, the background
+// checkpointer syncs it once `sync_interval` has passed. The columns, the name dictionary and the
+// pages are only saved by a checkpoint, which happens once the log is WAL_CHECKPOINT_BYTES big,
+// or every CHECKPOINT_INTERVAL milliseconds if it does not get that big. A checkpoint syncs
+// everything it saved and then starts the log over.
+//
+// When a shard is opened, the rows in the log that the saved columns do not have are written to
+// the columns again. Each column catches up from its own row count, so a crash in the middle of a
+// checkpoint, with some columns saved and some not, still ends with every column at the same row.
+//
+// The file starts with the number of the first row in it as a little endian u64. Each record is
+// then:
+//
+// | kind (u8) | length (u32) | payload | check (u32) |
+//
+// where the check is FNV-1a of the kind and the payload. A name is its code (u32) and its bytes,
+// and a row is the code (u32), start (u128) and delta (u128) of the capture. A record that was
+// cut off or does not match its check ends the log, and is cut off the file when it is opened.
+
+const KIND_NAME: u8 = 1;
+const KIND_ROW: u8 = 2;
+
+const HEADER_SIZE: u64 = 8;
+
+/// A name or a row that was written to the log
+#[derive(Debug, Clone, PartialEq)]
+pub enum WalRecord {
+    Name { code: u32, name: String },
+    Row { code: u32, start: u128, delta: u128 },
+}
+
+fn check(kind: u8, payload: &[u8]) -> u32 {
+    let mut hash: u32 = 0x811c_9dc5;
+
+    for b in std::iter::once(&kind).chain(payload) {
+        hash ^= *b as u32;
+        hash = hash.wrapping_mul(0x0100_0193);
+    }
+
+    hash
+}
+
+/// Read the next whole record from `bytes`, returning it and how many bytes it took
+fn read_record(bytes: &[u8]) -> Option<(WalRecord, usize)> {
+    let kind = *bytes.first()?;
+    let len = u32::from_le_bytes(bytes.get(1..5)?.try_into().unwrap()) as usize;
+    let payload = bytes.get(5..5 + len)?;
+    let stored = u32::from_le_bytes(bytes.get(5 + len..9 + len)?.try_into().unwrap());
+
+    if stored != check(kind, payload) {
+        return None;
+    }
+
+    let record = match kind {
+        KIND_NAME if len >= 4 => WalRecord::Name {
+            code: u32::from_le_bytes(payload[..4].try_into().unwrap()),
+            name: String::from_utf8_lossy(&payload[4..]).to_string(),
+        },
+        KIND_ROW if len == 36 => WalRecord::Row {
+            code: u32::from_le_bytes(payload[..4].try_into().unwrap()),
+            start: u128::from_le_bytes(payload[4..20].try_into().unwrap()),
+            delta: u128::from_le_bytes(payload[20..36].try_into().unwrap()),
+        },
+        _ => return None,
+    };
+
+    Some((record, 9 + len))
+}
+
+/// The write-ahead log of one shard
+pub struct Wal {
+    file: File,
+    /// Records that have not been written to the file yet
+    buffer: Vec<u8>,
+    /// The number of the first row in the log
+    base: usize,
+    /// How many rows are in the log
+    rows: usize,
+    /// How many bytes the file has, with the buffer
+    bytes: u64,
+    sync_interval: Duration,
+    last_sync: Instant,
+    /// Something was written since the last sync
+    unsynced: bool,
+}
+
+impl Wal {
+    /// Get the path of the log of the shard in `dir`
+    pub fn get_path(dir: &Path) -> PathBuf {
+        dir.join("wal.data")
+    }
+
+    /// Open the log of the shard in `dir`, returning it with the number of its first row and the
+    /// whole records in it
+    ///
+    /// The number of the first row is None if there is no log yet.
+    pub fn open(dir: &Path, sync_interval: Duration) -> (Self, Option<usize>, Vec<WalRecord>) {
+        let path = Wal::get_path(dir);
+        let bytes = fs::read(&path).unwrap_or_default();
+
+        let base = bytes
+            .get(..HEADER_SIZE as usize)
+            .map(|b| u64::from_le_bytes(b.try_into().unwrap()) as usize);
+
+        let mut records = vec![];
+        let mut offset = HEADER_SIZE as usize;
+
+        if base.is_some() {
+            while let Some((record, len)) = read_record(&bytes[offset..]) {
+                records.push(record);
+                offset += len;
+            }
+
+            if offset < bytes.len() {
+                warn!(
+                    "Write-ahead log ends with {} bytes of a partial record, removing them",
+                    bytes.len() - offset
+                );
+            }
+        }
+
+        let file = OpenOptions::new()
+            .read(true)
+            .write(true)
+            .create(true)
+            .truncate(false)
+            .open(&path)
+            .expect("Should open write-ahead log.");
+
+        let wal = Wal {
+            file,
+            buffer: vec![],
+            base: base.unwrap_or(0),
+            rows: records
+                .iter()
+                .filter(|r| matches!(r, WalRecord::Row { .. }))
+                .count(),
+            bytes: offset as u64,
+            sync_interval,
+            last_sync: Instant::now(),
+            unsynced: false,
+        };
+
+        if base.is_some() {
+            wal.file
+                .set_len(wal.bytes)
+                .expect("Should truncate write-ahead log.");
+            info!(
+                "Opened write-ahead log with {} rows from row {}",
+                wal.rows, wal.base
+            );
+        }
+
+        (wal, base, records)
+    }
+
+    /// The number of the first row in the log
+    pub fn base(&self) -> usize {
+        self.base
+    }
+
+    /// How many rows are in the log
+    pub fn rows(&self) -> usize {
+        self.rows
+    }
+
+    /// How many bytes the log has
+    pub fn len(&self) -> u64 {
+        self.bytes
+    }
+
+    fn push(&mut self, kind: u8, payload: &[u8]) {
+        self.buffer.push(kind);
+        self.buffer
+            .extend_from_slice(&(payload.len() as u32).to_le_bytes());
+        self.buffer.extend_from_slice(payload);
+        self.buffer
+            .extend_from_slice(&check(kind, payload).to_le_bytes());
+
+        self.bytes += 9 + payload.len() as u64;
+    }
+
+    /// Add a new name to the log, which has to come before the first row that uses it
+    pub fn log_name(&mut self, code: u32, name: &str) {
+        let mut payload = Vec::with_capacity(4 + name.len());
+        payload.extend_from_slice(&code.to_le_bytes());
+        payload.extend_from_slice(name.as_bytes());
+
+        self.push(KIND_NAME, &payload);
+    }
+
+    /// Add the next row to the log
+    pub fn log_row(&mut self, code: u32, start: u128, delta: u128) {
+        let mut payload = [0u8; 36];
+        payload[..4].copy_from_slice(&code.to_le_bytes());
+        payload[4..20].copy_from_slice(&start.to_le_bytes());
+        payload[20..].copy_from_slice(&delta.to_le_bytes());
+
+        self.push(KIND_ROW, &payload);
+        self.rows += 1;
+    }
+
+    fn write_buffer(&mut self) {
+        if self.buffer.is_empty() {
+            return;
+        }
+
+        self.file
+            .seek(SeekFrom::End(0))
+            .expect("Should seek in write-ahead log.");
+        self.file
+            .write_all(&self.buffer)
+            .expect("Should write to write-ahead log.");
+
+        self.buffer.clear();
+        self.unsynced = true;
+    }
+
+    /// Write the records added since the last commit to the file with one write, and sync the
+    /// file if it has not been synced for `sync_interval`
+    ///
+    /// Once this returns the records survive the process crashing. They survive the machine
+    /// crashing once they are synced.
+    pub fn commit(&mut self) {
+        self.write_buffer();
+
+        if self.needs_sync() {
+            self.sync();
+        }
+    }
+
+    /// Check if records were written and the log has not been synced for `sync_interval`
+    pub fn needs_sync(&self) -> bool {
+        self.unsynced && self.last_sync.elapsed() >= self.sync_interval
+    }
+
+    /// Commit and sync the log right away
+    pub fn sync(&mut self) {
+        self.write_buffer();
+
+        if self.unsynced {
+            self.file.sync_data().expect("Should sync write-ahead log.");
+            self.unsynced = false;
+        }
+
+        self.last_sync = Instant::now();
+    }
+
+    /// Start the log over at row `base`, once everything in it is saved somewhere else
+    pub fn reset(&mut self, base: usize) {
+        self.buffer.clear();
+
+        self.file
+            .set_len(0)
+            .expect("Should truncate write-ahead log.");
+        self.file
+            .seek(SeekFrom::Start(0))
+            .expect("Should seek in write-ahead log.");
+        self.file
+            .write_all(&(base as u64).to_le_bytes())
+            .expect("Should write to write-ahead log.");
+        self.file.sync_data().expect("Should sync write-ahead log.");
+
+        self.base = base;
+        self.rows = 0;
+        self.bytes = HEADER_SIZE;
+        self.last_sync = Instant::now();
+        self.unsynced = false;
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use crate::constants::DATA_DIRECTORY;
+    use std::thread;
+
+    fn test_dir(name: &str) -> PathBuf {
+        let dir = Path::new("./").join(DATA_DIRECTORY).join(name);
+        let _ = fs::remove_dir_all(&dir);
+        fs::create_dir_all(&dir).unwrap();
+        dir
+    }
+
+    #[test]
+    fn log_and_replay_test() {
+        let dir = test_dir("wal-test-1");
+
+        {
+            let (mut wal, base, records) = Wal::open(&dir, Duration::from_millis(100));
+            assert_eq!(base, None);
+            assert!(records.is_empty());
+
+            wal.reset(7);
+            wal.log_name(0, "first");
+            wal.log_row(0, 100, 5);
+            wal.log_row(0, 200, 6);
+            wal.commit();
+
+            // Rows that were never committed are not in the file
+            wal.log_row(0, 300, 7);
+        }
+
+        let (wal, base, records) = Wal::open(&dir, Duration::ZERO);
+        assert_eq!(base, Some(7));
+        assert_eq!(wal.rows(), 2);
+        assert_eq!(
+            records,
+            vec![
+                WalRecord::Name {
+                    code: 0,
+                    name: "first".to_string()
+                },
+                WalRecord::Row {
+                    code: 0,
+                    start: 100,
+                    delta: 5
+                },
+                WalRecord::Row {
+                    code: 0,
+                    start: 200,
+                    delta: 6
+                },
+            ]
+        );
+
+        let _ = fs::remove_dir_all(&dir);
+    }
+
+    #[test]
+    fn needs_sync_test() {
+        let dir = test_dir("wal-test-3");
+        let (mut wal, _, _) = Wal::open(&dir, Duration::from_millis(30));
+        wal.reset(0);
+        assert!(!wal.needs_sync());
+
+        // A group that comes right after a sync is left for later
+        wal.sync();
+        wal.log_row(0, 100, 5);
+        wal.commit();
+        assert!(!wal.needs_sync());
+
+        thread::sleep(Duration::from_millis(40));
+        assert!(wal.needs_sync());
+
+        wal.sync();
+        assert!(!wal.needs_sync());
+
+        let _ = fs::remove_dir_all(&dir);
+    }
+
+    #[test]
+    fn torn_record_is_dropped_test() {
+        let dir = test_dir("wal-test-2");
+
+        let whole = {
+            let (mut wal, _, _) = Wal::open(&dir, Duration::ZERO);
+            wal.reset(0);
+            wal.log_row(3, 10, 1);
+            wal.sync();
+            wal.len()
+        };
+
+        // Half of a record, as if the process died in the middle of the write
+        let mut file = OpenOptions::new()
+            .append(true)
+            .open(Wal::get_path(&dir))
+            .unwrap();
+        file.write_all(&[KIND_ROW, 36, 0, 0, 0, 1, 2, 3]).unwrap();
+
+        let (mut wal, _, records) = Wal::open(&dir, Duration::ZERO);
+        assert_eq!(records.len(), 1);
+        assert_eq!(wal.len(), whole);
+
+        // New records go after the last whole one
+        wal.log_row(3, 20, 2);
+        wal.commit();
+
+        let (_, _, records) = Wal::open(&dir, Duration::ZERO);
+        assert_eq!(records.len(), 2);
+
+        // A record that does not match its check ends the log
+        let path = Wal::get_path(&dir);
+        let mut bytes = fs::read(&path).unwrap();
+        let last = bytes.len() - 10;
+        bytes[last] ^= 0xff;
+        fs::write(&path, bytes).unwrap();
+
+        let (_, _, records) = Wal::open(&dir, Duration::ZERO);
+        assert_eq!(records.len(), 1);
+
+        let _ = fs::remove_dir_all(&dir);
+    }
+}
@@ -0,0 +1,113 @@
+use log::warn;
+use std::fs::{self, OpenOptions};
+use std::io::Write;
+use std::path::{Path, PathBuf};
+
+// The writer tells readers in other processes how many rows they can use with the watermark file.
+//
+// A row only counts once everything it needs is on disk: its values in the columns, its name in
+// the name dictionary and the page of the name column it is in. So the writer publishes a new
+// watermark at the end of each checkpoint of the write-ahead log, which happens at least every
+// CHECKPOINT_INTERVAL milliseconds while there are new rows, once the log is WAL_CHECKPOINT_BYTES
+// big, and on every flush.
+//
+// The file is 16 bytes, all little endian:
+//
+// | rows (u64) | rows ^ WATERMARK_CHECK (u64) |
+//
+// It is overwritten in place with one write, so a reader could see half of an old and half of a
+// new watermark. The second number catches that, and the reader keeps the rows it already had.
+
+const WATERMARK_CHECK: u64 = 0x6b72_6f6e_6963_6c65;
+
+pub struct Watermark {}
+
+impl Watermark {
+    /// Get the path of the watermark of the shard in `dir`
+    pub fn get_path(dir: &Path) -> PathBuf {
+        dir.join("watermark.data")
+    }
+
+    /// Tell readers that the first `rows` rows are on disk
+    pub fn publish(path: &Path, rows: usize) {
+        let rows = rows as u64;
+
+        let mut bytes = [0u8; 16];
+        bytes[..8].copy_from_slice(&rows.to_le_bytes());
+        bytes[8..].copy_from_slice(&(rows ^ WATERMARK_CHECK).to_le_bytes());
+
+        let mut file = OpenOptions::new()
+            .write(true)
+            .create(true)
+            .truncate(false)
+            .open(path)
+            .expect("Should open watermark file.");
+
+        file.write_all(&bytes).expect("Should write watermark.");
+    }
+
+    /// Read how many rows the writer has published, or None if there is no whole watermark
+    pub fn read(path: &Path) -> Option<usize> {
+        let bytes = fs::read(path).ok()?;
+
+        if bytes.len() < 16 {
+            return None;
+        }
+
+        let rows = u64::from_le_bytes(bytes[..8].try_into().unwrap());
+        let check = u64::from_le_bytes(bytes[8..16].try_into().unwrap());
+
+        if rows ^ WATERMARK_CHECK != check {
+            warn!("Watermark at {:?} was read while it was written", path);
+            return None;
+        }
+
+        Some(rows as usize)
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use crate::constants::DATA_DIRECTORY;
+
+    fn test_path(name: &str) -> PathBuf {
+        let dir = Path::new("./").join(DATA_DIRECTORY);
+        if !dir.exists() {
+            let _ = fs::create_dir_all(&dir);
+        }
+
+        let path = dir.join(name);
+        let _ = fs::remove_file(&path);
+        path
+    }
+
+    #[test]
+    fn publish_and_read_test() {
+        let path = test_path("watermark-test-1.data");
+
+        assert_eq!(Watermark::read(&path), None);
+
+        Watermark::publish(&path, 42);
+        assert_eq!(Watermark::read(&path), Some(42));
+
+        Watermark::publish(&path, 1 << 40);
+        assert_eq!(Watermark::read(&path), Some(1 << 40));
+
+        let _ = fs::remove_file(&path);
+    }
+
+    #[test]
+    fn torn_watermark_is_ignored_test() {
+        let path = test_path("watermark-test-2.data");
+
+        // The rows of one watermark with the check of another
+        let mut bytes = 7u64.to_le_bytes().to_vec();
+        bytes.extend_from_slice(&(9 ^ WATERMARK_CHECK).to_le_bytes());
+        fs::write(&path, bytes).unwrap();
+
+        assert_eq!(Watermark::read(&path), None);
+
+        let _ = fs::remove_file(&path);
+    }
+}
@@ -1,4 +1,5 @@
-from fastapi import FastAPI
+from typing import List, Optional
+from fastapi import FastAPI, Query
 import uvicorn
 import kronicler
 import random
@@ -41,9 +42,16 @@ def get_value():
     return bar()
 
 
+# Pass the high water from the last poll as since_id to only get new rows, one since_id for
+# each shard
 @app.get("/logs")
-def read_logs():
-    return DB.logs()
+def read_logs(since_id: Optional[List[int]] = Query(None), limit: Optional[int] = None):
+    return DB.logs(since_id=since_id, limit=limit)
+
+
+@app.get("/logs/high_water")
+def read_high_water():
+    return DB.high_water()
 
 
 if __name__ == "__main__":
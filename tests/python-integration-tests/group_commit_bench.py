@@ -0,0 +1,34 @@
+# Benchmark: How does the batch size change capture throughput?
+#
+# Each run makes a sync consume database that writes captures in groups of
+# `batch_size`, then times how long it takes to capture and flush N rows.
+# A batch size of 1 writes every capture on its own, like before batch_size
+# was configurable.
+#
+# Run this from an empty directory, it writes to .kronicler_data.
+
+import kronicler
+import time
+
+N = 100_000
+BATCH_SIZES = [1, 10, 100, 1_000, 10_000]
+
+
+def bench(batch_size: int) -> float:
+    # A long max_delay so only the batch size decides when a group is written
+    db = kronicler.Database(sync_consume=True, batch_size=batch_size, max_delay=60_000)
+
+    start = time.time()
+    for i in range(N):
+        db.capture("bench", [], i, i + 100)
+    db.flush()
+
+    return time.time() - start
+
+
+if __name__ == "__main__":
+    print(f"{'batch_size':>10} {'seconds':>10} {'captures/s':>12}")
+
+    for batch_size in BATCH_SIZES:
+        total = bench(batch_size)
+        print(f"{batch_size:>10} {total:>10.3f} {N / total:>12.0f}")